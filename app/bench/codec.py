@@ -0,0 +1,202 @@
+"""
+Codec benchmark suite: time the functions every query goes through, over
+the test suite queries and synthetic large responses, save the results as
+JSON and compare them with a saved baseline.
+
+Run it on the tree before a change with ``run --output base.json``, again
+after, and ``compare base.json new.json`` lists every case and exits with
+1 when any got slower than the threshold allows.
+
+Usage: python -m app.bench.codec run [--repeat N] [--output FILE]
+       python -m app.bench.codec compare BASELINE RESULTS [--threshold F]
+"""
+import argparse
+import copy
+import json
+import logging
+import platform
+import sys
+import time
+from typing import Callable
+from app.bench import samples
+from app.bench.decode import measure
+from app.dns.common import RType
+from app.dns.encoding import Encoding
+from app.dns.header import Header
+from app.dns.message import Message
+from app.dns.rdata import RDATA
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    queries = samples.queries()
+    query = samples.query()
+    large = samples.response(answers=50)
+    flat = samples.response(answers=50, compressed=False)
+    mixed = samples.mixed()
+
+    header = Header.from_bytes(large)
+    labels = 'www.codecrafters.io'.split('.')
+    decoded = {name: Message.from_bytes(data)
+               for name, data in (('50 answers', large), ('mixed', mixed))}
+    parsed = Message.from_bytes(query)
+
+    def decode_queries() -> None:
+        for data in queries:
+            Message.from_bytes(data)
+
+    def respond_queries() -> None:
+        for data in queries:
+            Message.from_bytes(data).create_response()
+
+    return {
+        'Header.from_bytes': lambda: Header.from_bytes(large),
+        'Header.__bytes__': lambda: bytes(header),
+        'Encoding.decode_domain_name': (
+            lambda: Encoding.decode_domain_name(large, 12)
+        ),
+        'Encoding.decode_domain_name (pointer)': (
+            lambda: Encoding.decode_domain_name(large, len(large) - 16)
+        ),
+        'Encoding.encode_domain_name': (
+            lambda: Encoding.encode_domain_name(labels)
+        ),
+        'Encoding.encode_domain_name (compressed)': (
+            lambda: Encoding.encode_domain_name(labels, 12,
+                                                {'codecrafters.io': 12})
+        ),
+        'Message.from_bytes (test queries)': decode_queries,
+        'Message.from_bytes (50 answers)': lambda: Message.from_bytes(large),
+        'Message.from_bytes (50 answers, uncompressed)': (
+            lambda: Message.from_bytes(flat)
+        ),
+        'Message.from_bytes (mixed)': lambda: Message.from_bytes(mixed),
+        'Message.create_response (stub)': lambda: parsed.create_response(),
+        'Message.create_response (stub, test queries)': respond_queries,
+        'Message.serialize (50 answers)': decoded['50 answers'].serialize,
+        'Message.serialize (mixed)': decoded['mixed'].serialize,
+        'Message.serialize (mixed, compressed)': (
+            lambda: decoded['mixed'].serialize(compress=True)
+        ),
+        'copy.copy(Message) (50 answers)': (
+            lambda: copy.copy(decoded['50 answers'])
+        ),
+        'copy.copy(Message) (mixed)': lambda: copy.copy(decoded['mixed']),
+        'RDATA.factory (A)': (
+            lambda: RDATA.factory(RType.A.value, data='1.2.3.4')
+        ),
+        'RDATA.factory (MX)': (
+            lambda: RDATA.factory(RType.MX.value, preference=10,
+                                  exchange='mx.codecrafters.io')
+        ),
+    }
+
+
+def run(repeat: int = 5) -> dict:
+    """
+    :rtype: dict
+    :return: Seconds per call of every case, with where they were measured
+    """
+    return {
+        'time': time.time(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'results': {name: measure(func, repeat)
+                    for name, func in cases().items()},
+    }
+
+
+def compare(baseline: dict, results: dict,
+            threshold: float = 0.1) -> list[str]:
+    """
+    Print every case of `results` next to `baseline`.
+
+    :param float threshold: Slowdown tolerated, as a fraction of the
+                            baseline time
+    :rtype: list[str]
+    :return: The cases slower than `threshold` allows
+    """
+    res = []
+    print(f'{"":<48} {"baseline":>10} {"results":>10} {"change":>8}')
+    for name, seconds in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f'{name:<48} {"":>10} {seconds * 1e6:>8.2f}us')
+            continue
+
+        change = seconds / before - 1
+        flag = ''
+        if change > threshold:
+            res.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<48} {before * 1e6:>8.2f}us {seconds * 1e6:>8.2f}us '
+              f'{change:>+8.1%}{flag}')
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Time every case')
+    run_parser.add_argument('--repeat', type=int, default=5,
+                            help='Runs per case, the best one is reported '
+                                 '(default: %(default)s)')
+    run_parser.add_argument('--output', metavar='FILE',
+                            help='Save the results as JSON to FILE')
+    run_parser.add_argument('--baseline', metavar='FILE',
+                            help='Compare the results with FILE, as '
+                                 'compare does')
+    run_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Slowdown flagged as a regression, as a '
+                                 'fraction (default: %(default)s)')
+
+    compare_parser = commands.add_parser(
+        'compare', help='Compare saved results with a baseline'
+    )
+    compare_parser.add_argument('baseline', help='Results saved before')
+    compare_parser.add_argument('results', help='Results to check')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='Slowdown flagged as a regression, as '
+                                     'a fraction (default: %(default)s)')
+    arg = parser.parse_args()
+
+    baseline = None
+    if arg.command == 'compare' or arg.baseline is not None:
+        path = arg.baseline
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not read {path}: {e}')
+
+    if arg.command == 'compare':
+        try:
+            with open(arg.results) as f:
+                results = json.load(f)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not read {arg.results}: {e}')
+    else:
+        # Nothing below WARNING is timed, as in production
+        logging.getLogger().setLevel(logging.WARNING)
+        try:
+            results = run(arg.repeat)
+        except ImportError as e:
+            parser.error(str(e))
+        if arg.output is not None:
+            with open(arg.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        if baseline is None:
+            for name, seconds in results['results'].items():
+                print(f'{name:<48} {seconds * 1e6:>10.2f} us')
+
+    if baseline is not None:
+        regressions = compare(baseline, results, arg.threshold)
+        if regressions:
+            print(f'{len(regressions)} case(s) slower than '
+                  f'{arg.threshold:.0%} over the baseline')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compression benchmark: compare the size and the encode time of responses
+serialized with and without name compression.
+
+Usage: python -m app.bench.compression [--repeat N]
+"""
+import argparse
+from app.bench import samples
+from app.bench.decode import measure
+from app.dns.message import Message
+
+
+def cases() -> dict[str, Message]:
+    return {
+        'stub response': (
+            Message.from_bytes(samples.queries()[0]).create_response()
+        ),
+        '20 A answers': Message.from_bytes(
+            samples.response(answers=20, compressed=False)
+        ),
+        '100 A answers': Message.from_bytes(
+            samples.response(answers=100, compressed=False)
+        ),
+        'CNAME, MX, NS, SOA and glue': Message.from_bytes(samples.mixed()),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    print(f'{"":<30} {"plain":>8} {"compressed":>11} '
+          f'{"plain":>11} {"compressed":>11}')
+    for name, message in cases().items():
+        plain = len(message.serialize())
+        compressed = len(message.serialize(compress=True))
+        plain_time = measure(lambda: message.serialize(), arg.repeat)
+        compressed_time = measure(
+            lambda: message.serialize(compress=True), arg.repeat
+        )
+        print(f'{name:<30} {plain:>7}B {compressed:>10}B '
+              f'{plain_time * 1e6:>9.1f}us {compressed_time * 1e6:>9.1f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Decode benchmark: time :meth:`Message.from_bytes` and the primitives it is
+built on over the test suite queries and synthetic responses.
+
+Usage: python -m app.bench.decode [--repeat N]
+"""
+import argparse
+import timeit
+from typing import Callable
+from app.bench import samples
+from app.dns.encoding import Encoding
+from app.dns.header import Header
+from app.dns.message import Message
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    queries = samples.queries()
+    small = samples.response(answers=1)
+    large = samples.response(answers=50)
+    flat = samples.response(answers=50, compressed=False)
+    mixed = samples.mixed()
+
+    def decode_queries() -> None:
+        for data in queries:
+            Message.from_bytes(data)
+
+    return {
+        'Header.from_bytes': lambda: Header.from_bytes(large),
+        'Encoding.decode_domain_name': (
+            lambda: Encoding.decode_domain_name(large, 12)
+        ),
+        'Encoding.decode_domain_name (pointer)': (
+            lambda: Encoding.decode_domain_name(large, len(large) - 16)
+        ),
+        'Message.from_bytes (test queries)': decode_queries,
+        'Message.from_bytes (1 answer)': lambda: Message.from_bytes(small),
+        'Message.from_bytes (50 answers)': lambda: Message.from_bytes(large),
+        'Message.from_bytes (50 answers, uncompressed)': (
+            lambda: Message.from_bytes(flat)
+        ),
+        'Message.from_bytes (50 answers, lazy)': (
+            lambda: Message.from_bytes(large, lazy=True)
+        ),
+        'Message.from_bytes (mixed, lazy, answers only)': (
+            lambda: Message.from_bytes(mixed, lazy=True).answers
+        ),
+        'Message.from_bytes (mixed)': lambda: Message.from_bytes(mixed),
+    }
+
+
+def measure(func: Callable[[], object], repeat: int = 5) -> float:
+    """
+    Best time of `repeat` runs, in seconds per call.
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    for name, func in cases().items():
+        print(f'{name:<48} {measure(func, arg.repeat) * 1e6:>10.2f} us')
+
+
+if __name__ == '__main__':
+    main()
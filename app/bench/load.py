@@ -0,0 +1,377 @@
+"""
+Load generator: drive a server on this host with queries over UDP or TCP,
+at a target rate or as fast as it answers, and report the rate achieved,
+the queries lost or timed out and the latency distribution.
+
+The queries are built with :class:`Message`, from names given on the
+command line or a query file of ``name [TYPE]`` lines. Every sender has
+its own socket and a thread receiving on it; at maximum rate a sender
+keeps `--outstanding` queries in flight, at a target rate the senders
+share it and send on schedule whether answered or not. The generator is
+Python too, compare its CPU use with the server's before trusting the
+maximum rate.
+
+Usage: python -m app.bench.load [--tcp] [--rate QPS] [--senders N]
+"""
+import argparse
+import ipaddress
+import socket
+import struct
+import threading
+import time
+from app.dns.common import QType, RClass, ResponseCode, RType
+from app.dns.header import Header
+from app.dns.message import Message
+from app.dns.metrics import LatencyHistogram
+from app.dns.record import Query
+
+_ID = struct.Struct('>H')
+_LENGTH = struct.Struct('>H')
+
+
+def build(name: str, qtype: int = RType.A.value) -> bytes:
+    """
+    A query with RD set asking a single question, its ID set per send.
+    """
+    header = Header(id=0, qdcount=1)
+    header.flags.rd = 1
+    return Message(
+        header=header,
+        queries=[Query(name=name, type=qtype, klass=RClass.IN)],
+    ).serialize()
+
+
+def load(path: str) -> list[bytes]:
+    """
+    Queries read from a file of ``name [TYPE]`` lines, blank lines and
+    lines starting with ``#`` are skipped.
+
+    :raises ValueError: On an unknown type
+    """
+    res = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            name = fields[0].rstrip('.')
+            qtype = fields[1].upper() if len(fields) > 1 else 'A'
+            if RType.name_exists(qtype):
+                code = RType[qtype].value
+            elif QType.name_exists(qtype):
+                code = QType[qtype].value
+            else:
+                raise ValueError(f'Unknown type {fields[1]} in {path}')
+            res.append(build(name, code))
+    return res
+
+
+class Sender:
+    """One socket sending queries and the thread receiving their answers"""
+
+    def __init__(self, address: tuple[str, int], queries: list[bytes],
+                 tcp: bool = False, timeout: float = 1.0,
+                 rate: float = 0.0, outstanding: int = 1):
+        """
+        :param address: Server to query as (ip, port)
+        :param list queries: Queries sent in turn, their ID is replaced
+        :param bool tcp: Query over a TCP connection instead of UDP
+        :param float timeout: Seconds after which a query is timed out
+        :param float rate: Queries per second, 0 to send as soon as fewer
+                           than `outstanding` are waiting for an answer
+        :param int outstanding: Queries in flight at maximum rate
+        """
+        self.queries = queries
+        self.tcp = tcp
+        self.timeout = timeout
+        self.rate = rate
+        self.window = threading.BoundedSemaphore(outstanding)
+
+        family = socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM
+        self.sock = socket.socket(socket.AF_INET, family)
+        self.sock.connect(address)
+        self.sock.settimeout(0.1)
+
+        #: Send time of the queries waiting for an answer, per ID
+        self.pending: dict[int, float] = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.sent = 0
+        self.received = 0
+
+        #: Seconds spent sending, the rates are measured over
+        self.elapsed = 0.0
+
+        #: Answers received after `timeout`
+        self.late = 0
+
+        #: Queries the server refused or the socket failed to send
+        self.errors = 0
+
+        self.rcodes: dict[int, int] = {}
+        self.latency = LatencyHistogram()
+
+    def run(self, duration: float) -> None:
+        """
+        Send for `duration` seconds, then wait `timeout` for the answers.
+        """
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+        try:
+            self.send(time.perf_counter() + duration)
+            time.sleep(self.timeout)
+        finally:
+            self.stopped.set()
+            receiver.join()
+            self.sock.close()
+
+    def send(self, deadline: float) -> None:
+        start = time.perf_counter()
+        try:
+            self._send(start, deadline)
+        finally:
+            self.elapsed = time.perf_counter() - start
+
+    def _send(self, start: float, deadline: float) -> None:
+        interval = 1 / self.rate if self.rate > 0 else 0.0
+        query_id = 0
+        while True:
+            now = time.perf_counter()
+            if now >= deadline:
+                return
+
+            if interval:
+                due = start + self.sent * interval
+                if due > now:
+                    time.sleep(due - now)
+            elif not self.window.acquire(timeout=self.timeout):
+                # Every query in flight timed out, make room for more
+                self.expire(time.perf_counter())
+                continue
+
+            query_id = (query_id + 1) & 0xffff
+            data = self.queries[self.sent % len(self.queries)]
+            data = _ID.pack(query_id) + data[2:]
+            if self.tcp:
+                data = _LENGTH.pack(len(data)) + data
+
+            with self.lock:
+                self.pending[query_id] = time.perf_counter()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.errors += 1
+                with self.lock:
+                    self.pending.pop(query_id, None)
+                if not interval:
+                    self.window.release()
+                if self.tcp:
+                    return
+            self.sent += 1
+
+    def expire(self, now: float) -> None:
+        """
+        Forget the queries waiting longer than `timeout`, their answer is
+        counted late if it comes.
+        """
+        with self.lock:
+            expired = [i for i, sent in self.pending.items()
+                       if now - sent > self.timeout]
+            for query_id in expired:
+                del self.pending[query_id]
+        if not self.rate:
+            for _ in expired:
+                self.window.release()
+
+    def receive(self) -> None:
+        buffer = b''
+        while not self.stopped.is_set():
+            try:
+                data = self.sock.recv(0xffff)
+            except (socket.timeout, BlockingIOError):
+                continue
+            except OSError:
+                # Refused by the server, or the connection closed
+                self.errors += 1
+                if self.tcp:
+                    return
+                continue
+            if self.tcp and not data:
+                return
+            now = time.perf_counter()
+
+            if not self.tcp:
+                self.answer(data, now)
+                continue
+
+            buffer += data
+            while len(buffer) >= _LENGTH.size:
+                (length,) = _LENGTH.unpack_from(buffer)
+                if len(buffer) < _LENGTH.size + length:
+                    break
+                self.answer(buffer[_LENGTH.size:_LENGTH.size + length], now)
+                buffer = buffer[_LENGTH.size + length:]
+
+    def answer(self, data: bytes, now: float) -> None:
+        if len(data) < 12:
+            self.errors += 1
+            return
+        (query_id,) = _ID.unpack_from(data)
+        with self.lock:
+            sent = self.pending.pop(query_id, None)
+        if sent is None:
+            self.late += 1
+            return
+        if not self.rate:
+            self.window.release()
+
+        elapsed = now - sent
+        if elapsed > self.timeout:
+            self.late += 1
+            return
+
+        self.received += 1
+        self.latency.record(elapsed)
+        rcode = data[3] & 0x0f
+        self.rcodes[rcode] = self.rcodes.get(rcode, 0) + 1
+
+
+def positive_int(value: str) -> int:
+    """
+    :raises argparse.ArgumentTypeError: If `value` isn't an integer above 0
+    """
+    try:
+        res = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid integer {value}')
+    if res < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not above 0')
+    return res
+
+
+def positive_float(value: str) -> float:
+    """
+    :raises argparse.ArgumentTypeError: If `value` isn't a number above 0
+    """
+    try:
+        res = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Invalid number {value}')
+    if not res > 0:
+        raise argparse.ArgumentTypeError(f'{value} is not above 0')
+    return res
+
+
+def loopback(address: str) -> tuple[str, int]:
+    """
+    :raises argparse.ArgumentTypeError: If the address isn't on this host
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        ip = socket.gethostbyname(host or '127.0.0.1')
+        if not ipaddress.ip_address(ip).is_loopback:
+            raise argparse.ArgumentTypeError(
+                f'{address} is not a loopback address, load is only '
+                f'generated against this host'
+            )
+        return ip, int(port)
+    except (OSError, ValueError):
+        raise argparse.ArgumentTypeError(f'Invalid address {address}')
+
+
+def report(senders: list[Sender], tcp: bool) -> None:
+    # From the first query sent to the last, as the senders ran together
+    elapsed = max(s.elapsed for s in senders) or float('inf')
+    sent = sum(s.sent for s in senders)
+    received = sum(s.received for s in senders)
+    late = sum(s.late for s in senders)
+    errors = sum(s.errors for s in senders)
+    lost = sent - received - late
+    latency = LatencyHistogram()
+    rcodes: dict[int, int] = {}
+    for sender in senders:
+        latency.merge(sender.latency)
+        for rcode, count in sender.rcodes.items():
+            rcodes[rcode] = rcodes.get(rcode, 0) + count
+
+    def share(count: int) -> str:
+        return f'{count} ({count / sent:.2%})' if sent else str(count)
+
+    print(f'Sent {sent} queries over {"TCP" if tcp else "UDP"} in '
+          f'{elapsed:.2f}s from {len(senders)} sender(s)')
+    print(f'Achieved {sent / elapsed:.1f} qps sent, '
+          f'{received / elapsed:.1f} qps answered')
+    print(f'Timed out {share(sent - received)}: lost {share(lost)}, '
+          f'late {share(late)}; socket errors {errors}')
+    if latency.count:
+        print('Latency ' + ', '.join(
+            f'{p} {seconds * 1000:.3f}ms'
+            for p, seconds in latency.percentiles().items()
+        ) + f', mean {latency.sum / latency.count * 1000:.3f}ms')
+    print('Response codes ' + ', '.join(
+        f'{ResponseCode.safe_get_name_by_value(rcode)} {count}'
+        for rcode, count in sorted(rcodes.items())
+    ))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', type=loopback,
+                        default=('127.0.0.1', 2053),
+                        help='Server to load, on this host '
+                             '(default: 127.0.0.1:2053)')
+    parser.add_argument('--name', action='append', dest='names',
+                        help='Name to query for A records, may be repeated '
+                             '(default: codecrafters.io)')
+    parser.add_argument('--queries', metavar='FILE',
+                        help='File of "name [TYPE]" lines to query instead')
+    parser.add_argument('--tcp', action='store_true',
+                        help='Query over TCP instead of UDP')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Queries per second shared by the senders, 0 '
+                             'for the maximum rate (default: %(default)s)')
+    parser.add_argument('--senders', type=positive_int, default=1,
+                        help='Concurrent senders, each with its own socket '
+                             '(default: %(default)s)')
+    parser.add_argument('--outstanding', type=positive_int, default=1,
+                        help='Queries in flight per sender at maximum rate '
+                             '(default: %(default)s)')
+    parser.add_argument('--duration', type=positive_float, default=10.0,
+                        help='Seconds to send for (default: %(default)s)')
+    parser.add_argument('--timeout', type=positive_float, default=1.0,
+                        help='Seconds before a query is timed out '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+    if arg.rate < 0:
+        parser.error(f'argument --rate: {arg.rate:g} is below 0')
+
+    if arg.queries is not None:
+        try:
+            queries = load(arg.queries)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        if not queries:
+            parser.error(f'No queries in {arg.queries}')
+    else:
+        queries = [build(name) for name in arg.names or ['codecrafters.io']]
+
+    senders = [
+        Sender(arg.server, queries, tcp=arg.tcp, timeout=arg.timeout,
+               rate=arg.rate / arg.senders, outstanding=arg.outstanding)
+        for _ in range(arg.senders)
+    ]
+    threads = [
+        threading.Thread(target=sender.run, args=(arg.duration,))
+        for sender in senders
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report(senders, arg.tcp)
+
+
+if __name__ == '__main__':
+    main()
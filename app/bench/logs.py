@@ -0,0 +1,99 @@
+"""
+Logging benchmark: time answering a query with the log records written by
+a handler on the packet path or through the queue pipeline, at INFO and
+with the per-packet messages enabled, sampled or not, and count the log
+volume written per packet.
+
+Usage: python -m app.bench.logs [--repeat N]
+"""
+import argparse
+import logging
+from typing import Callable
+from app.bench import samples
+from app.bench.decode import measure
+from app.dns.common import LogPipeline, PACKET_LOGGER
+from app.dns.message import Message
+
+
+class Sink:
+    """A stream counting what is written to it"""
+
+    def __init__(self) -> None:
+        self.lines = 0
+        self.bytes = 0
+
+    def write(self, data: str) -> None:
+        self.lines += data.count('\n')
+        self.bytes += len(data)
+
+    def flush(self) -> None:
+        pass
+
+
+def handler(sink: Sink) -> logging.Handler:
+    res = logging.StreamHandler(sink)
+    res.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    ))
+    return res
+
+
+def run(func: Callable[[], object], root: logging.Handler,
+        repeat: int) -> tuple[float, int]:
+    """
+    :return: Seconds per packet, and packets answered
+    """
+    count = 0
+
+    def packet() -> None:
+        nonlocal count
+        count += 1
+        func()
+
+    logger = logging.getLogger()
+    logger.addHandler(root)
+    try:
+        elapsed = measure(packet, repeat)
+    finally:
+        logger.removeHandler(root)
+    return elapsed, count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    query = samples.query()
+    logging.getLogger().setLevel(logging.INFO)
+
+    def answer() -> bytes:
+        return Message.from_bytes(query).create_response().serialize()
+
+    print(f'{"":<38} {"latency":>10} {"lines":>12} {"bytes":>12}')
+    packets = logging.getLogger(PACKET_LOGGER)
+    for name, level, rates in (
+        ('StreamHandler', logging.INFO, None),
+        ('QueueHandler', logging.INFO, {}),
+        ('QueueHandler, packets', logging.DEBUG, {}),
+        (f'QueueHandler, packets, {PACKET_LOGGER}=100', logging.DEBUG,
+         {PACKET_LOGGER: 100}),
+    ):
+        packets.setLevel(level)
+        sink = Sink()
+        if rates is None:
+            elapsed, count = run(answer, handler(sink), arg.repeat)
+        else:
+            pipeline = LogPipeline(handler(sink), rates=rates)
+            pipeline.start()
+            elapsed, count = run(answer, pipeline.handler, arg.repeat)
+            pipeline.stop()
+
+        print(f'{name:<38} {elapsed * 1e6:>8.2f}us '
+              f'{sink.lines / count:>8.2f}/pkt {sink.bytes / count:>8.1f}/pkt')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Memory benchmark: bytes allocated per header and per record, as held by a
+cache.
+
+Usage: python -m app.bench.memory [--count N]
+"""
+import argparse
+import tracemalloc
+from typing import Callable
+from app.bench import samples
+from app.dns.common import RClass, RType
+from app.dns.header import Header
+from app.dns.record import Query, ResourceRecord
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    header = samples.query()
+    data = samples.response(answers=1)
+    # Offset of the answer, after the header and the question
+    offset = len(samples.query())
+    names: dict[int, str] = {}
+
+    return {
+        'Header.from_bytes': lambda: Header.from_bytes(header),
+        'Query': lambda: Query(name='codecrafters.io', type=RType.A,
+                               klass=RClass.IN),
+        'ResourceRecord (no RDATA)': lambda: ResourceRecord(
+            name='codecrafters.io', type=RType.A, klass=RClass.IN, ttl=300,
+            rdlength=4, rdata=None
+        ),
+        'ResourceRecord.from_bytes (A)': (
+            lambda: ResourceRecord.from_bytes(data, offset, names)[0]
+        ),
+    }
+
+
+def allocated(func: Callable[[], object], count: int = 10000) -> float:
+    """
+    Bytes still allocated per object after building `count` of them.
+    """
+    objects: list[object] = [None] * count
+    func()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        for i in range(count):
+            objects[i] = func()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (after - before) / count
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--count', type=int, default=10000,
+                        help='Objects built per case (default: %(default)s)')
+    arg = parser.parse_args()
+
+    for name, func in cases().items():
+        print(f'{name:<48} {allocated(func, arg.count):>8.1f} B')
+
+
+if __name__ == '__main__':
+    main()
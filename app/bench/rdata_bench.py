@@ -0,0 +1,51 @@
+"""
+RDATA benchmark: time reading RDATA fields, copying RDATA and the records
+holding it, the way cache hits do, and building RDATA.
+
+Usage: python -m app.bench.rdata_bench [--repeat N]
+"""
+import argparse
+import copy
+from typing import Callable
+from app.bench.decode import measure
+from app.dns.common import RClass, RType
+from app.dns.rdata import RDATA
+from app.dns.record import ResourceRecord
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    a = RDATA.factory(RType.A.value, data='1.2.3.4')
+    soa = RDATA.factory(RType.SOA.value, mname='ns1.fastly.net',
+                        rname='hostmaster.fastly.net', serial=1,
+                        refresh=7200, retry=900, expire=1209600, minimum=300)
+    record = ResourceRecord(name='codecrafters.io', type=RType.A,
+                            klass=RClass.IN, ttl=300, rdlength=4,
+                            rdata=None)
+    record.rdata = a
+
+    return {
+        'RDATA_A.data': lambda: a.data,
+        'RDATA_SOA.minimum': lambda: soa.minimum,
+        'RDATA_A.data = ...': lambda: setattr(a, 'data', '1.2.3.4'),
+        'copy.copy(RDATA_A)': lambda: copy.copy(a),
+        'copy.copy(RDATA_SOA)': lambda: copy.copy(soa),
+        'copy.copy(ResourceRecord) (A)': lambda: copy.copy(record),
+        'RDATA.factory (A)': (
+            lambda: RDATA.factory(RType.A.value, data='1.2.3.4')
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    for name, func in cases().items():
+        print(f'{name:<48} {measure(func, arg.repeat) * 1e9:>10.1f} ns')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Messages shared by the benchmarks, from the test suite and synthetic ones
+larger than anything it holds.
+"""
+import struct
+from app.dns.encoding import Encoding
+
+_HEADER = struct.Struct('>HHHHHH')
+_QUESTION = struct.Struct('>HH')
+_RR = struct.Struct('>HHIH')
+
+
+def name(value: str) -> bytes:
+    return Encoding.encode_domain_name(value.split('.'))
+
+
+def query(qname: str = 'codecrafters.io', id: int = 0x1234,
+          qtype: int = 1) -> bytes:
+    """
+    A query with RD set asking a single question.
+    """
+    return (_HEADER.pack(id, 0x0100, 1, 0, 0, 0)
+            + name(qname) + _QUESTION.pack(qtype, 1))
+
+
+def response(answers: int = 20, qname: str = 'codecrafters.io',
+             compressed: bool = True) -> bytes:
+    """
+    A response to :func:`query` with `answers` A records, the owner names
+    pointing at the question when `compressed`.
+    """
+    owner = b'\xc0\x0c' if compressed else name(qname)
+    res = (_HEADER.pack(0x1234, 0x8180, 1, answers, 0, 0)
+           + name(qname) + _QUESTION.pack(1, 1))
+    for i in range(answers):
+        res += owner + _RR.pack(1, 1, 300, 4) + struct.pack(
+            '>BBBB', 10, 0, (i >> 8) & 0xff, i & 0xff
+        )
+    return res
+
+
+def mixed(servers: int = 4, qname: str = 'www.reddit.com') -> bytes:
+    """
+    A response with a CNAME and MX answers, NS and SOA authorities and glue
+    in the additional section, the kind of names compression pays off on.
+    """
+    from app.dns.common import RClass, RType
+    from app.dns.header import Header
+    from app.dns.message import Message
+    from app.dns.rdata import RDATA
+    from app.dns.record import Query, ResourceRecord
+
+    zone = qname.split('.', 1)[1]
+
+    def record(owner: str, type: RType, **rdata) -> ResourceRecord:
+        res = ResourceRecord(name=owner, type=type, klass=RClass.IN,
+                             ttl=300, rdlength=0, rdata=None)
+        res.rdata = RDATA.factory(type.value, **rdata)
+        return res
+
+    header = Header(id=0x1234)
+    header.flags.qr = 1
+    header.flags.rd = 1
+    header.flags.ra = 1
+    message = Message(
+        header=header,
+        queries=[Query(name=qname, type=RType.CNAME, klass=RClass.IN)],
+        answers=[record(qname, RType.CNAME, data=f'edge.{zone}')] + [
+            record(zone, RType.MX, preference=i, exchange=f'mx{i}.{zone}')
+            for i in range(servers)
+        ],
+        authorities=[
+            record(zone, RType.NS, data=f'ns{i}.{zone}')
+            for i in range(servers)
+        ] + [
+            record(zone, RType.SOA, mname=f'ns0.{zone}',
+                   rname=f'hostmaster.{zone}', serial=1, refresh=7200,
+                   retry=900, expire=1209600, minimum=300),
+        ],
+        additional=[
+            record(f'ns{i}.{zone}', RType.A, data=f'10.0.0.{i + 1}')
+            for i in range(servers)
+        ],
+    )
+    return message.serialize()
+
+
+def queries() -> list[bytes]:
+    """
+    The queries of the test suite that are answered without an error.
+
+    :raises ImportError: If the test suite isn't importable, as when the
+                         app package is installed without it
+    """
+    try:
+        from tests.messages import test_messages
+    except ImportError as e:
+        raise ImportError(
+            'The benchmarks replay the queries of tests/messages.py, run '
+            'them from the root of a source checkout'
+        ) from e
+    from app.dns.common import ResponseCode
+
+    return [data for _, data, rcode, _ in test_messages
+            if rcode == ResponseCode.NO_ERROR]
@@ -0,0 +1,55 @@
+"""
+Tracing benchmark: time handling a packet with the app loggers at WARNING,
+and at DEBUG with every trace formatted and written to the null device.
+
+Usage: python -m app.bench.trace [--repeat N]
+"""
+import argparse
+import logging
+import os
+from typing import Callable
+from app.bench import samples
+from app.bench.decode import measure
+from app.dns.message import Message
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    query = samples.query()
+    response = samples.response(answers=20)
+
+    return {
+        'query, stub response': (
+            lambda: Message.from_bytes(query).create_response().serialize()
+        ),
+        'Message.from_bytes (20 answers)': (
+            lambda: Message.from_bytes(response)
+        ),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    logger = logging.getLogger('app')
+    with open(os.devnull, 'w') as null:
+        handler = logging.StreamHandler(null)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+        print(f'{"":<40} {"off":>10} {"on":>13}')
+        for name, func in cases().items():
+            logger.setLevel(logging.WARNING)
+            off = measure(func, arg.repeat)
+            logger.setLevel(logging.DEBUG)
+            on = measure(func, arg.repeat)
+            print(f'{name:<40} {off * 1e6:>8.2f}us {on * 1e6:>11.2f}us')
+
+        logger.removeHandler(handler)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Validation benchmark: time :meth:`Message.validate` per message over the test
+suite queries and synthetic responses.
+
+Usage: python -m app.bench.validate [--repeat N]
+"""
+import argparse
+from typing import Callable
+from app.bench import samples
+from app.bench.decode import measure
+from app.dns.message import Message
+
+
+def cases() -> dict[str, Callable[[], object]]:
+    queries = [Message.from_bytes(data) for data in samples.queries()]
+    query = queries[0]
+    large = Message.from_bytes(samples.response(answers=50))
+    mixed = Message.from_bytes(samples.mixed())
+
+    def validate_queries() -> None:
+        for message in queries:
+            message.validate()
+
+    return {
+        'query': query.validate,
+        f'test queries ({len(queries)})': validate_queries,
+        '50 A answers': large.validate,
+        'CNAME, MX, NS, SOA and glue': mixed.validate,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Runs per case, the best one is reported '
+                             '(default: %(default)s)')
+    arg = parser.parse_args()
+
+    for name, func in cases().items():
+        print(f'{name:<48} {measure(func, arg.repeat) * 1e6:>10.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,567 @@
+import copy
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+from app.dns.common import RType
+from app.dns.encoding import Encoding
+from app.dns.record import Record, ResourceRecord
+
+CacheKey = tuple[str, int, int]
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    __slots__ = ('records', 'stored', 'expires', 'size', 'rcode', 'hits',
+                 'refreshing')
+
+    def __init__(self, records: list[ResourceRecord], stored: float,
+                 expires: float, size: int, rcode: int = 0):
+        #: The cached RRset, with the TTLs as received
+        self.records = records
+
+        #: Clock reading when the entry was stored
+        self.stored = stored
+
+        #: Clock reading when the shortest TTL runs out
+        self.expires = expires
+
+        #: Wire size of the records, counted against the byte budget
+        self.size = size
+
+        #: Response code the records were received with
+        self.rcode = rcode
+
+        #: Number of times the entry was handed out
+        self.hits = 0
+
+        #: Set once a refresh ahead of expiry was started
+        self.refreshing = False
+
+
+class Prefetch:
+    """
+    Refresh-ahead policy of a cache.
+
+    An entry that was hit often enough is refreshed in the background once
+    the end of its TTL is near, so popular names don't all miss at once when
+    their TTL runs out. The refresh is started by calling `callback` with
+    the key the entry was looked up with, the refreshed answer is expected
+    to be put back in the cache.
+    """
+
+    def __init__(self, callback: Callable[[Any], None], hits: int = 3,
+                 window: float = 0.1):
+        """
+        :param callback: Starts the refresh, must not block
+        :param int hits: Hits an entry needs before it is refreshed
+        :param float window: Fraction of the TTL left when the entry is
+                             refreshed
+        """
+        self.callback = callback
+        self.hits = hits
+        self.window = window
+
+        #: Number of refreshes started
+        self.count = 0
+
+    def due(self, entry: 'CacheEntry | AnswerEntry', now: float) -> bool:
+        """
+        Count a hit on `entry` and tell whether it should be refreshed now.
+        Called with the cache lock held.
+        """
+        entry.hits += 1
+        if entry.refreshing or entry.hits < self.hits:
+            return False
+
+        if entry.expires - now > (entry.expires - entry.stored) * self.window:
+            return False
+
+        entry.refreshing = True
+        self.count += 1
+        return True
+
+
+class RecordCache:
+    """
+    RRset cache keyed on the normalized (name, type, class) of a question.
+
+    The TTLs count down while a record sits in the cache and records are
+    handed out with their remaining TTL. An entry expires with its shortest
+    TTL. The least recently used entries are evicted once the entry count or
+    the byte budget is exceeded.
+
+    With a `stale_ttl`, expired entries are kept that much longer so they
+    can still be served (RFC 8767) when the upstream can't be reached.
+    """
+
+    def __init__(self, max_entries: int | None = 10000,
+                 max_bytes: int | None = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 prefetch: Prefetch | None = None, stale_ttl: int = 0,
+                 stale_answer_ttl: int = 30):
+        """
+        :param int max_entries: Maximum number of entries, None for no limit
+        :param int max_bytes: Maximum wire size of all cached records, None
+                              for no limit
+        :param clock: Monotonic clock returning seconds
+        :param Prefetch prefetch: Refreshes popular entries ahead of expiry
+        :param int stale_ttl: Seconds an expired entry is kept for
+                              :meth:`get_stale`, 0 to drop it right away
+        :param int stale_answer_ttl: TTL of the records served stale
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.prefetch = prefetch
+        self.stale_ttl = stale_ttl
+        self.stale_answer_ttl = stale_answer_ttl
+
+        self._entries: OrderedDict[CacheKey, CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+        #: Total wire size of the cached records
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.stale = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(query: Record) -> CacheKey:
+        return (query.name.lower().rstrip('.'), query.type, query.klass)
+
+    def get(self, query: Record) -> list[ResourceRecord] | None:
+        """
+        Cached answer to `query`, with the TTLs counted down.
+
+        :param Record query: The question
+        :rtype: list[ResourceRecord] | None
+        :return: Copies of the cached records, or None on a miss
+        """
+        entry, now = self._lookup(query)
+        if entry is None:
+            return None
+        return self._copy(entry, now)
+
+    def get_stale(self, query: Record) -> list[ResourceRecord] | None:
+        """
+        Expired answer to `query` (RFC 8767), for when the upstream failed.
+
+        :param Record query: The question
+        :rtype: list[ResourceRecord] | None
+        :return: Copies of the cached records with `stale_answer_ttl` as
+                 TTL, or None if nothing is cached or it expired more than
+                 `stale_ttl` ago
+        """
+        key = self.key(query)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.expires + self.stale_ttl <= now:
+                return None
+            self.stale += 1
+
+        records = []
+        for record in entry.records:
+            cached = copy.copy(record)
+            cached.ttl = min(record.ttl, self.stale_answer_ttl)
+            records.append(cached)
+        return records
+
+    def put(self, query: Record, records: list[ResourceRecord]) -> None:
+        """
+        Cache `records` as the answer to `query`.
+
+        :param Record query: The question
+        :param records: The answer, not cached if empty, with a zero TTL or
+                        with records of a type that can't be decoded
+        """
+        if len(records) < 1:
+            return
+
+        if not all(isinstance(record, ResourceRecord) for record in records):
+            return
+
+        ttl = min(record.ttl for record in records)
+        if ttl <= 0:
+            return
+
+        size = 0
+        if self.max_bytes is not None:
+            size = sum(record.bytes_read or len(record) for record in records)
+            if size > self.max_bytes:
+                return
+
+        now = self.clock()
+        entry = CacheEntry([copy.copy(record) for record in records],
+                           now, now + ttl, size)
+        self._store(query, entry)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'stale': self.stale,
+            'prefetches': self.prefetch.count if self.prefetch else 0,
+        }
+
+    def _lookup(self, query: Record) -> tuple[CacheEntry | None, float]:
+        key = self.key(query)
+        now = self.clock()
+        due = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, now
+
+            if entry.expires <= now:
+                # Kept around to be served stale until then
+                if entry.expires + self.stale_ttl <= now:
+                    self._remove(key)
+                    self.expirations += 1
+                self.misses += 1
+                return None, now
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if self.prefetch is not None:
+                due = self.prefetch.due(entry, now)
+
+        if due:
+            logger.info(f'Refreshing {key} ahead of expiry')
+            self.prefetch.callback(query)
+        return entry, now
+
+    def _store(self, query: Record, entry: CacheEntry) -> None:
+        key = self.key(query)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            self._evict()
+
+    @staticmethod
+    def _copy(entry: CacheEntry, now: float) -> list[ResourceRecord]:
+        elapsed = int(now - entry.stored)
+        records = []
+        for record in entry.records:
+            cached = copy.copy(record)
+            cached.ttl = max(record.ttl - elapsed, 0)
+            records.append(cached)
+        return records
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key)
+        self.size -= entry.size
+
+    def _evict(self) -> None:
+        while self._entries and (
+            (self.max_entries is not None
+             and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            key, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+            logger.debug(f'Evicted {key} from the cache')
+
+
+class NegativeCache(RecordCache):
+    """
+    Cache of negative answers (RFC 2308), NXDOMAIN and NODATA alike, keyed
+    like :class:`RecordCache`.
+
+    An answer is only cached along with the SOA record of its authority
+    section, for the lower of the SOA TTL and its MINIMUM field, capped at
+    `max_ttl`. The SOA is handed out again with the remaining TTL, so the
+    client can cache the answer for no longer than we do.
+    """
+
+    def __init__(self, max_entries: int | None = 10000,
+                 max_ttl: int = 10800,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param int max_entries: Maximum number of entries, None for no limit
+        :param int max_ttl: Longest a negative answer is cached, in seconds
+        :param clock: Monotonic clock returning seconds
+        """
+        super().__init__(max_entries=max_entries, clock=clock)
+        self.max_ttl = max_ttl
+
+        self.nxdomain = 0
+        self.nodata = 0
+
+    def get(
+        self, query: Record
+    ) -> tuple[int, list[ResourceRecord]] | None:
+        """
+        Cached negative answer to `query`.
+
+        :param Record query: The question
+        :rtype: tuple[int, list[ResourceRecord]] | None
+        :return: The response code and copies of the SOA records, with the
+                 TTLs counted down, or None on a miss
+        """
+        entry, now = self._lookup(query)
+        if entry is None:
+            return None
+        return entry.rcode, self._copy(entry, now)
+
+    def put(self, query: Record, rcode: int,
+            authorities: list[Record]) -> None:
+        """
+        Cache a negative answer to `query`.
+
+        :param Record query: The question
+        :param int rcode: NAME_ERROR for NXDOMAIN, NO_ERROR for NODATA
+        :param authorities: The authority section of the answer, nothing is
+                            cached without an SOA record in it
+        """
+        soa = [
+            record for record in authorities
+            if isinstance(record, ResourceRecord)
+            and record.type == RType.SOA.value
+        ]
+        ttl = self.ttl(soa)
+        if ttl is None or ttl <= 0:
+            return
+
+        ttl = min(ttl, self.max_ttl)
+        records = []
+        for record in soa:
+            cached = copy.copy(record)
+            cached.ttl = ttl
+            records.append(cached)
+
+        now = self.clock()
+        self._store(query, CacheEntry(records, now, now + ttl, 0, rcode))
+        if rcode == 0:
+            self.nodata += 1
+        else:
+            self.nxdomain += 1
+
+    def stats(self) -> dict[str, int]:
+        stats = super().stats()
+        del stats['bytes']
+        stats['nxdomain'] = self.nxdomain
+        stats['nodata'] = self.nodata
+        return stats
+
+    @staticmethod
+    def ttl(soa: list[ResourceRecord]) -> int | None:
+        """
+        Negative caching TTL of an answer, the lower of the TTL and the
+        MINIMUM field of its SOA records (RFC 2308, section 5).
+
+        :param soa: The SOA records of the authority section
+        :rtype: int | None
+        :return: The TTL, or None without an SOA record
+        """
+        ttls = [min(record.ttl, record.rdata.minimum) for record in soa
+                if record.rdata is not None]
+        if len(ttls) < 1:
+            return None
+        return min(ttls)
+
+
+class AnswerEntry:
+    __slots__ = ('data', 'ttls', 'stored', 'expires', 'hits', 'refreshing')
+
+    def __init__(self, data: bytes, ttls: list[tuple[int, int]],
+                 stored: float, expires: float):
+        #: The serialized response
+        self.data = data
+
+        #: Offset and value of every TTL field in `data`
+        self.ttls = ttls
+
+        #: Clock reading when the entry was stored
+        self.stored = stored
+
+        #: Clock reading when the shortest TTL runs out
+        self.expires = expires
+
+        #: Number of times the entry was handed out
+        self.hits = 0
+
+        #: Set once a refresh ahead of expiry was started
+        self.refreshing = False
+
+
+class AnswerCache:
+    """
+    Cache of fully serialized responses, keyed on the query as received
+    minus its ID and RD bit.
+
+    A hit is answered from a copy of the stored bytes, with the ID, the RD
+    bit and the TTLs patched in place, without building a :class:`Message`.
+    """
+
+    _u16 = struct.Struct('>H')
+    _u32 = struct.Struct('>I')
+
+    #: Recursion Desired, copied from the query into the response
+    RD = 0x0100
+
+    #: EDNS pseudo-record, its TTL field holds flags rather than a TTL
+    OPT = 41
+
+    def __init__(self, max_entries: int | None = 10000,
+                 clock: Callable[[], float] = time.monotonic,
+                 prefetch: Prefetch | None = None):
+        """
+        :param int max_entries: Maximum number of entries, None for no limit
+        :param clock: Monotonic clock returning seconds
+        :param Prefetch prefetch: Refreshes popular entries ahead of expiry,
+                                  its callback gets the query as received
+        """
+        self.max_entries = max_entries
+        self.clock = clock
+        self.prefetch = prefetch
+
+        self._entries: OrderedDict[bytes, AnswerEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @classmethod
+    def key(cls, query: bytes) -> bytes:
+        (flags,) = cls._u16.unpack_from(query, 2)
+        return cls._u16.pack(flags & ~cls.RD) + bytes(query[4:])
+
+    def get(self, query: bytes) -> bytes | None:
+        """
+        Cached response to `query`, ready to be sent.
+
+        :param bytes query: The query as received
+        :rtype: bytes | None
+        :return: The response, or None on a miss
+        """
+        if len(query) < 12:
+            return None
+
+        key = self.key(query)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry.expires <= now:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            due = self.prefetch is not None and self.prefetch.due(entry, now)
+
+        if due:
+            self.prefetch.callback(bytes(query))
+
+        data = bytearray(entry.data)
+        data[0:2] = query[0:2]
+        data[2] = (data[2] & ~(self.RD >> 8)) | (query[2] & (self.RD >> 8))
+
+        elapsed = int(now - entry.stored)
+        if elapsed > 0:
+            for offset, ttl in entry.ttls:
+                self._u32.pack_into(data, offset, max(ttl - elapsed, 0))
+        return bytes(data)
+
+    def put(self, query: bytes, response: bytes) -> None:
+        """
+        Cache `response` as the answer to `query`.
+
+        :param bytes query: The query as received
+        :param bytes response: The serialized response, not cached if it
+                               holds no records or a record with a zero TTL
+        """
+        ttls = self.ttls(response)
+        if len(ttls) < 1:
+            return
+
+        ttl = min(ttl for _, ttl in ttls)
+        if ttl <= 0:
+            return
+
+        key = self.key(query)
+        now = self.clock()
+        entry = AnswerEntry(bytes(response), ttls, now, now + ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while (self.max_entries is not None
+                   and len(self._entries) > self.max_entries):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'prefetches': self.prefetch.count if self.prefetch else 0,
+        }
+
+    @classmethod
+    def ttls(cls, data: bytes) -> list[tuple[int, int]]:
+        """
+        Locate the TTL of every resource record in a serialized message.
+
+        :param bytes data: The message
+        :rtype: list[tuple[int, int]]
+        :return: Offset and value of every TTL field
+        """
+        qdcount, ancount, nscount, arcount = struct.unpack_from(
+            '>HHHH', data, 4
+        )
+        i = 12
+        for _ in range(qdcount):
+            i = Encoding.skip_domain_name(data, i) + 4
+
+        ttls = []
+        for _ in range(ancount + nscount + arcount):
+            i = Encoding.skip_domain_name(data, i)
+            if i + 10 > len(data):
+                break
+            (rtype,) = cls._u16.unpack_from(data, i)
+            if rtype != cls.OPT:
+                ttls.append((i + 4, cls._u32.unpack_from(data, i + 4)[0]))
+            (rdlength,) = cls._u16.unpack_from(data, i + 8)
+            i += 10 + rdlength
+        return ttls
@@ -1,6 +1,12 @@
+import atexit
 import enum
 import inspect
+import itertools
 import logging
+import logging.handlers
+import os
+import queue
+import sys
 from typing import NewType
 
 DomainName = NewType('DomainName', str)
@@ -9,23 +15,78 @@ _Address = tuple[str, int] | str
 
 
 def debug(message: str = '', *args: tuple, **kwarg: dict) -> None:
-    info = caller_info()
-    logger = logging.getLogger('.'.join([info[0], info[1]]))
-    offset = kwarg['offset'] if 'offset' in kwarg else 0
+    """
+    Log `args` and `kwarg` at DEBUG level to the logger of the calling
+    module. Prefer a :class:`Tracer`, which identifies its call site without
+    looking the caller up.
+    """
+    module = sys._getframe(1).f_globals.get('__name__', '')
+    logger = logging.getLogger(module)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s', _Trace('', message, args, kwarg))
 
-    last_message = ''
 
-    if len(args) > 0:
-        x = 0
-        for value in args:
-            name = f'arg{x}'
-            res = format_debug_message(value=value, name=name, offset=offset)
+class Tracer:
+    """
+    A debug trace point, created once per call site:
+
+        _trace = Tracer(logger, 'Message.from_bytes')
+        ...
+        if _trace.enabled:
+            _trace(data=data)
+
+    Nothing is inspected or formatted unless DEBUG is enabled on `logger`,
+    and even then the message, hex dumps included, is only formatted if a
+    handler emits it.
+    """
+
+    __slots__ = ('logger', 'site')
+
+    def __init__(self, logger: logging.Logger, site: str):
+        """
+        :param logging.Logger logger: Logger the trace goes to
+        :param str site: Name of the call site, prefixed to every message
+        """
+        self.logger = logger
+        self.site = site
+
+    @property
+    def enabled(self) -> bool:
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, message: str = '', *args, **kwargs) -> None:
+        """
+        Same arguments as :func:`debug`. Checks the level again, so a call
+        site may skip :attr:`enabled` when the arguments are cheap.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('%s', _Trace(self.site, message, args, kwargs))
+
+
+class _Trace:
+    """A trace message, formatted when the logging record is"""
+
+    __slots__ = ('site', 'message', 'args', 'kwargs')
+
+    def __init__(self, site: str, message: str, args: tuple, kwargs: dict):
+        self.site = site
+        self.message = message
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        offset = self.kwargs.get('offset', 0)
+        message = f'{self.site}: {self.message}' if self.site else \
+            self.message
+        last_message = ''
+
+        for x, value in enumerate(self.args):
+            res = format_debug_message(value=value, name=f'arg{x}',
+                                       offset=offset)
             message += res[0]
             last_message += res[1]
-            x += 1
 
-    if len(kwarg) > 0:
-        for name, value in kwarg.items():
+        for name, value in self.kwargs.items():
             if name == 'offset':
                 continue
 
@@ -33,7 +94,7 @@ def debug(message: str = '', *args: tuple, **kwarg: dict) -> None:
             message += res[0]
             last_message += res[1]
 
-    logger.debug(message + last_message + '\n')
+        return message + last_message + '\n'
 
 
 def format_debug_message(
@@ -45,7 +106,7 @@ def format_debug_message(
     last_message = ''
     tname = type(value)
 
-    if isinstance(value, bytes):
+    if isinstance(value, (bytes, bytearray, memoryview)):
         data_length = len(value) - offset
         p = stringify_bytes(value, offset)
         o = ''
@@ -119,13 +180,14 @@ def caller_info(skip=2):
 
 
 def stringify_bytes(value: bytes, offset: int = 0) -> str:
-    p = ''
-    data_length = len(value)
-    for z in range(offset, data_length):
-        if (z % 16) == 0 or z == offset:
-            p += '\n'
-        p += '\\x{:0>2x}'.format(value[z])
-    return p
+    lines = []
+    start = offset
+    while start < len(value):
+        # Lines break on every 16th byte of the message
+        end = min((start // 16 + 1) * 16, len(value))
+        lines.append(''.join(f'\\x{byte:0>2x}' for byte in value[start:end]))
+        start = end
+    return ''.join('\n' + line for line in lines)
 
 
 def get_random_ip() -> int:
@@ -147,12 +209,141 @@ def get_random_ttl() -> int:
     return random.choice(ttl_values)
 
 
-def setUpRootLogger(level: int = 0) -> logging.Logger:
+#: Parent of the loggers per-packet messages go to, see :func:`packet_logger`
+PACKET_LOGGER = 'packet'
+
+
+def packet_logger(name: str) -> logging.Logger:
+    """
+    Logger for the messages logged for every packet by module `name`,
+    sampled apart from the module's other messages. They are logged at
+    DEBUG, so cost a level check unless enabled.
+
+    :param str name: Name of the module
+    :rtype: logging.Logger
+    """
+    return logging.getLogger(f'{PACKET_LOGGER}.{name}')
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets one in every N records below WARNING through, counted per logger.
+    N is the rate of the logger or of its closest ancestor with one, 1 when
+    none has, and a rate below 1 drops every such record.
+    """
+
+    def __init__(self, rates: dict[str, int] | None = None):
+        """
+        :param dict rates: Sampling rate by logger name
+        """
+        super().__init__()
+        self.rates = dict(rates or {})
+
+        #: Records dropped so far
+        self.dropped = 0
+
+        self._counters: dict[str, itertools.count] = {}
+        self._resolved: dict[str, int] = {}
+
+    def rate(self, name: str) -> int:
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate = 1
+            parent = name
+            while parent:
+                if parent in self.rates:
+                    rate = self.rates[parent]
+                    break
+                parent = parent.rpartition('.')[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        rate = self.rate(record.name)
+        if rate == 1:
+            return True
+
+        if rate > 1:
+            counter = self._counters.get(record.name)
+            if counter is None:
+                counter = self._counters.setdefault(record.name,
+                                                    itertools.count())
+            if next(counter) % rate == 0:
+                return True
+
+        self.dropped += 1
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Only the arguments are merged here, so they can't change while
+        # the record waits in the queue. Timestamps, layout and tracebacks
+        # are formatted by the listener thread.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class LogPipeline:
+    """
+    Moves formatting and writing log records off the threads logging them:
+    records are put on a queue by a handler on the root logger, and handed
+    to the real handlers by a :class:`logging.handlers.QueueListener`
+    thread.
+
+    A forked child gets a pipeline of its own, the listener thread of the
+    parent doesn't exist in it.
+    """
+
+    def __init__(self, *handlers: logging.Handler,
+                 rates: dict[str, int] | None = None):
+        """
+        :param handlers: Handlers the records are written with
+        :param dict rates: Sampling rates by logger name, see
+                           :class:`SamplingFilter`
+        """
+        self.handlers = handlers
+        self.sampling = SamplingFilter(rates)
+        self.handler = _QueueHandler(queue.SimpleQueue())
+        self.handler.addFilter(self.sampling)
+        self.listener: logging.handlers.QueueListener | None = None
+
+    def start(self) -> None:
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, *self.handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    def stop(self) -> None:
+        """
+        Write the records still queued and stop the listener thread.
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def _restart(self) -> None:
+        self.handler.queue = queue.SimpleQueue()
+        self.start()
+
+
+def setUpRootLogger(level: int = 0,
+                    rates: dict[str, int] | None = None) -> logging.Logger:
+    """
+    Log to stdout through a :class:`LogPipeline`, unless the root logger
+    has handlers already.
+
+    :param int level: Level of the root logger, DEBUG when not a level
+    :param dict rates: Sampling rates by logger name, see
+                       :class:`SamplingFilter`
+    """
     root = logging.getLogger()
 
     if not root.hasHandlers():
-        import sys
-
         if level not in [logging.CRITICAL, logging.ERROR, logging.WARNING,
                          logging.INFO, logging.DEBUG,]:
             level = logging.DEBUG
@@ -165,7 +356,12 @@ def setUpRootLogger(level: int = 0) -> logging.Logger:
             '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         )
         handler.setFormatter(formatter)
-        root.addHandler(handler)
+
+        pipeline = LogPipeline(handler, rates=rates)
+        pipeline.start()
+        atexit.register(pipeline.stop)
+        os.register_at_fork(after_in_child=pipeline._restart)
+        root.addHandler(pipeline.handler)
     return root
 
 
@@ -179,17 +375,12 @@ def exist_in_enum(value, enum_class: enum.Enum):
 class EnumExtension(enum.Enum):
     @classmethod
     def value_exists(cls, value) -> bool:
-        values = set(item.value for item in cls)
-        if value in values:
-            return True
-        return False
+        # The enum keeps a map of its values, no need to collect them
+        return value in cls._value2member_map_
 
     @classmethod
     def name_exists(cls, name) -> bool:
-        names = set(item.name for item in cls)
-        if name in names:
-            return True
-        return False
+        return name in cls.__members__
 
     @classmethod
     def safe_get_value_by_value(cls, key, default=None):
@@ -1,6 +1,7 @@
 import logging
 import struct
 from app.dns.exceptions import FormatError
+from app.dns.writer import Writer
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
@@ -8,25 +9,36 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+_POINTER = struct.Struct('!H')
+_IPV4 = struct.Struct('!BBBB')
+
 
 class Encoding:
+    #: Most compression pointers followed while decoding a single name,
+    #: which bounds the work spent on a pointer loop
+    max_pointers: int = 16
+
+    #: Longest domain name in octets (RFC 1035, section 3.1)
+    max_name_length: int = 255
 
     """Encoding Part"""
     @staticmethod
-    def encode_domain_name(parts: list[str]) -> bytes:
-        res = b''
-        for part in parts:
-            ascii_part = part.encode('ascii')
-            part_length = len(ascii_part)
-            if part_length >= 63:
-                raise FormatError(
-                    'Part \'{}\' of \'{}\' exceeds limit of 63 chars'
-                    .format(part, '.'.join(parts))
-                )
-            res += len(ascii_part).to_bytes(1, 'big') + ascii_part
-
-        res = res + b'\x00'
-        return res
+    def encode_domain_name(parts: list[str], offset: int = 0,
+                           names: dict[str, int] | None = None) -> bytes:
+        """
+        Encode the labels of a domain name, compressed (RFC 1035, section
+        4.1.4) when `names` is given.
+
+        :param list[str] parts: The labels
+        :param int offset: Offset in the message the name is written at
+        :param dict names: Offset of every name already written to the
+                           message, the longest known suffix is replaced by
+                           a pointer and the other suffixes are added
+        :rtype: bytes
+        """
+        writer = Writer(names=names, base=offset)
+        writer.name('.'.join(parts))
+        return writer.getvalue()
 
     @staticmethod
     def encode_character_string(value: 'CharacterString') -> bytes:
@@ -39,10 +51,7 @@ class Encoding:
 
     @staticmethod
     def encode_ip(parts: list[int]) -> bytes:
-        res = b''
-        for part in parts:
-            res += int(part).to_bytes(1, 'big')
-        return res
+        return bytes(int(part) for part in parts)
 
     @staticmethod
     def encode(value: str) -> bytes:
@@ -58,52 +67,127 @@ class Encoding:
 
     """Decoding Part"""
     @staticmethod
-    def decode_domain_name(data: bytes,
-                           offset: int = 0) -> tuple['DomainName', int]:
+    def decode_domain_name(
+        data: bytes | memoryview, offset: int = 0,
+        names: dict[int, 'DomainName'] | None = None
+    ) -> tuple['DomainName', int]:
         """
-        Read from `data` until first NUL-byte is reached
+        Read from `data` until first NUL-byte is reached, following
+        compression pointers.
 
-        :param bytes data: Data to decode
+        :param data: Data to decode, read in place when a memoryview
+        :type data: bytes, memoryview
         :param int offset: Offset to start decoding from
+        :param dict names: Names already decoded from `data` by offset, used
+                           instead of decoding a suffix again and filled
+                           with every suffix decoded
         :rtype: tuple[str, int]
         :return: A 2-tuple, first is decoded data, second is bytes read
+        :raises FormatError: If the name runs past the end of `data`, is
+                             longer than 255 octets or follows more than
+                             `max_pointers` pointers
         """
         i = offset
+        end = None
         parts = []
+        starts = []
+        size = 1
+        pointers = 0
         while True:
-            length = int.from_bytes(data[i:i+1], 'big')
+            if names is not None and i in names:
+                suffix = names[i]
+                if suffix:
+                    parts.append(suffix)
+                    size += len(suffix) + 1
+                if size > Encoding.max_name_length:
+                    raise FormatError(
+                        f'Domain name at {offset} exceeds '
+                        f'{Encoding.max_name_length} octets'
+                    )
+                if end is None:
+                    end = Encoding.skip_domain_name(data, i)
+                break
+
+            if i >= len(data):
+                raise FormatError('Domain name exceeds the message')
 
-            if data[i] == 0x00:
+            length = data[i]
+
+            if length == 0x00:
                 i += 1
                 break
             # Check if the first two bits are set
             elif (length & 0xc0 == 0xc0):
-                pointer = struct.unpack("!H", data[i:i+2])[0]
-                pointer &= 0x3fff  # Clear the first two bits
-                i += 2
-                name = Encoding.decode_domain_name(data, pointer)[0]
-                parts.append(name)
-                break
+                if i + 2 > len(data):
+                    raise FormatError('Domain name exceeds the message')
+
+                pointers += 1
+                if pointers > Encoding.max_pointers:
+                    raise FormatError(
+                        f'Domain name at {offset} follows more than '
+                        f'{Encoding.max_pointers} compression pointers'
+                    )
+
+                if end is None:
+                    end = i + 2
+                pointer = _POINTER.unpack_from(data, i)[0]
+                i = pointer & 0x3fff  # Clear the first two bits
             else:
+                start = i
                 i += 1
                 if (i + length) > len(data):
-                    break
+                    raise FormatError('Domain name exceeds the message')
+
+                size += length + 1
+                if size > Encoding.max_name_length:
+                    raise FormatError(
+                        f'Domain name at {offset} exceeds '
+                        f'{Encoding.max_name_length} octets'
+                    )
 
-                payload = data[i:i + length]
                 try:
-                    name = payload.decode('utf-8')
+                    name = str(data[i:i + length], 'utf-8')
+                    starts.append((start, len(parts)))
                     parts.append(name)
                 except UnicodeDecodeError:
                     pass
                 i += length
 
+        if end is None:
+            end = i
+
+        if names is not None:
+            for start, index in starts:
+                names[start] = '.'.join(parts[index:])
+
         name = '.'.join(parts)
 
-        return (name, i)
+        return (name, end)
+
+    @staticmethod
+    def skip_domain_name(data: bytes, offset: int = 0) -> int:
+        """
+        Find the end of the domain name starting at `offset`, without
+        decoding it or following compression pointers.
+
+        :param bytes data: Data holding the name
+        :param int offset: Offset the name starts at
+        :rtype: int
+        :return: Offset of the first byte after the name
+        """
+        i = offset
+        while i < len(data):
+            length = data[i]
+            if length & 0xc0 == 0xc0:
+                return i + 2
+            i += 1 + length
+            if length == 0:
+                break
+        return i
 
     @staticmethod
     def decode_character_string(
-        data: bytes, offset: int = 0
+        data: bytes | memoryview, offset: int = 0
     ) -> tuple['CharacterString', int]:
         """
         Read length-octet from first byte, then read length-bytes from `data`
@@ -113,13 +197,14 @@ class Encoding:
         :rtype: tuple[str, int]
         :return: A 2-tuple, first is decoded data, second is bytes read
         """
-        length = int.from_bytes(data[offset:1], 'big')
-        res = data[offset+1:length].decode('utf-8')
+        length = data[offset]
+        res = str(data[offset+1:offset+1+length], 'utf-8')
 
         return (res, length + 1)
 
     @staticmethod
-    def decode_ip(data: bytes, offset: int = 0) -> tuple[str, int]:
+    def decode_ip(data: bytes | memoryview,
+                  offset: int = 0) -> tuple[str, int]:
         """
         Read length-octet from first byte, then read length-bytes from `data`
 
@@ -128,12 +213,7 @@ class Encoding:
         :rtype: tuple[str, int]
         :return: A 2-tuple, first is decoded data, second is bytes read
         """
-        res = '{}.{}.{}.{}'.format(
-            int.from_bytes(data[offset+0:offset+1], 'big'),
-            int.from_bytes(data[offset+1:offset+2], 'big'),
-            int.from_bytes(data[offset+2:offset+3], 'big'),
-            int.from_bytes(data[offset+3:offset+4], 'big'),
-        )
+        res = '{}.{}.{}.{}'.format(*_IPV4.unpack_from(data, offset))
 
         return (res, 4)
 
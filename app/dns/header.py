@@ -2,10 +2,18 @@ import struct
 import logging
 import copy
 from dataclasses import dataclass, field
-from app.dns.common import OpCode, ResponseCode, debug
+from app.dns.common import OpCode, ResponseCode, Tracer
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.dns.writer import Writer
 
 logger = logging.getLogger(__name__)
 
+_trace_flags = Tracer(logger, 'HeaderFlags.from_bytes')
+
+_HEADER = struct.Struct('>HHHHHH')
+
 
 class HeaderFlags:
     #: A one bit field that specifies whether this message is a query (0), or a
@@ -40,16 +48,22 @@ class HeaderFlags:
     #: Response code - this 4 bit field is set as part of responses.
     rcode: int
 
+    __slots__ = ('qr', 'opcode', 'aa', 'tc', 'rd', 'ra', 'z', 'rcode')
+
     def __init__(self, qr: int = 0, opcode: int = 0, aa: int = 0, tc: int = 0,
                  rd: int = 0, ra: int = 0, z: int = 0, rcode: int = 0):
-        self.qr: int = qr
-        self.opcode: int = opcode
-        self.aa: int = aa
-        self.tc: int = tc
-        self.rd: int = rd
-        self.ra: int = ra
-        self.z: int = z
-        self.rcode: int = rcode
+        self.qr = qr
+        self.opcode = opcode
+        self.aa = aa
+        self.tc = tc
+        self.rd = rd
+        self.ra = ra
+        self.z = z
+        self.rcode = rcode
+
+    def __copy__(self) -> 'HeaderFlags':
+        return self.__class__(self.qr, self.opcode, self.aa, self.tc, self.rd,
+                              self.ra, self.z, self.rcode)
 
     def __index__(self) -> int:
         return (
@@ -97,27 +111,27 @@ class HeaderFlags:
 
     @classmethod
     def from_bytes(cls, data: bytes) -> "HeaderFlags":
-        flag_parameters = {
-            'qr': (data & 0x8000) >> 15,
-            'opcode': (data & 0x7800) >> 11,
-            'aa': (data & 0x0400) >> 10,
-            'tc': (data & 0x0200) >> 9,
-            'rd': (data & 0x0100) >> 8,
-            'ra': (data & 0x0080) >> 7,
-            'z': (data & 0x0070) >> 4,
-            'rcode': (data & 0x000f) >> 0,
-        }
+        qr = (data & 0x8000) >> 15
+        opcode = (data & 0x7800) >> 11
+        aa = (data & 0x0400) >> 10
+        tc = (data & 0x0200) >> 9
+        rd = (data & 0x0100) >> 8
+        ra = (data & 0x0080) >> 7
+        z = (data & 0x0070) >> 4
+        rcode = data & 0x000f
 
-        debug(**flag_parameters, data=data, offset=0)
+        if _trace_flags.enabled:
+            _trace_flags(qr=qr, opcode=opcode, aa=aa, tc=tc, rd=rd, ra=ra,
+                         z=z, rcode=rcode, data=data, offset=0)
 
-        return cls(**flag_parameters)
+        return cls(qr, opcode, aa, tc, rd, ra, z, rcode)
 
     @classmethod
     def empty(cls) -> "HeaderFlags":
-        return cls(qr=0, opcode=0, aa=0, tc=0, rd=0, ra=0, z=0, rcode=0,)
+        return cls()
 
 
-@dataclass
+@dataclass(slots=True)
 class Header:
     #: A 16 bit identifier assigned by the program that generates any kind of
     #: query. This identifier is copied the corresponding reply and can be used
@@ -144,23 +158,14 @@ class Header:
     arcount: int = 0
 
     def __bytes__(self) -> bytes:
-        return struct.pack(
-            '>HHHHHH',
+        return _HEADER.pack(
             self.id, self.flags, self.qdcount, self.ancount,
             self.nscount, self.arcount,
         )
 
     def __copy__(self) -> 'Header':
-        cls = self.__class__
-        result = cls.__new__(cls)
-        result.id = self.id
-        result.flags = copy.copy(self.flags)
-        result.qdcount = self.qdcount
-        result.ancount = self.ancount
-        result.nscount = self.nscount
-        result.arcount = self.arcount
-
-        return result
+        return self.__class__(self.id, copy.copy(self.flags), self.qdcount,
+                              self.ancount, self.nscount, self.arcount)
 
     def __repr__(self) -> str:
         str_head = ';; ->>HEADER<<- opcode: {}, status: {}, id: {}\n'\
@@ -181,20 +186,31 @@ class Header:
     def serialize(self) -> bytes:
         return bytes(self)
 
+    def write(self, writer: 'Writer', position: int | None = None) -> None:
+        """
+        :param Writer writer: Writer to append the header to
+        :param int position: Back-patch the header reserved there instead
+        """
+        values = (self.id, self.flags, self.qdcount, self.ancount,
+                  self.nscount, self.arcount)
+        if position is None:
+            writer.pack(_HEADER, *values)
+        else:
+            writer.pack_at(_HEADER, position, *values)
+
     def validate(self) -> ResponseCode:
         return self.flags.validate()
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> "Header":
+    def from_bytes(cls, data: bytes | memoryview) -> "Header":
         #: big endian
 
         (
             id, flagbyte, qdcount, ancount, nscount, arcount
-        ) = struct.unpack('>HHHHHH', data[:12])
+        ) = _HEADER.unpack_from(data)
         flags = HeaderFlags.from_bytes(flagbyte)
 
-        return cls(id=id, flags=flags, qdcount=qdcount, ancount=ancount,
-                   nscount=nscount, arcount=arcount)
+        return cls(id, flags, qdcount, ancount, nscount, arcount)
 
     @classmethod
     def empty(cls) -> "Header":
@@ -202,11 +218,4 @@ class Header:
         _id = random.randint(0x0000, 0xFFFF)
 
         logger.info('Creating empty Header with ID: {_id}')
-        return cls(
-            id=_id,
-            flags=HeaderFlags.empty(),
-            qdcount=0,
-            ancount=0,
-            nscount=0,
-            arcount=0,
-        )
+        return cls(_id, HeaderFlags.empty())
@@ -1,15 +1,38 @@
 import copy
 import logging
-import socket
+import struct
+import time
 from dataclasses import dataclass, field
-from app.dns.common import debug, ResponseCode, _Address
-from app.dns.exceptions import NotImplementedError
+from app.dns.common import ResponseCode, RType, Tracer, _Address, \
+    packet_logger
+from app.dns.exceptions import DNSError, DNSServerFailure, FormatError, \
+    NotImplementedError
 from app.dns.header import Header
 from app.dns.record import ResourceRecord, Query, Record, BaseRecord
+from app.dns.upstream import Pending, UpstreamClient
+from app.dns.writer import Writer
+from app.dns import validation
+from typing import NamedTuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.dns.cache import NegativeCache, RecordCache
+    from app.dns.metrics import Timings
 
 SectionResponse = dict[str, list[Record]]
 
+
+class Resolution(NamedTuple):
+    """Outcome of forwarding a single question"""
+
+    rcode: int
+    answers: list[Record]
+    authorities: list[Record]
+
+
 logger = logging.getLogger(__name__)
+packets = packet_logger(__name__)
+
+_trace_decode = Tracer(logger, 'Message.from_bytes')
 
 
 @dataclass
@@ -28,6 +51,9 @@ class Message:
         'additional': 'arcount',
     }
 
+    #: Sections a lazily decoded message defers, in wire order
+    lazy_sections = ('answers', 'authorities', 'additional')
+
     def __copy__(self) -> 'Message':
         cls = self.__class__
         result = cls.__new__(cls)
@@ -47,6 +73,24 @@ class Message:
         return result
 
     def __bytes__(self) -> bytes:
+        return self.serialize()
+
+    def serialize(self, compress: bool = False) -> bytes:
+        """
+        :param bool compress: Compress the domain names (RFC 1035, section
+                              4.1.4), across all sections and within the
+                              RDATA types that allow it
+        :rtype: bytes
+        """
+        writer = Writer(names={} if compress else None)
+        self.write(writer)
+        return writer.getvalue()
+
+    def write(self, writer: Writer) -> None:
+        """
+        Append the message to `writer`. The header is written last, over the
+        space reserved for it, once the sections are written and counted.
+        """
         if not isinstance(self.header, Header):
             logger.error('Missing Header object')
             raise AttributeError(
@@ -63,136 +107,412 @@ class Message:
                 obj=self
             )
 
+        start = writer.skip(12)
+
         for key, count in Message.sections.items():
-            section = getattr(self, key)
+            section: list[Record] = getattr(self, key)
             section_size = len(section)
             if section_size < 1:
-                logger.info(f'Section {key} has no value')
+                packets.debug('Section %s has no value', key)
                 continue
 
-            logger.info(
-                f'Assigning size of {key} ({section_size}) to Header.{count}'
-            )
-            setattr(self.header, count, section_size)
-
-        res = bytes(self.header)
-
-        for key in Message.sections:
-            section: list[Record] = getattr(self, key)
-            logger.info(f'Serializing section: {key}')
+            packets.debug('Serializing section: %s', key)
             for q in section:
                 try:
-                    res += bytes(q)
+                    q.write(writer)
                 except Exception as e:
                     logger.exception(e)
                     raise e
-        return res
 
-    def serialize(self) -> bytes:
-        return bytes(self)
+            packets.debug('Assigning size of %s (%d) to Header.%s', key,
+                          section_size, count)
+            setattr(self.header, count, section_size)
+
+        self.header.write(writer, start)
 
     def validate(self) -> ResponseCode:
-        header_res = self.header.validate()
+        """
+        Validate the header, then every record in section order.
 
-        if header_res != ResponseCode.NO_ERROR:
-            return header_res
-
-        for key in Message.sections:
-            section: list[Record] = getattr(self, key)
-            if len(section) > 0:
-                for q in section:
-                    q_res = q.validate()
-                    if q_res != ResponseCode.NO_ERROR:
-                        return q_res
-        return ResponseCode.NO_ERROR
+        :rtype: ResponseCode
+        :return: The first failure found, or NO_ERROR
+        """
+        return validation.validate(self)
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> "Message":
-        debug(data=data)
-        header = Header.from_bytes(data[:12])
-
+    def from_bytes(cls, data: bytes, lazy: bool = False) -> "Message":
+        """
+        :param bytes data: The message
+        :param bool lazy: Only decode the header and the questions. The
+                          other sections are decoded the first time one of
+                          them is accessed, and only as far as that section.
+        :rtype: Message
+        """
+        if _trace_decode.enabled:
+            _trace_decode(data=data)
+        # Every section is decoded in place, nothing is copied out of the
+        # message before a name or value is built from it
+        view = memoryview(data)
+        header = Header.from_bytes(view)
+
+        # Every name decoded so far by offset, a compressed name is only
+        # decoded once per message
+        names: dict[int, str] = {}
+
+        keys = ('queries',) if lazy else tuple(Message.sections)
+        container: SectionResponse = {}
+        position = 12
         try:
-            container = cls._build_sections(data, header, 12)
+            for key in keys:
+                container[key], position = cls._build_section(
+                    view, header, key, position, names
+                )
         except AttributeError as e:
             logger.exception(e)
             raise e
+        except struct.error as e:
+            raise FormatError(f'Record exceeds the message: {e}') from e
+
+        message = cls(header=header, data=data, **container)
+        if lazy:
+            for key in Message.lazy_sections:
+                delattr(message, key)
+            message._lazy = (view, position, names, 0)
+        return message
 
-        return cls(header=header, data=data, **container)
+    def __getattr__(self, name: str) -> list[Record]:
+        # Only reached for the sections of a lazily decoded message that
+        # haven't been accessed yet
+        if name not in Message.lazy_sections or '_lazy' not in self.__dict__:
+            raise AttributeError(
+                f'\'{type(self).__name__}\' object has no attribute '
+                f'\'{name}\'',
+                name=name,
+                obj=self
+            )
 
-    def create_response(self, resolver: _Address | None = None) -> 'Message':
+        self._decode(name)
+        return self.__dict__[name]
+
+    def _decode(self, name: str) -> None:
+        """
+        Decode the pending sections up to and including `name`. Sections are
+        laid out back to back, the ones before `name` are decoded to find
+        where it starts, and kept unless replaced meanwhile.
+        """
+        view, position, names, index = self._lazy
+        while index < len(Message.lazy_sections):
+            key = Message.lazy_sections[index]
+            try:
+                records, position = self._build_section(
+                    view, self.header, key, position, names
+                )
+            except struct.error as e:
+                raise FormatError(f'Record exceeds the message: {e}') from e
+            index += 1
+
+            if key not in self.__dict__:
+                setattr(self, key, records)
+            if key == name:
+                break
+
+        if index < len(Message.lazy_sections):
+            self._lazy = (view, position, names, index)
+        else:
+            del self._lazy
+
+    def create_response(
+        self, resolver: _Address | UpstreamClient | None = None,
+        cache: 'RecordCache | None' = None,
+        negative_cache: 'NegativeCache | None' = None,
+        refresh: bool = False, timings: 'Timings | None' = None
+    ) -> 'Message':
+        """
+        Build the response to this query.
+
+        :param resolver: Upstream resolver to forward the questions to, as
+                         an address or a client. Without one, every question
+                         is answered from :meth:`ResourceRecord.lookup`.
+        :param RecordCache cache: Answers forwarded questions from the cache
+                                  when possible, and caches the upstream
+                                  answers otherwise
+        :param NegativeCache negative_cache: Same as `cache`, for the
+                                             NXDOMAIN and NODATA answers
+        :param bool refresh: Ask the resolver without consulting the caches,
+                             the answers are still cached. Nothing is
+                             answered stale.
+        :param Timings timings: Gets the time spent validating, resolving
+                                and waiting for the resolver
+        :rtype: Message
+        """
         if self.header.flags.qr == 1:
             logger.error('Can\'t create a response on a response')
             return self
 
-        message = copy.copy(self)
-
+        start = time.perf_counter()
         res = self.validate()
+        if timings is not None:
+            now = time.perf_counter()
+            timings.validate = now - start
+            start = now
+
+        message = copy.copy(self)
         if res != ResponseCode.NO_ERROR:
             message.header.flags.qr = 1
             message.header.flags.rcode = res.value
             return message
 
-        for query in message.queries:
-            if resolver is None:
-                logger.info(f'Creating response for {query.name}')
+        if resolver is not None and not isinstance(resolver, UpstreamClient):
+            resolver = UpstreamClient.shared(resolver)
+
+        if resolver is None:
+            for query in message.queries:
+                packets.debug('Creating response for %s', query.name)
                 record = ResourceRecord.lookup(query=query)
                 message.answers.append(record)
-            else:
-                logger.info(f'Looking up {query.name}')
-                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sock.sendto(self.data, resolver)
-                _buf, _ = sock.recvfrom(512)
-                sock.close()
-
-                if len(self.data) < len(_buf):
-                    resolved = Message.from_bytes(data=_buf)
-                    if len(resolved.answers) > 0:
-                        for record in resolved.answers:
-                            message.answers.append(record)
-                else:
-                    record = ResourceRecord.lookup(query=query)
-                    message.answers.append(record)
+        else:
+            results = self._forward(resolver, cache, negative_cache,
+                                    refresh, timings)
+            for result in results:
+                message.answers.extend(result.answers)
+                message.authorities.extend(result.authorities)
+            message.header.nscount = len(message.authorities)
+
+            message.header.flags.rcode = self._merge_rcodes(results)
 
         message.header.flags.qr = 1
         message.header.ancount = len(message.answers)
+        if timings is not None:
+            timings.resolve = time.perf_counter() - start
         return message
 
     @staticmethod
-    def _build_sections(data: bytes, header: Header,
-                        position: int = 12) -> SectionResponse:
+    def _merge_rcodes(results: list[Resolution]) -> int:
+        """
+        The response code of the answers to every question: the first
+        error an upstream replied with, such as SERVFAIL or REFUSED, else
+        NXDOMAIN when no question has a name, else NOERROR.
+        """
+        negative = (ResponseCode.NO_ERROR.value, ResponseCode.NAME_ERROR.value)
+        for result in results:
+            if result.rcode not in negative:
+                return result.rcode
+
+        if all(r.rcode == ResponseCode.NAME_ERROR.value for r in results):
+            return ResponseCode.NAME_ERROR.value
+        return ResponseCode.NO_ERROR.value
+
+    def _forward(
+        self, resolver: UpstreamClient, cache: 'RecordCache | None' = None,
+        negative_cache: 'NegativeCache | None' = None, refresh: bool = False,
+        timings: 'Timings | None' = None
+    ) -> list[Resolution]:
+        """
+        Resolve every question that isn't cached upstream at once, one
+        question per upstream query, and wait for the replies with a shared
+        deadline.
+
+        :param UpstreamClient resolver: The upstream client
+        :param RecordCache cache: Cache to consult first and fill afterwards
+        :param NegativeCache negative_cache: Same as `cache`, for negative
+                                             answers
+        :param bool refresh: Skip the cache lookups, and fail rather than
+                             answer stale
+        :param Timings timings: Gets the round trip time to the resolver
+        :rtype: list[Resolution]
+        :return: The outcome of every question, in question order
+        :raises DNSServerFailure: If any question is left unanswered and no
+                                  stale answer is cached for it
+        """
+        results: list[Resolution | None] = [None] * len(self.queries)
+        if not refresh:
+            for i, query in enumerate(self.queries):
+                results[i] = self._cached(query, cache, negative_cache)
+
+        misses = [i for i, result in enumerate(results) if result is None]
+        if len(misses) < 1:
+            return results
+
+        if len(self.queries) == 1:
+            requests = [self.data]
+        else:
+            requests = [self._split(self.queries[i]) for i in misses]
+
+        pending: list[Pending | None] = []
+        start = time.perf_counter()
+        try:
+            for i, data in zip(misses, requests):
+                packets.debug('Looking up %s', self.queries[i].name)
+                try:
+                    pending.append(resolver.submit(data))
+                except DNSServerFailure as e:
+                    logger.warning(e)
+                    pending.append(None)
+
+            resolver.wait([p for p in pending if p is not None])
+        finally:
+            for p in pending:
+                if p is not None and not p.done:
+                    resolver.cancel(p)
+            if timings is not None:
+                timings.upstream = time.perf_counter() - start
+
+        for i, data, p in zip(misses, requests, pending):
+            query = self.queries[i]
+            if p is None or p.response is None:
+                # A failed refresh leaves the cached answer to expire
+                results[i] = None if refresh else self._stale(query, cache)
+                if results[i] is None:
+                    raise DNSServerFailure(
+                        f'Upstream did not answer {query.name} in time'
+                    )
+                continue
 
-        container: SectionResponse = {}
-        for key, count in Message.sections.items():
-            if key not in container:
-                container[key] = []
+            results[i] = self._resolved(query, data, p.response, cache,
+                                        negative_cache, refresh)
 
-            ranger = getattr(header, count)
+        return results
 
-            logger.info(f'Header.{key} reports {ranger} record(s)')
+    @staticmethod
+    def _cached(
+        query: Record, cache: 'RecordCache | None',
+        negative_cache: 'NegativeCache | None'
+    ) -> Resolution | None:
+        if cache is not None:
+            answers = cache.get(query)
+            if answers is not None:
+                return Resolution(ResponseCode.NO_ERROR.value, answers, [])
+
+        if negative_cache is not None:
+            negative = negative_cache.get(query)
+            if negative is not None:
+                rcode, authorities = negative
+                return Resolution(rcode, [], authorities)
+
+        return None
 
-            if key == 'queries' and ranger < 1:
-                raise AttributeError(
-                    f'Attribute ({count}) requires a positive value',
-                    name=count,
-                    object=header,
-                )
+    @staticmethod
+    def _stale(query: Record,
+               cache: 'RecordCache | None') -> Resolution | None:
+        """
+        Answer `query` from an expired cache entry (RFC 8767), as the
+        upstream failed to.
+        """
+        answers = cache.get_stale(query) if cache is not None else None
+        if answers is None:
+            return None
+
+        logger.warning(f'Serving stale answer for {query.name}')
+        return Resolution(ResponseCode.NO_ERROR.value, answers, [])
 
-            if ranger > 0:
-                logger.info(f'Building {ranger} record(s) for Header.{key}...')
-                for _ in range(ranger):
-                    try:
-                        if key == 'queries':
-                            record, position = Query.from_bytes(data,
-                                                                position)
-                        else:
-                            record, position = BaseRecord.factory(data,
-                                                                  position)
-
-                        container[key].append(record)
-                        # position += record.bytes_read
-                    except NotImplementedError as e:
-                        setattr(header, count, ranger - 1)
-                        logger.warning(e)
-                        continue
-
-        return container
+    @staticmethod
+    def _resolved(
+        query: Record, data: bytes, reply: bytes,
+        cache: 'RecordCache | None', negative_cache: 'NegativeCache | None',
+        refresh: bool = False
+    ) -> Resolution:
+        """
+        Turn the upstream `reply` to `data` into the answer to `query`, and
+        cache it.
+
+        :param bool refresh: Never fall back to a stale answer
+        :raises DNSServerFailure: If `reply` is malformed and no stale
+                                  answer is cached for `query`
+        """
+        rcode = Header.from_bytes(reply[:12]).flags.rcode
+        if rcode == ResponseCode.SERVER_FAILURE.value and not refresh:
+            stale = Message._stale(query, cache)
+            if stale is not None:
+                return stale
+
+        if len(data) >= len(reply) and rcode == ResponseCode.NO_ERROR.value:
+            # Nothing was added to the query, answer it ourselves
+            return Resolution(rcode, [ResourceRecord.lookup(query=query)], [])
+
+        # Only as many sections as needed are decoded, the additional section
+        # never is
+        negative = (ResponseCode.NO_ERROR.value, ResponseCode.NAME_ERROR.value)
+        authorities: list[Record] = []
+        try:
+            resolved = Message.from_bytes(data=reply, lazy=True)
+            answers = resolved.answers
+            if len(answers) < 1 and rcode in negative:
+                # NXDOMAIN or NODATA, the SOA tells how long it may be cached
+                authorities = [record for record in resolved.authorities
+                               if record.type == RType.SOA.value]
+        except DNSError as e:
+            # The upstream failed, not the client: never answer FORMERR
+            logger.warning(f'Malformed upstream reply for {query.name}: {e}')
+            stale = None if refresh else Message._stale(query, cache)
+            if stale is not None:
+                return stale
+            raise DNSServerFailure(
+                f'Upstream sent a malformed reply for {query.name}'
+            ) from e
+
+        if len(answers) > 0 or rcode not in negative:
+            if cache is not None and rcode == ResponseCode.NO_ERROR.value:
+                cache.put(query, answers)
+            return Resolution(rcode, answers, [])
+
+        if negative_cache is not None:
+            negative_cache.put(query, rcode, authorities)
+        return Resolution(rcode, [], authorities)
+
+    def _split(self, query: Record) -> bytes:
+        """
+        Serialize a query message asking only `query`.
+        """
+        header = copy.copy(self.header)
+        header.qdcount = 1
+        header.ancount = 0
+        header.nscount = 0
+        header.arcount = 0
+        return Message(header=header, queries=[query]).serialize()
+
+    @staticmethod
+    def _build_section(
+        data: bytes | memoryview, header: Header, key: str, position: int,
+        names: dict[int, str]
+    ) -> tuple[list[Record], int]:
+        """
+        Decode the records of section `key` starting at `position`.
+
+        :rtype: tuple[list[Record], int]
+        :return: The records, and the offset the next section starts at
+        """
+        records: list[Record] = []
+        count = Message.sections[key]
+        ranger = getattr(header, count)
+
+        packets.debug('Header.%s reports %d record(s)', key, ranger)
+
+        if key == 'queries' and ranger < 1:
+            raise AttributeError(
+                f'Attribute ({count}) requires a positive value',
+                name=count,
+                object=header,
+            )
+
+        if ranger > 0:
+            packets.debug('Building %d record(s) for Header.%s...', ranger,
+                          key)
+            for _ in range(ranger):
+                try:
+                    if key == 'queries':
+                        record, position = Query.from_bytes(
+                            data, position, names
+                        )
+                    else:
+                        record, position = BaseRecord.factory(
+                            data, position, names
+                        )
+
+                    records.append(record)
+                    # position += record.bytes_read
+                except NotImplementedError as e:
+                    setattr(header, count, ranger - 1)
+                    logger.warning(e)
+                    continue
+
+        return records, position
@@ -0,0 +1,529 @@
+"""
+Latency histograms and counters of the stages a query goes through,
+labelled by query type and response code, with a Prometheus text endpoint
+and a periodic JSON dump. Request latency, from receive to send, and the
+upstream round trip time go to log-bucketed histograms reporting their
+percentiles per interval.
+
+Recording takes no lock: every series and its buckets are allocated the
+first time a label pair is seen, and recording only increments them. Two
+threads recording into the same bucket at the same instant may lose one
+increment, a trade made for metrics cheap enough to leave on.
+"""
+import bisect
+import math
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from app.dns.common import QType, ResponseCode, RType, _Address
+
+logger = logging.getLogger(__name__)
+
+#: Stages answering a query goes through, in order
+STAGES = ('parse', 'validate', 'resolve', 'serialize')
+
+#: Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+#: Percentiles reported of the latency histograms
+PERCENTILES = (50.0, 90.0, 99.0, 99.9)
+
+#: Latency histograms of :class:`Metrics`, the time from receiving a query
+#: to sending its response, and the round trip to the upstream resolver
+LATENCIES = ('request', 'upstream')
+
+
+class Timings:
+    """Seconds answering one query spent in each stage"""
+
+    __slots__ = STAGES + ('upstream',)
+
+    def __init__(self) -> None:
+        self.parse = 0.0
+        self.validate = 0.0
+        self.resolve = 0.0
+        self.serialize = 0.0
+
+        #: Round trip to the upstream resolver, part of `resolve`, 0 when
+        #: answered without asking it
+        self.upstream = 0.0
+
+
+class Histogram:
+    """Counts of the values observed per bucket, Prometheus style"""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple[float, ...] = BUCKETS):
+        """
+        :param tuple bounds: Increasing upper bounds of the buckets, values
+                             above the last one are counted in a +Inf bucket
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """
+        :rtype: list[tuple[str, int]]
+        :return: Every upper bound, +Inf last, and the number of values at
+                 or below it
+        """
+        res = []
+        total = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            res.append(('+Inf' if bound == float('inf') else repr(bound),
+                        total))
+        return res
+
+
+class LatencyHistogram:
+    """
+    Latencies counted in log-bucketed buckets, HDR histogram style: values
+    below ``2 ** precision`` microseconds get a bucket each, every power of
+    two above is split into ``2 ** (precision - 1)`` buckets of equal width.
+    A value is reported within ``2 ** (1 - precision)`` of what was
+    recorded, 1/64 by default, in memory fixed by the highest value.
+    """
+
+    __slots__ = ('precision', 'highest', 'counts', 'count', 'sum')
+
+    def __init__(self, highest: float = 60.0, precision: int = 7):
+        """
+        :param float highest: Highest latency tracked in seconds, above it
+                              latencies are counted as `highest`
+        :param int precision: Bits of every value kept
+        """
+        self.precision = precision
+        self.highest = int(highest * 1_000_000)
+        self.counts = array('Q', bytes(8 * (self._index(self.highest) + 1)))
+        self.count = 0
+        self.sum = 0.0
+
+    def _index(self, value: int) -> int:
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return (shift << (self.precision - 1)) + (value >> shift)
+
+    def _bounds(self, index: int) -> tuple[int, int]:
+        """
+        :return: Lowest and highest microseconds counted in the bucket
+        """
+        sub_count = 1 << self.precision
+        if index < sub_count:
+            return index, index
+        half = sub_count >> 1
+        shift = (index - sub_count) // half + 1
+        mantissa = index - shift * half
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+    def record(self, seconds: float) -> None:
+        value = int(seconds * 1_000_000)
+        if value > self.highest:
+            value = self.highest
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def percentile(self, percentile: float) -> float:
+        """
+        :param float percentile: Between 0 and 100
+        :rtype: float
+        :return: Seconds at or below which `percentile` percent of the
+                 latencies are, the highest of their bucket, 0 when empty
+        """
+        if self.count < 1:
+            return 0.0
+        rank = max(1, math.ceil(self.count * percentile / 100))
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return self._bounds(index)[1] / 1_000_000
+        return self.highest / 1_000_000
+
+    def percentiles(self) -> dict[str, float]:
+        """
+        :rtype: dict[str, float]
+        :return: Seconds per reported percentile, keyed as ``p99.9``
+        """
+        return {f'p{p:g}': self.percentile(p) for p in PERCENTILES}
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """
+        Add the latencies of `other`, of another worker or interval.
+
+        :raises ValueError: If the histograms aren't bucketed alike
+        """
+        if (other.precision, other.highest) != (self.precision,
+                                                self.highest):
+            raise ValueError('Can\'t merge histograms of different buckets')
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def reset(self) -> None:
+        self.counts = array('Q', bytes(8 * len(self.counts)))
+        self.count = 0
+        self.sum = 0.0
+
+    def to_dict(self) -> dict:
+        """
+        :rtype: dict
+        :return: The histogram as JSON serializable values, only the
+                 buckets counted in
+        """
+        return {
+            'highest': self.highest / 1_000_000,
+            'precision': self.precision,
+            'count': self.count,
+            'sum': self.sum,
+            'counts': {str(i): c for i, c in enumerate(self.counts) if c},
+            **self.percentiles(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'LatencyHistogram':
+        """
+        :param dict data: As returned by :meth:`to_dict`
+        :rtype: LatencyHistogram
+        """
+        res = cls(data['highest'], data['precision'])
+        for index, count in data['counts'].items():
+            res.counts[int(index)] = count
+        res.count = data['count']
+        res.sum = data['sum']
+        return res
+
+
+class Series:
+    """The histogram of every stage for one query type and response code"""
+
+    __slots__ = STAGES
+
+    def __init__(self) -> None:
+        for stage in STAGES:
+            setattr(self, stage, Histogram())
+
+    def record(self, timings: Timings) -> None:
+        self.parse.observe(timings.parse)
+        self.validate.observe(timings.validate)
+        self.resolve.observe(timings.resolve)
+        self.serialize.observe(timings.serialize)
+
+
+class Metrics:
+    """Stage latencies and counters of a server process"""
+
+    def __init__(self) -> None:
+        self.series: dict[tuple[str, str], Series] = {}
+
+        #: Responses sent from the answer cache without being parsed
+        self.answer_cache_hits = 0
+
+        #: Queries answered with an error before a response was built
+        self.errors: dict[str, int] = {}
+
+        #: Time from receiving a query to sending its response
+        self.request = LatencyHistogram()
+
+        #: Round trip time to the upstream resolver
+        self.upstream = LatencyHistogram()
+
+        # Latencies of the intervals before the current one, and the
+        # histograms the next interval will record into
+        self._totals = {name: LatencyHistogram() for name in LATENCIES}
+        self._spares = {name: LatencyHistogram() for name in LATENCIES}
+
+        self._qtypes: dict[int, str] = {}
+        self._rcodes: dict[int, str] = {}
+
+    def record(self, qtype: int, rcode: int, timings: Timings) -> None:
+        """
+        :param int qtype: Type of the first question
+        :param int rcode: Response code sent
+        :param Timings timings: Time spent per stage
+        """
+        key = (self.qtype(qtype), self.rcode(rcode))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series.setdefault(key, Series())
+        series.record(timings)
+        if timings.upstream:
+            self.upstream.record(timings.upstream)
+
+    def error(self, rcode: int) -> None:
+        name = self.rcode(rcode)
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def interval(self) -> dict[str, LatencyHistogram]:
+        """
+        End the current interval: the latency histograms start over, the
+        ones recorded so far are added to the totals.
+
+        Recording goes on without waiting, into histograms reset ahead of
+        time, a latency recorded while they are swapped may be counted in
+        either interval.
+
+        :rtype: dict[str, LatencyHistogram]
+        :return: The histograms of the interval ended, per latency
+        """
+        res = {}
+        for name in LATENCIES:
+            spare = self._spares[name]
+            spare.reset()
+            res[name] = getattr(self, name)
+            setattr(self, name, spare)
+            self._spares[name] = res[name]
+            self._totals[name].merge(res[name])
+        return res
+
+    def latency(self, name: str) -> LatencyHistogram:
+        """
+        :param str name: One of :data:`LATENCIES`
+        :rtype: LatencyHistogram
+        :return: Every latency recorded since the start
+        """
+        res = LatencyHistogram()
+        res.merge(self._totals[name])
+        res.merge(getattr(self, name))
+        return res
+
+    def qtype(self, code: int) -> str:
+        name = self._qtypes.get(code)
+        if name is None:
+            name = str(RType.safe_get_name_by_value(code,
+                       QType.safe_get_name_by_value(code)))
+            self._qtypes[code] = name
+        return name
+
+    def rcode(self, code: int) -> str:
+        name = self._rcodes.get(code)
+        if name is None:
+            name = str(ResponseCode.safe_get_name_by_value(code))
+            self._rcodes[code] = name
+        return name
+
+    def render(self) -> str:
+        """
+        :rtype: str
+        :return: Every metric in the Prometheus text exposition format
+        """
+        lines = [
+            '# HELP dns_stage_seconds Time spent answering a query, per '
+            'stage',
+            '# TYPE dns_stage_seconds histogram',
+        ]
+        requests = []
+        for (qtype, rcode), series in list(self.series.items()):
+            labels = f'qtype="{qtype}",rcode="{rcode}"'
+            for stage in STAGES:
+                histogram: Histogram = getattr(series, stage)
+                stage_labels = f'stage="{stage}",{labels}'
+                for bound, total in histogram.cumulative():
+                    lines.append(
+                        f'dns_stage_seconds_bucket{{{stage_labels},'
+                        f'le="{bound}"}} {total}'
+                    )
+                lines.append(f'dns_stage_seconds_sum{{{stage_labels}}} '
+                             f'{histogram.sum!r}')
+                lines.append(f'dns_stage_seconds_count{{{stage_labels}}} '
+                             f'{total}')
+            requests.append(f'dns_requests_total{{{labels}}} '
+                            f'{series.parse.count}')
+
+        lines += [
+            '# HELP dns_requests_total Queries answered',
+            '# TYPE dns_requests_total counter',
+            *requests,
+            '# HELP dns_errors_total Queries answered with an error before '
+            'a response was built',
+            '# TYPE dns_errors_total counter',
+            *(f'dns_errors_total{{rcode="{rcode}"}} {count}'
+              for rcode, count in list(self.errors.items())),
+            '# HELP dns_answer_cache_hits_total Responses sent from the '
+            'answer cache',
+            '# TYPE dns_answer_cache_hits_total counter',
+            f'dns_answer_cache_hits_total {self.answer_cache_hits}',
+        ]
+        for name in LATENCIES:
+            histogram = self.latency(name)
+            metric = f'dns_{name}_latency_seconds'
+            lines += [
+                f'# HELP {metric} Percentiles of the {name} latency',
+                f'# TYPE {metric} summary',
+                *(f'{metric}{{quantile="{p / 100:g}"}} '
+                  f'{histogram.percentile(p)!r}' for p in PERCENTILES),
+                f'{metric}_sum {histogram.sum!r}',
+                f'{metric}_count {histogram.count}',
+            ]
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """
+        :rtype: dict
+        :return: Every metric, as JSON serializable values
+        """
+        return {
+            'time': time.time(),
+            'answer_cache_hits': self.answer_cache_hits,
+            'errors': dict(self.errors),
+            'latency': {name: self.latency(name).to_dict()
+                        for name in LATENCIES},
+            'series': [
+                {
+                    'qtype': qtype,
+                    'rcode': rcode,
+                    'count': series.parse.count,
+                    'stages': {
+                        stage: {
+                            'count': getattr(series, stage).count,
+                            'sum': getattr(series, stage).sum,
+                            'buckets': dict(getattr(series, stage)
+                                            .cumulative()),
+                        }
+                        for stage in STAGES
+                    },
+                }
+                for (qtype, rcode), series in list(self.series.items())
+            ],
+        }
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """Serves :meth:`Metrics.render` on ``/metrics``"""
+
+    daemon_threads = True
+
+    def __init__(self, metrics: Metrics, address: _Address):
+        """
+        :param Metrics metrics: The metrics served
+        :param address: Address to listen on as (ip, port)
+        """
+        self.metrics = metrics
+        super().__init__(address, _MetricsHandler)
+
+    def start(self) -> threading.Thread:
+        """
+        Serve from a daemon thread.
+        """
+        thread = threading.Thread(target=self.serve_forever, name='metrics',
+                                  daemon=True)
+        thread.start()
+        host, port = self.server_address[:2]
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return thread
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    server: MetricsServer
+
+    def do_GET(self) -> None:
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+
+class LatencyReport:
+    """Logs the latency percentiles and starts them over every interval"""
+
+    def __init__(self, metrics: Metrics, interval: float = 60.0):
+        """
+        :param Metrics metrics: The metrics reported
+        :param float interval: Seconds between two reports
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def report(self) -> None:
+        for name, histogram in self.metrics.interval().items():
+            if histogram.count < 1:
+                continue
+            percentiles = ', '.join(f'{p} {seconds * 1000:.3f}ms'
+                                    for p, seconds
+                                    in histogram.percentiles().items())
+            logger.info(f'{name.capitalize()} latency of '
+                        f'{histogram.count} in {self.interval:g}s: '
+                        f'{percentiles}')
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name='latency-report',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class MetricsDump:
+    """Writes :meth:`Metrics.snapshot` to a JSON file periodically"""
+
+    def __init__(self, metrics: Metrics, path: str, interval: float = 60.0):
+        """
+        :param Metrics metrics: The metrics dumped
+        :param str path: File replaced with every dump
+        :param float interval: Seconds between two dumps
+        """
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def dump(self) -> None:
+        # Replaced in one step, a reader never sees half a dump
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.metrics.snapshot(), f)
+        os.replace(tmp, self.path)
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.dump()
+            except OSError as e:
+                logger.warning(f'Could not dump metrics to {self.path}: {e}')
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.run, name='metrics-dump',
+                                  daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self.stopped.set()
@@ -1,124 +1,224 @@
 import logging
 import struct
 import enum
-from abc import ABC, abstractmethod
+from abc import ABCMeta, abstractmethod
+from typing import Callable
 from app.dns.encoding import Encoding
+from app.dns.writer import Writer
 from app.dns.exceptions import NotImplementedError
-from app.dns.common import RType, DomainName, CharacterString
+from app.dns.common import RType, DomainName, CharacterString, \
+    packet_logger
 
 logger = logging.getLogger(__name__)
+packets = packet_logger(__name__)
 
+_U16 = struct.Struct('!H')
+_SOA = struct.Struct('!LLLLL')
+_IPV4 = struct.Struct('!BBBB')
 
-class RDATA(ABC):
-    __annotations__: dict[str, str] = dict()
+#: Marks a field :meth:`RDATA.__copy__` found unset
+_UNSET = object()
 
-    def __init__(self, **kwargs) -> None:
-        super().__init__()
-        self._annotate(kwargs)
 
-    @staticmethod
-    def get_callable(record_type: int) -> tuple['RDATA', RType]:
-        if not RType.value_exists(record_type):
-            raise NotImplementedError(
-                f'Unsupported Record Type: {record_type}'
-            )
+class _Fields(ABCMeta):
+    """
+    Lays out the fields an RDATA type annotates as slots. A slot can't have
+    a class-level default, the defaults are kept in `_defaults` and assigned
+    by the constructor.
+    """
+
+    def __new__(mcs, name: str, bases: tuple[type, ...], namespace: dict,
+                **kwargs) -> '_Fields':
+        fields = tuple(
+            field for field in namespace.get('__annotations__', {})
+            if not field.startswith('_')
+        )
+
+        defaults: dict[str, object] = {}
+        inherited: tuple[str, ...] = ()
+        for base in bases:
+            defaults.update(getattr(base, '_defaults', {}))
+            inherited += getattr(base, '_fields', ())
+        for field in fields:
+            if field in namespace:
+                defaults[field] = namespace.pop(field)
+
+        namespace['__slots__'] = fields
+        namespace['_defaults'] = defaults
+        namespace['_fields'] = inherited + fields
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class RDATA(metaclass=_Fields):
+    #: Every field of the type, in the order positional arguments fill them
+    _fields: tuple[str, ...]
 
-        t = RType(record_type)
+    #: Default value of every field declared with one
+    _defaults: dict[str, object]
 
-        match t:
-            case (
-                    RType.CNAME | RType.MB | RType.MD | RType.MF | RType.MG
-                    | RType.MR | RType.NS | RType.PTR):
-                name = 'DOMAIN'
+    #: RDATA type of every record type code, see :meth:`register`
+    _codecs: dict[int, type['RDATA']] = {}
 
-            case _:
-                name = t.name.upper()
+    def __init__(self, *args, **kwargs) -> None:
+        """
+        Fields are given positionally, in declaration order, or by name.
+        Fields without a default that aren't given are left unset.
+        """
+        for name, value in self._defaults.items():
+            setattr(self, name, value)
 
-        from importlib import import_module
-        obj = getattr(import_module('app.dns.rdata'), 'RDATA_' + name)
-        return obj, t
+        for name, value in zip(self._fields, args):
+            setattr(self, name, value)
+
+        for name, value in kwargs.items():
+            if isinstance(value, enum.Enum):
+                value = value.value
+            setattr(self, name, value)
+
+    @staticmethod
+    def register(
+        *record_types: RType | int
+    ) -> Callable[[type['RDATA']], type['RDATA']]:
+        """
+        Class decorator registering an RDATA type as the codec of
+        `record_types`, replacing any codec registered before.
+
+        :param record_types: Record types, as RType or their code
+        """
+        def decorator(codec: type['RDATA']) -> type['RDATA']:
+            for record_type in record_types:
+                if isinstance(record_type, enum.Enum):
+                    record_type = record_type.value
+                RDATA._codecs[record_type] = codec
+            return codec
+        return decorator
+
+    @staticmethod
+    def codec(record_type: int) -> type['RDATA']:
+        """
+        :param int record_type: Record type code
+        :rtype: type[RDATA]
+        :raises NotImplementedError: If no codec is registered for the type
+        """
+        try:
+            return RDATA._codecs[record_type]
+        except KeyError:
+            raise NotImplementedError(
+                f'Unsupported Record Type: {record_type}'
+            ) from None
+
+    @staticmethod
+    def get_callable(record_type: int) -> tuple[type['RDATA'], RType]:
+        codec = RDATA.codec(record_type)
+        return codec, RType(record_type)
 
     @staticmethod
     def factory(record_type: int, **kwargs) -> 'RDATA':
-        obj_path, t = RDATA.get_callable(record_type)
-        obj: RDATA = obj_path()
-        logger.info(f'Matched \'RType.{t.name}\' to \'{obj_path.__name__}\'')
-
-        obj._annotate(kwargs)
-        return obj
-
-    def _annotate(self, annotations: dict = {}) -> None:
-        if len(annotations) > 0:
-            for name, value in annotations.items():
-                if isinstance(value, enum.Enum):
-                    value = value.value
-                self.__annotations__[name] = value
-
-    def __getattr__(self, instance, owner=None):
-        annotation = object.__getattribute__(self, '__annotations__')
-        if instance in annotation:
-            return annotation[instance]
-        else:
-            raise AttributeError('Could not find {instance}')
-
-    def __setattr__(self, instance, value):
-        annotation = object.__getattribute__(self, '__annotations__')
-        if instance in annotation:
-            annotation[instance] = value
-            object.__setattr__(self, '__annotations__', annotation)
-        else:
-            raise AttributeError('Could not find {instance}')
-
-    def __delattr__(self, instance):
-        annotation = object.__getattribute__(self, '__annotations__')
-        if instance in annotation:
-            del annotation[instance]
-            object.__setattr__(self, '__annotations__', annotation)
-        else:
-            raise AttributeError('Could not find {instance}')
+        codec = RDATA.codec(record_type)
+        packets.debug('Matched type %d to \'%s\'', record_type, codec.__name__)
+
+        return codec(**kwargs)
 
     @abstractmethod
     def __bytes__(self) -> bytes:
         return b''
 
-    def __copy__(self):
+    def serialize(self, offset: int = 0,
+                  names: dict[str, int] | None = None) -> bytes:
+        """
+        Encode the RDATA, with its domain names compressed when `names` is
+        given and the type allows it (RFC 3597, section 4).
+
+        :param int offset: Offset in the message the RDATA is written at
+        :param dict names: Offset of every name already written to the
+                           message, see :meth:`Encoding.encode_domain_name`
+        :rtype: bytes
+        """
+        writer = Writer(names=names, base=offset)
+        self.write(writer)
+        return writer.getvalue()
+
+    def write(self, writer: Writer) -> None:
+        """
+        Append the RDATA to `writer`, types that don't override this are
+        encoded with ``bytes()`` first.
+        """
+        writer.write(bytes(self))
+
+    def __copy__(self) -> 'RDATA':
         cls = self.__class__
         result = cls.__new__(cls)
-
-        obj_annotations = getattr(self, '__annotations__')
-        result._annotate(obj_annotations)
+        for name in self._fields:
+            value = getattr(self, name, _UNSET)
+            if value is not _UNSET:
+                setattr(result, name, value)
         return result
 
+    def __repr__(self) -> str:
+        fields = ', '.join(
+            f'{name}={getattr(self, name)!r}' for name in self._fields
+            if hasattr(self, name)
+        )
+        return f'{self.__class__.__name__}({fields})'
+
     @classmethod
     @abstractmethod
-    def decode(cls, data: bytes) -> 'RDATA':
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> 'RDATA':
+        """
+        Decode the RDATA starting at `offset`.
+
+        :param data: The whole message, so compressed names can be followed,
+                     read in place when a memoryview
+        :type data: bytes, memoryview
+        :param int offset: Offset the RDATA starts at
+        :param int length: RDLENGTH, defaults to the rest of `data`
+        :param dict names: Names already decoded from `data` by offset, see
+                           :meth:`Encoding.decode_domain_name`
+        :rtype: RDATA
+        """
         return cls()
 
 
+@RDATA.register(RType.A)
 class RDATA_A(RDATA):
     data: DomainName
 
     def __bytes__(self) -> bytes:
-        return Encoding.encode(self.data)
+        return self.serialize()
+
+    def write(self, writer: Writer) -> None:
+        writer.pack(_IPV4, *map(int, self.data.split('.')))
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_A":
-        name, _ = Encoding.decode_ip(data)
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_A":
+        name, _ = Encoding.decode_ip(data, offset)
         return cls(data=name)
 
 
+@RDATA.register(RType.CNAME, RType.MB, RType.MD, RType.MF, RType.MG,
+                RType.MR, RType.NS, RType.PTR)
 class RDATA_DOMAIN(RDATA):
     data: DomainName
 
     def __bytes__(self) -> bytes:
-        return Encoding.encode(self.data)
+        return self.serialize()
+
+    def write(self, writer: Writer) -> None:
+        writer.name(self.data)
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_DOMAIN":
-        name, _ = Encoding.decode_domain_name(data)
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_DOMAIN":
+        name, _ = Encoding.decode_domain_name(data, offset, names)
         return cls(data=name)
 
 
+@RDATA.register(RType.HINFO)
 class RDATA_HINFO(RDATA):
     cpu: CharacterString = ''
     os: CharacterString = ''
@@ -130,49 +230,57 @@ class RDATA_HINFO(RDATA):
         return res
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_HINFO":
-        cpu, cpu_length = Encoding.decode_character_string(data)
-        os, _ = Encoding.decode_character_string(
-            data[cpu_length:]
-        )
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_HINFO":
+        cpu, cpu_length = Encoding.decode_character_string(data, offset)
+        os, _ = Encoding.decode_character_string(data, offset + cpu_length)
         return cls(cpu=cpu, os=os)
 
 
+@RDATA.register(RType.MINFO)
 class RDATA_MINFO(RDATA):
     rmailbx: DomainName = ''
     emailbx: DomainName = ''
 
     def __bytes__(self) -> bytes:
-        res = b''
-        res += Encoding.encode_domain_name(self.rmailbx)
-        res += Encoding.encode_domain_name(self.emailbx)
+        return self.serialize()
 
-        return res
+    def write(self, writer: Writer) -> None:
+        writer.name(self.rmailbx)
+        writer.name(self.emailbx)
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_MINFO":
-        rmailbx, _len = Encoding.decode_domain_name(data)
-        emailbx, _ = Encoding.decode_domain_name(data[_len:])
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_MINFO":
+        rmailbx, i = Encoding.decode_domain_name(data, offset, names)
+        emailbx, _ = Encoding.decode_domain_name(data, i, names)
         return cls(rmailbx=rmailbx, emailbx=emailbx)
 
 
+@RDATA.register(RType.MX)
 class RDATA_MX(RDATA):
     preference: int = 0
     exchange: DomainName = ''
 
     def __bytes__(self) -> bytes:
-        res = b''
-        res += struct.pack("!H", self.preference)
-        res += Encoding.encode_domain_name(self.exchange)
-        return res
+        return self.serialize()
+
+    def write(self, writer: Writer) -> None:
+        writer.pack(_U16, self.preference)
+        writer.name(self.exchange)
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_MX":
-        preference = int.from_bytes(data[0:2], 'big')
-        exchange = Encoding.decode_domain_name(data[2:])
-        return cls(preference=preference, exchange=exchange, data=data)
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_MX":
+        (preference,) = _U16.unpack_from(data, offset)
+        exchange, _ = Encoding.decode_domain_name(data, offset + 2, names)
+        return cls(preference=preference, exchange=exchange)
 
 
+@RDATA.register(RType.SOA)
 class RDATA_SOA(RDATA):
     mname: DomainName = ''
     rname: DomainName = ''
@@ -183,38 +291,27 @@ class RDATA_SOA(RDATA):
     minimum: int = 0
 
     def __bytes__(self) -> bytes:
-        import struct
+        return self.serialize()
 
-        res = b''
-        res += Encoding.encode_domain_name(self.mname)
-        res += Encoding.encode_domain_name(self.rname)
-        res += struct.pack(
-            '!LLLLL',
+    def write(self, writer: Writer) -> None:
+        writer.name(self.mname)
+        writer.name(self.rname)
+        writer.pack(
+            _SOA,
             self.serial,
             self.refresh,
             self.retry,
             self.expire,
             self.minimum,
         )
-        return res
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_SOA":
-        len = 0
-        mname, _len = Encoding.decode_domain_name(data[len:])
-        len += _len
-        rname, _len = Encoding.decode_domain_name(data[len:])
-        len += _len
-        serial = int.from_bytes(data[len:4], 'big')
-        len += 4
-        refresh = int.from_bytes(data[len:4], 'big')
-        len += 4
-        retry = int.from_bytes(data[len:4], 'big')
-        len += 4
-        expire = int.from_bytes(data[len:4], 'big')
-        len += 4
-        minimum = int.from_bytes(data[len:4], 'big')
-        len += 4
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_SOA":
+        mname, i = Encoding.decode_domain_name(data, offset, names)
+        rname, i = Encoding.decode_domain_name(data, i, names)
+        serial, refresh, retry, expire, minimum = _SOA.unpack_from(data, i)
 
         return cls(
             mname=mname, rname=rname, serial=serial, refresh=refresh,
@@ -222,6 +319,7 @@ class RDATA_SOA(RDATA):
         )
 
 
+@RDATA.register(RType.TXT)
 class RDATA_TXT(RDATA):
     data: CharacterString = ''
 
@@ -229,16 +327,22 @@ class RDATA_TXT(RDATA):
         return Encoding.encode_character_string(self.data)
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_TXT":
-        i = 0
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_TXT":
+        if length is None:
+            length = len(data) - offset
+
+        i = offset
         rdata: CharacterString = ''
-        while i < len(data):
-            _data, _i = Encoding.decode_character_string(data[i:])
+        while i < offset + length:
+            _data, _i = Encoding.decode_character_string(data, i)
             rdata += _data
             i += _i
-        return cls(rdata)
+        return cls(data=rdata)
 
 
+@RDATA.register(RType.NULL)
 class RDATA_NULL(RDATA):
     data: str = ''
 
@@ -246,23 +350,31 @@ class RDATA_NULL(RDATA):
         return Encoding.encode_character_string(self.data)
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_NULL":
-        rdata = data[:65535].decode('utf-8')
-        return cls(rdata)
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_NULL":
+        if length is None:
+            length = len(data) - offset
 
+        rdata = str(data[offset:offset + length], 'utf-8')
+        return cls(data=rdata)
 
+
+@RDATA.register(RType.WKS)
 class RDATA_WKS(RDATA):
     address: DomainName
     protocol: int
 
     def __bytes__(self) -> bytes:
         res = b''
-        res += struct.pack("!H", self.preference)
-        res += Encoding.encode_domain_name(self.exchange)
+        res += Encoding.encode_ip(self.address.split('.'))
+        res += bytes((self.protocol,))
         return res
 
     @classmethod
-    def decode(cls, data: bytes) -> "RDATA_WKS":
-        name, i = Encoding.decode_ip(data)
-        # protocol = int.from_bytes(data[i:i + 1], 'big')
-        return cls(data=name)
+    def decode(cls, data: bytes, offset: int = 0,
+               length: int | None = None,
+               names: dict[int, DomainName] | None = None) -> "RDATA_WKS":
+        address, i = Encoding.decode_ip(data, offset)
+        protocol = data[offset + i]
+        return cls(address=address, protocol=protocol)
@@ -4,69 +4,91 @@ import enum
 import logging
 from typing import TypeVar
 from app.dns.common import RType, QType, RClass, QClass, ResponseCode, \
-    debug, get_random_ttl
+    Tracer, get_random_ttl
 from app.dns.rdata import RDATA
 from app.dns.encoding import Encoding
+from app.dns.exceptions import FormatError
+from app.dns.writer import Writer
 
 RDATA_ARG = TypeVar('RDATA_ARG', RDATA, tuple[str | int, ...], str, int)
 
 logger = logging.getLogger(__name__)
 
+_trace_base = Tracer(logger, 'BaseRecord.from_bytes')
+_trace_record = Tracer(logger, 'Record.from_bytes')
+_trace_resource = Tracer(logger, 'ResourceRecord.from_bytes')
+_trace_write = Tracer(logger, 'ResourceRecord.write')
+
+_U16 = struct.Struct('!H')
+_TYPE_CLASS = struct.Struct('!HH')
+_TTL_RDLENGTH = struct.Struct('!IH')
+_FIXED = struct.Struct('!HHIH')
+
+
+def _value(value: enum.Enum | int) -> int:
+    if value.__class__ is int:
+        return value
+    return value.value if isinstance(value, enum.Enum) else value
+
 
 class BaseRecord:
     name: str
     type: int
 
-    bytes_read: int = 0
-    bytes_written: int = 0
+    #: Octets the record took up in the message it was decoded from
+    bytes_read: int
+
+    #: Octets the record took up the last time it was written
+    bytes_written: int
+
+    __slots__ = ('name', 'type', 'bytes_read', 'bytes_written')
 
-    def __init__(self, *args, **kwargs):
+    #: Class records of every registered type code are decoded as, see
+    #: :meth:`register`. Types with an RDATA codec default to
+    #: :class:`ResourceRecord`.
+    _types: dict[int, type['BaseRecord']] = {}
+
+    def __init__(self, name: str, type: RType | int):
         """
         :param str name: Label of record
         :param int type: Record Type
         """
-        total = len(args) + len(kwargs)
-        if total < 2:
-            cname = str(self.__class__)
-            raise TypeError(
-                f'{cname} takes 3 arguments but {total} were given'
-            )
-
-        if len(args) > 0:
-            if 'name' not in kwargs:
-                kwargs['name'] = args[0]
-            if 'type' not in kwargs:
-                kwargs['type'] = args[1]
-        if len(kwargs) > 0:
-            for name, value in kwargs.items():
-                if isinstance(value, enum.Enum):
-                    value = value.value
-                setattr(self, name, value)
+        self.name = name
+        self.type = _value(type)
+        self.bytes_read = 0
+        self.bytes_written = 0
 
     def __copy__(self) -> 'BaseRecord':
-        cls = self.__class__
-        result = cls.__new__(cls)
-        result.name = self.name
-        result.type = self.type
-
-        return result
+        return self.__class__(self.name, self.type)
 
     def __len__(self) -> int:
         return len(bytes(self))
 
     def __bytes__(self) -> bytes:
-        res = (Encoding.encode(self.name)
-               + struct.pack('!H', self.type))
-        self.bytes_written = len(res)
-        return res
+        return self.serialize()
 
     def __repr__(self) -> str:
         type = RType.safe_get_name_by_value(self.type)
 
         return f'BASE: {self.name} {type}'
 
-    def serialize(self) -> bytes:
-        return bytes(self)
+    def serialize(self, offset: int = 0,
+                  names: dict[str, int] | None = None) -> bytes:
+        """
+        :param int offset: Offset in the message the record is written at
+        :param dict names: Offset of every name already written to the
+                           message, names are compressed when given, see
+                           :meth:`Encoding.encode_domain_name`
+        """
+        writer = Writer(names=names, base=offset)
+        self.write(writer)
+        return writer.getvalue()
+
+    def write(self, writer: Writer) -> None:
+        start = len(writer)
+        writer.name(self.name)
+        writer.pack(_U16, self.type)
+        self.bytes_written = len(writer) - start
 
     def validate(self) -> ResponseCode:
         if not RType.value_exists(self.type):
@@ -77,84 +99,81 @@ class BaseRecord:
 
     @classmethod
     def from_bytes(
-        cls, data: bytes, offset: int = 0
+        cls, data: bytes | memoryview, offset: int = 0,
+        names: dict[int, str] | None = None
     ) -> tuple["BaseRecord", int]:
-        debug('Base Payload', data=data)
+        """
+        :param data: The whole message
+        :param int offset: Offset the record starts at
+        :param dict names: Names already decoded from `data` by offset, see
+                           :meth:`Encoding.decode_domain_name`
+        """
+        if _trace_base.enabled:
+            _trace_base('Base Payload', data=data)
 
-        name, i = Encoding.decode_domain_name(data, offset=offset)
+        name, i = Encoding.decode_domain_name(data, offset, names)
 
-        _type = int.from_bytes(data[i:i + 2], 'big')
+        (_type,) = _U16.unpack_from(data, i)
         i += 2
 
-        obj = cls.__new__(cls)
-        obj.name = name
-        obj.type = _type
+        obj = cls(name, _type)
         obj.bytes_read = i - offset
         return obj, i
 
     @classmethod
-    def factory(cls, data: bytes, offset: int = 0) -> tuple['BaseRecord', int]:
-        name, i = Encoding.decode_domain_name(data, offset=offset)
+    def factory(
+        cls, data: bytes | memoryview, offset: int = 0,
+        names: dict[int, str] | None = None
+    ) -> tuple['BaseRecord', int]:
+        name, i = Encoding.decode_domain_name(data, offset, names)
 
-        _type = int.from_bytes(data[i:i + 2], 'big')
+        (_type,) = _U16.unpack_from(data, i)
         i += 2
 
-        if not RType.value_exists(_type):
-            obj = cls.__new__(cls)
-            obj.name = name
-            obj.type = _type
+        record_class = BaseRecord._types.get(_type)
+        if record_class is None and _type in RDATA._codecs:
+            # Also covers the codecs registered after this module loaded
+            record_class = ResourceRecord
+        if record_class is None:
+            obj = BaseRecord(name, _type)
             obj.bytes_read = i - offset
             return obj, i
 
-        t = RType(_type)
+        return record_class.from_bytes(data, offset=offset, names=names)
 
-        match t:
-            case (
-                    RType.A | RType.NS | RType.MD | RType.MF | RType.CNAME |
-                    RType.SOA | RType.MB | RType.MG | RType.MR | RType.NULL |
-                    RType.WKS | RType.PTR | RType.HINFO | RType.MINFO |
-                    RType.MX | RType.TXT):
-                resource = ResourceRecord
-            case _:
-                resource = BaseRecord
+    @staticmethod
+    def register(record_type: RType | int,
+                 record_class: type['BaseRecord'] | None = None) -> None:
+        """
+        Decode records of `record_type` as `record_class`. Types never
+        registered are decoded as :class:`ResourceRecord` if an RDATA codec
+        is registered for them with :meth:`RDATA.register`, else as
+        :class:`BaseRecord`.
 
-        return resource.from_bytes(data, offset=offset)
+        :param record_type: Record type, as RType or its code
+        :param record_class: Defaults to :class:`ResourceRecord`
+        """
+        record_type = _value(record_type)
+        BaseRecord._types[record_type] = record_class or ResourceRecord
 
 
 class Record(BaseRecord):
     klass: int
 
-    def __init__(self, *args, **kwargs):
+    __slots__ = ('klass',)
+
+    def __init__(self, name: str, type: RType | QType | int,
+                 klass: RClass | QClass | int):
         """
         :param str name: Label of record
         :param int type: Record Type
         :param int klass: Record Class
         """
-        super(Record, self).__init__(*args, **kwargs)
-        total = len(args) + len(kwargs)
-        if total < 3:
-            cname = str(self.__class__)
-            raise TypeError(
-                f'{cname} takes 3 arguments but {total} were given'
-            )
-
-        if len(args) >= 3:
-            if 'klass' not in kwargs:
-                kwargs['klass'] = args[2]
-        if len(kwargs) > 0:
-            for name, value in kwargs.items():
-                if isinstance(value, enum.Enum):
-                    value = value.value
-                setattr(self, name, value)
+        super(Record, self).__init__(name, type)
+        self.klass = _value(klass)
 
     def __copy__(self) -> 'Record':
-        cls = self.__class__
-        result = cls.__new__(cls)
-        result.name = self.name
-        result.type = self.type
-        result.klass = self.klass
-
-        return result
+        return self.__class__(self.name, self.type, self.klass)
 
     def __repr__(self) -> str:
         if RType.value_exists(self.type):
@@ -169,11 +188,11 @@ class Record(BaseRecord):
 
         return f'R: {self.name} {klass} {type}'
 
-    def __bytes__(self) -> bytes:
-        res = (Encoding.encode(self.name)
-               + struct.pack('!HH', self.type, self.klass))
-        self.bytes_written = len(res)
-        return res
+    def write(self, writer: Writer) -> None:
+        start = len(writer)
+        writer.name(self.name)
+        writer.pack(_TYPE_CLASS, self.type, self.klass)
+        self.bytes_written = len(writer) - start
 
     def validate(self) -> ResponseCode:
         pre = super(Record, self).validate()
@@ -187,23 +206,26 @@ class Record(BaseRecord):
         return ResponseCode.NO_ERROR
 
     @classmethod
-    def from_bytes(cls, data: bytes, offset: int = 0) -> tuple['Record', int]:
-        newcls, i = super(Record, cls).from_bytes(data, offset=offset)
+    def from_bytes(
+        cls, data: bytes | memoryview, offset: int = 0,
+        names: dict[int, str] | None = None
+    ) -> tuple['Record', int]:
+        name, i = Encoding.decode_domain_name(data, offset, names)
 
-        klass = int.from_bytes(data[i:i + 2], 'big')
-        i += 2
+        _type, klass = _TYPE_CLASS.unpack_from(data, i)
+        i += _TYPE_CLASS.size
 
-        debug('RR', qn=newcls.name, qt=newcls.type, qc=klass)
+        if _trace_record.enabled:
+            _trace_record('RR', qn=name, qt=_type, qc=klass)
 
-        obj = cls.__new__(cls)
-        obj.name = newcls.name
-        obj.type = newcls.type
-        obj.klass = klass
+        obj = cls(name, _type, klass)
         obj.bytes_read = i - offset
         return obj, i
 
 
 class Query(Record):
+    __slots__ = ()
+
     def __repr__(self) -> str:
         if RClass.value_exists(self.klass):
             klass = RClass.safe_get_name_by_value(self.klass)
@@ -244,11 +266,15 @@ class Query(Record):
 
 
 class ResourceRecord(Record):
-    ttl: int = 0
-    rdlength: int = 0
-    rdata: RDATA | None = None
+    ttl: int
+    rdlength: int
+    rdata: RDATA | None
+
+    __slots__ = ('ttl', 'rdlength', 'rdata')
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, name: str, type: RType | int, klass: RClass | int,
+                 ttl: int = 0, rdlength: int = 0,
+                 rdata: RDATA_ARG | None = None):
         """
         :param str name: Label of record
         :param int type: Record Type
@@ -258,42 +284,30 @@ class ResourceRecord(Record):
         :param rdata: Resource Record Data (RDATA)
         :type rdata: RDATA, tuple[str | int, ...], str, int
         """
-        super(Record, self).__init__(*args, **kwargs)
-        self.rdata = None
+        super(ResourceRecord, self).__init__(name, type, klass)
+        self.ttl = ttl
+        self.rdlength = rdlength
 
-        total = len(args) + len(kwargs)
-        if total < 6:
-            raise TypeError(
-                self.__class__ + f' takes 6 arguments but {total} were given'
-            )
-        if len(args) > 0:
-            if 'ttl' not in kwargs:
-                kwargs['ttl'] = args[3]
-            if 'rdlength' not in kwargs:
-                kwargs['rdlength'] = args[4]
-            if 'rdata' not in kwargs:
-                kwargs['rdata'] = args[5]
-        if len(kwargs) > 0:
-            for name, value in kwargs.items():
-                if isinstance(value, enum.Enum):
-                    value = value.value
-                setattr(self, name, value)
-
-        if self.rdata is not None:
-            self.rdata = RDATA.factory(record_type=self.type, data=self.rdata)
+        if rdata is not None and not isinstance(rdata, RDATA):
+            rdata = self._rdata(rdata)
+        self.rdata = rdata
 
-    def __copy__(self) -> 'ResourceRecord':
-        cls = self.__class__
-        result = cls.__new__(cls)
-        result.name = self.name
-        result.type = self.type
-        result.klass = self.klass
+    def _rdata(self, value: RDATA_ARG | None) -> RDATA:
+        """
+        :raises FormatError: If there is no RDATA to write
+        """
+        if value is None:
+            raise FormatError(f'No RDATA for {self.name}')
 
-        result.ttl = self.ttl
-        result.rdlength = self.rdlength
-        result.rdata = copy.copy(self.rdata)
+        # A bare value is the single field of A, NS, TXT and the like,
+        # the types without one are left to their defaults
+        if 'data' in RDATA.codec(self.type)._fields:
+            return RDATA.factory(record_type=self.type, data=value)
+        return RDATA.factory(record_type=self.type)
 
-        return result
+    def __copy__(self) -> 'ResourceRecord':
+        return self.__class__(self.name, self.type, self.klass, self.ttl,
+                              self.rdlength, copy.copy(self.rdata))
 
     def __repr__(self) -> str:
         klass = RClass.safe_get_name_by_value(self.klass)
@@ -301,72 +315,80 @@ class ResourceRecord(Record):
 
         return f'R: {self.name} {klass} {type}'
 
-    def __bytes__(self) -> bytes:
-        rdlength, rdata = self.encode_rdata()
+    def write(self, writer: Writer) -> None:
+        if not isinstance(self.rdata, RDATA):
+            self.rdata = self._rdata(self.rdata)
+
+        start = len(writer)
+        writer.name(self.name)
+
+        # RDLENGTH is back-patched once the RDATA is written
+        fixed = writer.pack(_FIXED, self.type, self.klass, self.ttl, 0)
+        self.rdata.write(writer)
+        rdlength = len(writer) - fixed - _FIXED.size
+        writer.pack_at(_U16, fixed + _FIXED.size - 2, rdlength)
 
-        debug(type=self.type, klass=self.klass, ttl=self.ttl,
-              rdlength=rdlength, rdata=rdata)
+        if _trace_write.enabled:
+            _trace_write(type=self.type, klass=self.klass, ttl=self.ttl,
+                         rdlength=rdlength, rdata=self.rdata)
 
-        res = Encoding.encode(self.name)
-        res += struct.pack("!HHIH",
-                           self.type, self.klass, self.ttl, rdlength)
-        res += rdata
-        self.bytes_written = len(res)
-        return res
+        self.bytes_written = len(writer) - start
 
     @classmethod
     def from_bytes(
-        cls, data: bytes, offset: int = 0
+        cls, data: bytes | memoryview, offset: int = 0,
+        names: dict[int, str] | None = None
     ) -> tuple['ResourceRecord', int]:
-        newcls, i = super(ResourceRecord, cls).from_bytes(data, offset=offset)
+        name, i = Encoding.decode_domain_name(data, offset, names)
 
-        length = len(data)
+        _type, klass, ttl, rdlength = _FIXED.unpack_from(data, i)
+        i += _FIXED.size
 
-        ttl = int.from_bytes(data[i:i + 4], 'big')
-        i += 4
-
-        rdlength = int.from_bytes(data[i:i + 2], 'big')
-        i += 2
+        if _trace_resource.enabled:
+            _trace_resource('RR', qn=name, qt=_type, qc=klass)
 
-        obj = cls.__new__(cls)
-        obj.name = newcls.name
-        obj.type = newcls.type
-        obj.klass = newcls.klass
-        obj.ttl = ttl
-        obj.rdlength = rdlength
+        if i + rdlength > len(data):
+            raise FormatError(f'RDATA of {name} exceeds the message')
 
-        obj.rdata = None
-        if (i + rdlength) <= length:
-            d = data[i:i + rdlength]
-            obj.rdata = obj.decode_rdata(d)
-            i += rdlength
+        obj = cls(name, _type, klass, ttl, rdlength)
+        obj.rdata = obj.decode_rdata(data, i, rdlength, names)
+        i += rdlength
 
         obj.bytes_read = i - offset
         return obj, i
 
     @classmethod
     def lookup(cls, query: Query) -> 'ResourceRecord':
-        return cls(
-            name=query.name,
-            type=query.type,
-            klass=query.klass,
-            ttl=get_random_ttl(),
-            rdlength=4,
-            rdata='8.8.8.8'
-        )
-
-    def decode_rdata(self, data: bytes) -> RDATA:
-        if len(data) < 1:
-            return RDATA()
+        return cls(query.name, query.type, query.klass, get_random_ttl(), 4,
+                   '8.8.8.8')
 
-        if not isinstance(self.rdata, RDATA):
-            self.rdata, _ = RDATA.get_callable(self.type)
+    def decode_rdata(self, data: bytes | memoryview, offset: int = 0,
+                     length: int | None = None,
+                     names: dict[int, str] | None = None) -> RDATA:
+        """
+        :param bytes data: The whole message, RDATA may hold compressed names
+        :param int offset: Offset the RDATA starts at
+        :param int length: RDLENGTH, defaults to the rest of `data`
+        :param dict names: Names already decoded from `data` by offset
+        :raises FormatError: If the RDATA is empty
+        """
+        if length is None:
+            length = len(data) - offset
+        if length < 1:
+            raise FormatError(f'Empty RDATA for {self.name}')
+
+        if isinstance(self.rdata, RDATA):
+            codec = self.rdata.__class__
+        else:
+            codec = RDATA.codec(self.type)
 
-        return self.rdata.decode(data)
+        return codec.decode(data, offset, length, names)
 
-    def encode_rdata(self) -> tuple[int, bytes]:
+    def encode_rdata(
+        self, offset: int = 0, names: dict[str, int] | None = None
+    ) -> tuple[int, bytes]:
         if not isinstance(self.rdata, RDATA):
-            self.rdata = RDATA.factory(self.type, self.rdata)
+            self.rdata = self._rdata(self.rdata)
 
-        res = bytes(self.rdata)
+        res = self.rdata.serialize(offset, names)
         return len(res), res
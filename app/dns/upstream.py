@@ -0,0 +1,269 @@
+import itertools
+import logging
+import secrets
+import socket
+import struct
+import threading
+import time
+from app.dns.common import _Address
+from app.dns.encoding import Encoding
+from app.dns.exceptions import DNSServerFailure, FormatError
+
+logger = logging.getLogger(__name__)
+
+_ID = struct.Struct('>H')
+
+
+class Pending:
+    """An upstream query waiting for its reply"""
+
+    __slots__ = ('id', 'upstream_id', 'question', 'channel', 'event',
+                 'response')
+
+    def __init__(self, id: int, upstream_id: int, question: bytes,
+                 channel: 'Channel'):
+        #: ID of the query as sent by the client
+        self.id = id
+
+        #: ID the query was rewritten to on the upstream socket
+        self.upstream_id = upstream_id
+
+        #: Question section of the query, lower-cased
+        self.question = question
+
+        self.channel = channel
+        self.event = threading.Event()
+
+        #: The reply, with the client ID restored
+        self.response: bytes | None = None
+
+    @property
+    def done(self) -> bool:
+        return self.event.is_set()
+
+
+class Channel:
+    """One connected socket of the pool"""
+
+    __slots__ = ('sock', 'lock')
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+
+        #: Held by the thread currently reading from the socket
+        self.lock = threading.Lock()
+
+
+class UpstreamClient:
+    """
+    Forwards queries to a single upstream resolver over a small pool of
+    persistent UDP sockets.
+
+    Every query is sent with a fresh ID, unique among the queries in flight,
+    so many queries can be outstanding on one socket. Replies are matched
+    back by that ID plus the question section, then handed to the waiting
+    caller with its original ID restored.
+
+    There is no reader thread. A waiting caller reads from its socket
+    itself, and dispatches any reply it receives to whoever is waiting for
+    it.
+    """
+
+    _shared: dict[_Address, 'UpstreamClient'] = {}
+    _shared_lock = threading.Lock()
+
+    #: Longest a waiting caller reads from a socket before letting another
+    #: waiter take over
+    poll_interval: float = 0.05
+
+    def __init__(self, address: _Address, pool_size: int = 4,
+                 timeout: float = 2.0, buffer_size: int = 4096):
+        """
+        :param address: The upstream resolver as (ip, port)
+        :param int pool_size: Number of sockets to spread the queries over
+        :param float timeout: Seconds to wait for a reply
+        :param int buffer_size: Largest reply accepted from the upstream
+        """
+        self.address = address
+        self.timeout = timeout
+        self.buffer_size = buffer_size
+        self._channels: list[Channel | None] = [None] * pool_size
+        self._next = itertools.count()
+        self._pending: dict[int, Pending] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, address: _Address) -> 'UpstreamClient':
+        """
+        Client for `address` shared by every caller in the process.
+        """
+        with cls._shared_lock:
+            if address not in cls._shared:
+                cls._shared[address] = cls(address)
+            return cls._shared[address]
+
+    def query(self, data: bytes, timeout: float | None = None) -> bytes:
+        """
+        Send `data` upstream and wait for its reply.
+
+        :param bytes data: The query, as received from the client
+        :param float timeout: Seconds to wait, defaults to the client timeout
+        :rtype: bytes
+        :return: The reply, with the ID of `data`
+        :raises DNSServerFailure: If no reply arrived in time
+        """
+        pending = self.submit(data)
+        self.wait([pending], timeout)
+        if pending.response is None:
+            raise DNSServerFailure(
+                f'Upstream {self.address} did not answer in time'
+            )
+        return pending.response
+
+    def submit(self, data: bytes) -> Pending:
+        """
+        Send `data` upstream without waiting for the reply.
+
+        :param bytes data: The query, as received from the client
+        :rtype: Pending
+        """
+        (client_id,) = _ID.unpack_from(data)
+        channel = self._channel()
+
+        with self._lock:
+            if len(self._pending) > 0xffff:
+                raise DNSServerFailure('Too many upstream queries in flight')
+            # The sockets are persistent, so the source port is fixed. The
+            # ID is all a forged reply has to guess besides the question,
+            # so it comes from the OS CSPRNG.
+            upstream_id = secrets.randbits(16)
+            while upstream_id in self._pending:
+                upstream_id = secrets.randbits(16)
+
+            pending = Pending(client_id, upstream_id,
+                              self.question(data).lower(), channel)
+            self._pending[upstream_id] = pending
+
+        try:
+            channel.sock.send(_ID.pack(upstream_id) + data[2:])
+        except OSError as e:
+            self.cancel(pending)
+            raise DNSServerFailure(
+                f'Could not send to upstream {self.address}: {e}'
+            ) from e
+        return pending
+
+    def wait(self, pending: list[Pending],
+             timeout: float | None = None) -> None:
+        """
+        Wait until every query in `pending` is answered or the shared
+        deadline has passed. Queries left unanswered are cancelled.
+
+        :param pending: Queries returned by :meth:`submit`
+        :param float timeout: Seconds to wait, defaults to the client timeout
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+
+        for query in pending:
+            while not query.done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                channel = query.channel
+                if channel.lock.acquire(blocking=False):
+                    try:
+                        if not query.done:
+                            self._receive(
+                                channel, min(remaining, self.poll_interval)
+                            )
+                    finally:
+                        channel.lock.release()
+                else:
+                    query.event.wait(min(remaining, self.poll_interval))
+
+        for query in pending:
+            if not query.done:
+                logger.warning(
+                    f'Upstream query {query.id} timed out after {timeout}s'
+                )
+                self.cancel(query)
+
+    def cancel(self, pending: Pending) -> None:
+        with self._lock:
+            if self._pending.get(pending.upstream_id) is pending:
+                del self._pending[pending.upstream_id]
+
+    def close(self) -> None:
+        for channel in self._channels:
+            if channel is not None:
+                channel.sock.close()
+        self._channels = [None] * len(self._channels)
+
+    def _channel(self) -> Channel:
+        index = next(self._next) % len(self._channels)
+        channel = self._channels[index]
+        if channel is None:
+            with self._lock:
+                channel = self._channels[index]
+                if channel is None:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sock.connect(self.address)
+                    channel = Channel(sock)
+                    self._channels[index] = channel
+        return channel
+
+    def _receive(self, channel: Channel, timeout: float) -> None:
+        channel.sock.settimeout(timeout)
+        try:
+            reply = channel.sock.recv(self.buffer_size)
+        except (socket.timeout, BlockingIOError, InterruptedError):
+            return
+        except ConnectionRefusedError:
+            logger.warning(f'Upstream {self.address} refused the query')
+            return
+
+        if len(reply) < 12:
+            return
+
+        (upstream_id,) = _ID.unpack_from(reply)
+        with self._lock:
+            pending = self._pending.get(upstream_id)
+            if not self._matches(pending, channel, reply):
+                logger.warning(
+                    f'Dropping unexpected upstream reply {upstream_id}'
+                )
+                return
+            del self._pending[upstream_id]
+
+        pending.response = _ID.pack(pending.id) + reply[2:]
+        pending.event.set()
+
+    @staticmethod
+    def _matches(pending: Pending | None, channel: Channel,
+                 reply: bytes) -> bool:
+        if pending is None or pending.channel is not channel:
+            return False
+
+        end = 12 + len(pending.question)
+        return reply[12:end].lower() == pending.question
+
+    @staticmethod
+    def question(data: bytes) -> bytes:
+        """
+        The question section of a message, as sent on the wire.
+
+        :param bytes data: The message
+        :rtype: bytes
+        :raises FormatError: If the section runs past the end of `data`
+        """
+        (qdcount,) = _ID.unpack_from(data, 4)
+        i = 12
+        for _ in range(qdcount):
+            i = Encoding.skip_domain_name(data, i) + 4
+
+        if i > len(data):
+            raise FormatError('Question section exceeds the message')
+        return data[12:i]
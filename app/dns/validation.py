@@ -0,0 +1,68 @@
+"""
+Validation of whole messages against lookup tables built once at import.
+
+:func:`validate` returns the same :class:`ResponseCode` as validating the
+header and then every record in turn with their own ``validate`` methods,
+in a single pass over plain integer set lookups. Whenever a check fails
+the object's own method is called, so the error is logged as it always
+was.
+"""
+from app.dns.common import OpCode, QClass, QType, RClass, ResponseCode, \
+    RType
+from app.dns.record import BaseRecord, Query, Record, ResourceRecord
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.dns.message import Message
+
+#: OpCodes a header may carry. HeaderFlags.validate also looks the opcode up
+#: among the response codes, the table does the same.
+OPCODES = frozenset(OpCode._value2member_map_) \
+    & frozenset(ResponseCode._value2member_map_)
+
+RTYPES = frozenset(RType._value2member_map_)
+RCLASSES = frozenset(RClass._value2member_map_)
+QTYPES = RTYPES | frozenset(QType._value2member_map_)
+QCLASSES = RCLASSES | frozenset(QClass._value2member_map_)
+
+_Rule = tuple[frozenset[int], frozenset[int] | None]
+
+#: Types and classes accepted for every record class, None when the class
+#: isn't checked
+RULES: dict[type[BaseRecord], _Rule] = {
+    BaseRecord: (RTYPES, None),
+    Record: (RTYPES, RCLASSES),
+    Query: (QTYPES, QCLASSES),
+    ResourceRecord: (RTYPES, RCLASSES),
+}
+
+_SECTIONS = ('queries', 'answers', 'authorities', 'additional')
+
+
+def validate(message: 'Message') -> ResponseCode:
+    """
+    :param Message message: The message to validate
+    :rtype: ResponseCode
+    :return: The first failure found, or NO_ERROR
+    """
+    header = message.header
+    flags = header.flags
+    if flags.z != 0 or flags.opcode not in OPCODES:
+        return header.validate()
+
+    for key in _SECTIONS:
+        for record in getattr(message, key):
+            rule = RULES.get(record.__class__)
+            if rule is None:
+                # Registered record classes keep their own rules
+                res = record.validate()
+                if res != ResponseCode.NO_ERROR:
+                    return res
+                continue
+
+            types, classes = rule
+            if (record.type not in types
+               or classes is not None and record.klass not in classes):
+                return record.validate()
+
+    return ResponseCode.NO_ERROR
@@ -0,0 +1,122 @@
+import struct
+from app.dns.exceptions import FormatError
+
+_U16 = struct.Struct('!H')
+
+
+class Writer:
+    """
+    Growable buffer a message is serialized into.
+
+    The buffer is allocated once and fields are packed into it in place with
+    precompiled structs. Fields depending on what follows them, the section
+    counts and RDLENGTH, are reserved with :meth:`skip` and back-patched with
+    :meth:`pack_at` once known.
+
+    When created with a `names` table, every domain name written is
+    compressed (RFC 1035, section 4.1.4) against the names written before it.
+    """
+
+    __slots__ = ('buffer', 'length', 'base', 'names')
+
+    def __init__(self, size: int = 512, names: dict[str, int] | None = None,
+                 base: int = 0):
+        """
+        :param int size: Initial size of the buffer, doubled when exceeded
+        :param dict names: Offset of every name already written to the
+                           message, None to write names uncompressed
+        :param int base: Offset in the message the buffer starts at
+        """
+        self.buffer = bytearray(size)
+
+        #: Number of bytes written
+        self.length = 0
+
+        self.base = base
+        self.names = names
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def offset(self) -> int:
+        """Offset in the message the next byte is written at"""
+        return self.base + self.length
+
+    def getvalue(self) -> bytes:
+        with memoryview(self.buffer) as view:
+            return bytes(view[:self.length])
+
+    def skip(self, size: int) -> int:
+        """
+        Reserve `size` zeroed bytes.
+
+        :rtype: int
+        :return: Position of the reserved bytes in the buffer
+        """
+        start = self.length
+        end = start + size
+        if end > len(self.buffer):
+            grow = max(end, len(self.buffer) * 2) - len(self.buffer)
+            self.buffer.extend(bytes(grow))
+        self.length = end
+        return start
+
+    def write(self, data: bytes) -> None:
+        start = self.skip(len(data))
+        self.buffer[start:self.length] = data
+
+    def pack(self, fmt: struct.Struct, *values) -> int:
+        """
+        Append `values` packed with `fmt`.
+
+        :rtype: int
+        :return: Position of the packed values in the buffer
+        """
+        start = self.skip(fmt.size)
+        fmt.pack_into(self.buffer, start, *values)
+        return start
+
+    def pack_at(self, fmt: struct.Struct, position: int, *values) -> None:
+        """
+        Overwrite the bytes at `position` with `values` packed with `fmt`.
+        """
+        fmt.pack_into(self.buffer, position, *values)
+
+    def name(self, name: str) -> None:
+        """
+        Append a dotted domain name, its longest suffix already written
+        replaced by a pointer if compressing.
+
+        :raises FormatError: If a label is longer than 63 octets
+        """
+        name = name.rstrip('.')
+        names = self.names
+        i = 0
+        while i < len(name):
+            if names is not None:
+                pointer = names.get(name[i:])
+                if pointer is not None:
+                    self.pack(_U16, 0xc000 | pointer)
+                    return
+                # Pointers only hold 14 bits
+                if self.offset < 0x4000:
+                    names[name[i:]] = self.offset
+
+            end = name.find('.', i)
+            if end < 0:
+                end = len(name)
+
+            label = name[i:end].encode('ascii')
+            if len(label) > 63:
+                raise FormatError(
+                    f'Part \'{name[i:end]}\' of \'{name}\' exceeds limit of '
+                    '63 chars'
+                )
+
+            start = self.skip(len(label) + 1)
+            self.buffer[start] = len(label)
+            self.buffer[start + 1:self.length] = label
+            i = end + 1
+
+        self.skip(1)
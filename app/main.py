@@ -1,11 +1,25 @@
 import argparse
+import asyncio
+import selectors
 import socket
 import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
 from app.dns.message import Message
-from app.dns.exceptions import DNSError
-from app.dns.common import setUpRootLogger
+from app.dns.exceptions import DNSError, DNSServerFailure
+from app.dns.cache import AnswerCache, NegativeCache, Prefetch, RecordCache
+from app.dns.header import Header
+from app.dns.metrics import LatencyReport, Metrics, MetricsDump, \
+    MetricsServer, Timings
+from app.dns.record import Record
+from app.dns.upstream import UpstreamClient
+from app.dns.common import PACKET_LOGGER, setUpRootLogger, _Address
+from app.protocol import TCPProtocol, UDPProtocol
+from app.supervisor import Supervisor
 
-setUpRootLogger()
 logger = logging.getLogger(__name__)
 
 
@@ -13,45 +27,448 @@ class DNSServer:
     address = ('127.0.0.1', 2053)
     # address = ('0.0.0.0', 2053)
 
+    #: Server modes selectable with ``--mode``
+    modes = ('asyncio', 'sync', 'batch')
+
+    #: Size of the receive buffers, the UDP message limit from RFC 1035
+    buffer_size = 512
+
+    #: Seconds between two reports of the packets handled per wakeup in
+    #: batch mode
+    batch_report_interval = 10.0
+
+    #: Pending connections queued by the TCP listener
+    tcp_backlog = 128
+
+    #: Sampling rates of the loggers, overridden with ``--log-sample``
+    log_sample = {PACKET_LOGGER: 100}
+
     def __init__(self):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.handle_arguments()
-        self.sock.bind(self.address)
+        setUpRootLogger(
+            getattr(logging, self.arg.log_level),
+            rates={**self.log_sample, **dict(self.arg.log_sample or [])},
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.arg.concurrency,
+            thread_name_prefix='resolver',
+        )
+        self.sock: socket.socket | None = None
+        self.tcp_sock: socket.socket | None = None
+        self.tcp_connections: set[TCPProtocol] = set()
+
+        self.upstream: UpstreamClient | None = None
+        if self.resolver is not None:
+            self.upstream = UpstreamClient(
+                self.resolver,
+                pool_size=self.arg.upstream_sockets,
+                timeout=self.arg.upstream_timeout,
+            )
+
+        self.answers: AnswerCache | None = None
+        if self.upstream is not None and self.arg.answer_cache_size > 0:
+            self.answers = AnswerCache(
+                max_entries=self.arg.answer_cache_size,
+                prefetch=self._prefetch(self.prefetch_answer),
+            )
+
+        self.cache: RecordCache | None = None
+        if self.arg.cache_size > 0 or self.arg.cache_bytes is not None:
+            self.cache = RecordCache(
+                max_entries=self.arg.cache_size or None,
+                max_bytes=self.arg.cache_bytes,
+                prefetch=self._prefetch(self.prefetch_record),
+                stale_ttl=self.arg.serve_stale,
+                stale_answer_ttl=self.arg.stale_answer_ttl,
+            )
+
+        self.negative_cache: NegativeCache | None = None
+        if self.arg.negative_cache_size > 0:
+            self.negative_cache = NegativeCache(
+                max_entries=self.arg.negative_cache_size,
+                max_ttl=self.arg.negative_cache_ttl,
+            )
+
+        #: Stage latencies of the queries answered, per process
+        self.metrics = Metrics()
+
+        # Workers bind their own sockets once forked
+        if self.arg.workers < 1:
+            self.sock = self.bind()
+            if self.arg.tcp:
+                self.tcp_sock = self.listen()
+
+    def bind(self, reuse_port: bool = False) -> socket.socket:
+        """
+        Create the UDP socket and bind it to `address`.
+
+        :param bool reuse_port: Set SO_REUSEPORT, letting several processes
+                                bind the same address and the kernel spread
+                                the incoming packets between them.
+        :rtype: socket.socket
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
         logger.info(f'Listening on {self.address[0]}:{self.address[1]}')
+        return sock
+
+    def listen(self, reuse_port: bool = False) -> socket.socket:
+        """
+        Create the TCP socket, listening on the same address and port as
+        the UDP socket.
+
+        :param bool reuse_port: Set SO_REUSEPORT, see :meth:`bind`
+        :rtype: socket.socket
+        """
+        port = self.sock.getsockname()[1]
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.address[0], port))
+        sock.listen(self.tcp_backlog)
+        logger.info(f'Listening on {self.address[0]}:{port} (TCP)')
+        return sock
+
+    @property
+    def resolver(self) -> _Address | None:
+        return self.arg.resolver if 'resolver' in self.arg else None
+
+    def run(self) -> None:
+        """
+        Serve in the mode selected on the command line, either in this
+        process or in `--workers` supervised worker processes.
+        """
+        if self.arg.workers > 0:
+            Supervisor(self.work, self.arg.workers).run()
+            return
+
+        self.serve_forever()
+
+    def work(self) -> None:
+        """
+        Entry point of a worker process.
+        """
+        self.sock = self.bind(reuse_port=True)
+        if self.arg.tcp:
+            self.tcp_sock = self.listen(reuse_port=True)
+        self.serve_forever()
+
+    def serve_forever(self) -> None:
+        logger.info(f'Starting server in {self.arg.mode} mode')
+        self.start_metrics()
+        if self.arg.mode != 'asyncio' and self.tcp_sock is not None:
+            # The blocking UDP loops keep the main thread, TCP gets its own
+            # event loop next to them.
+            threading.Thread(
+                target=lambda: asyncio.run(self.serve_tcp()),
+                name='tcp', daemon=True,
+            ).start()
+
+        if self.arg.mode == 'sync':
+            self.main()
+        elif self.arg.mode == 'batch':
+            self.batch()
+        else:
+            asyncio.run(self.serve())
+
+    def start_metrics(self) -> None:
+        """
+        Start the metrics endpoint and the periodic JSON dump, as enabled on
+        the command line, and the latency report. Workers each dump their
+        own metrics, to the path suffixed with their PID, and serve no
+        endpoint as they'd share the port.
+        """
+        LatencyReport(self.metrics, self.arg.metrics_interval).start()
+
+        if self.arg.metrics_port > 0:
+            if self.arg.workers > 0:
+                logger.warning('The metrics endpoint is not served with '
+                               '--workers, use --metrics-json')
+            else:
+                MetricsServer(
+                    self.metrics, ('127.0.0.1', self.arg.metrics_port)
+                ).start()
+
+        if self.arg.metrics_json is not None:
+            path = self.arg.metrics_json
+            if self.arg.workers > 0:
+                path = f'{path}.{os.getpid()}'
+            MetricsDump(self.metrics, path,
+                        self.arg.metrics_interval).start()
 
     def main(self) -> None:
-        resolver = self.arg.resolver if 'resolver' in self.arg else None
+        """
+        Blocking loop, receiving and answering one packet at a time.
+        """
         while True:
-            buf, source = self.sock.recvfrom(512)
+            buf, source = self.sock.recvfrom(self.buffer_size)
+            received = time.perf_counter()
             if len(buf) == 0:
                 break
 
             try:
-                message: Message = Message.from_bytes(buf)
-
-                response = message.create_response(resolver=resolver)
-
-                res = response.serialize()
-                self.sock.sendto(res, source)
+                res = self.handle(buf)
+                if res is not None:
+                    self.sock.sendto(res, source)
+                    self.metrics.request.record(
+                        time.perf_counter() - received
+                    )
             except socket.timeout:
                 break
-            except DNSError as e:
-                logger.exception(e)
-                self._create_error_response(e, buf, source)
             except Exception as e:
                 logger.exception(e)
                 break
 
-    def _create_error_response(self, e: DNSError, buf: bytes,
-                               source: any) -> None:
-        from app.dns.header import Header
+    def batch(self) -> None:
+        """
+        Non-blocking loop, draining every pending packet into a pool of
+        preallocated buffers on each wakeup, then answering the whole batch.
+        """
+        pool = [memoryview(bytearray(self.buffer_size))
+                for _ in range(self.arg.buffers)]
+        limit = min(self.arg.batch_size, len(pool))
+
+        self.sock.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.sock, selectors.EVENT_READ)
+
+        wakeups = packets = largest = 0
+        reported = time.monotonic()
+        try:
+            while True:
+                selector.select()
+                handled = self._drain(pool, limit)
+
+                wakeups += 1
+                packets += handled
+                largest = max(largest, handled)
+                logger.debug(f'Handled {handled} packet(s) in this wakeup')
+
+                now = time.monotonic()
+                if now - reported >= self.batch_report_interval:
+                    logger.info(
+                        f'Handled {packets} packet(s) in {wakeups} '
+                        f'wakeup(s), {packets / wakeups:.1f} per wakeup, '
+                        f'at most {largest}'
+                    )
+                    wakeups = packets = largest = 0
+                    reported = now
+        except OSError as e:
+            logger.exception(e)
+        finally:
+            selector.close()
+
+    def _drain(self, pool: list[memoryview], limit: int) -> int:
+        """
+        Receive up to `limit` pending packets into `pool`, handle them and
+        flush the responses.
+
+        :param pool: Preallocated receive buffers, reused on every call
+        :param int limit: Maximum number of packets to receive
+        :rtype: int
+        :return: Number of packets received
+        """
+        received: list[tuple[int, _Address]] = []
+        for buf in pool[:limit]:
+            try:
+                received.append(self.sock.recvfrom_into(buf))
+            except (BlockingIOError, InterruptedError):
+                break
+        drained = time.perf_counter()
+
+        responses: list[tuple[bytes, _Address]] = []
+        for buf, (nbytes, source) in zip(pool, received):
+            if nbytes == 0:
+                continue
+            try:
+                res = self.handle(buf[:nbytes].tobytes())
+            except Exception as e:
+                logger.exception(e)
+                continue
+            if res is not None:
+                responses.append((res, source))
+
+        for res, source in responses:
+            try:
+                self.sock.sendto(res, source)
+            except (BlockingIOError, InterruptedError):
+                logger.warning(f'Send buffer full, dropped response to '
+                               f'{source}')
+                continue
+            # From the end of the drain, the queue wait isn't measured
+            self.metrics.request.record(time.perf_counter() - drained)
+
+        return len(received)
+
+    async def serve(self) -> None:
+        """
+        Asyncio loop, receiving packets while earlier queries are still
+        being resolved on the executor.
+        """
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: UDPProtocol(self), sock=self.sock
+        )
+        tcp = None
+        if self.tcp_sock is not None:
+            tcp = await loop.create_server(
+                lambda: TCPProtocol(self), sock=self.tcp_sock
+            )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            transport.close()
+            if tcp is not None:
+                tcp.close()
+
+    async def serve_tcp(self) -> None:
+        """
+        Asyncio loop serving only the TCP listener.
+        """
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: TCPProtocol(self), sock=self.tcp_sock
+        )
+        async with server:
+            await server.serve_forever()
+
+    def handle(self, buf: bytes, max_size: int = buffer_size) -> bytes | None:
+        """
+        Parse a query and build the serialized response for it.
+
+        :param bytes buf: The received packet
+        :param int max_size: Largest response the transport can carry, a
+                             larger response is truncated and flagged TC
+        :rtype: bytes | None
+        :return: The response to send back, or None if there is nothing to
+                 answer.
+        """
+        if self.answers is not None:
+            res = self.answers.get(buf)
+            if res is not None and len(res) <= max_size:
+                self.metrics.answer_cache_hits += 1
+                return res
+
+        timings = Timings()
+        try:
+            start = time.perf_counter()
+            message: Message = Message.from_bytes(buf)
+            timings.parse = time.perf_counter() - start
+
+            response = message.create_response(
+                resolver=self.upstream,
+                cache=self.cache,
+                negative_cache=self.negative_cache,
+                timings=timings,
+            )
+
+            start = time.perf_counter()
+            res = response.serialize(compress=self.arg.compression)
+            timings.serialize = time.perf_counter() - start
+            qtype = message.queries[0].type if message.queries else 0
+            self.metrics.record(qtype, response.header.flags.rcode, timings)
+            if len(res) > max_size:
+                return self._truncate(response, max_size)
+
+            if (self.answers is not None and len(response.answers) > 0
+               and response.header.flags.rcode == 0):
+                self.answers.put(buf, res)
+            return res
+        except (DNSError, DNSServerFailure) as e:
+            logger.exception(e)
+            self.metrics.error(e.rcode.value)
+            return self._create_error_response(e, buf)
+
+    def prefetch_answer(self, buf: bytes) -> None:
+        """
+        Refresh the cached response to `buf` in the background.
+        """
+        self.executor.submit(self.refresh, buf, True)
+
+    def prefetch_record(self, query: Record) -> None:
+        """
+        Refresh the cached answer to `query` in the background.
+        """
+        header = Header.empty()
+        header.flags.rd = 1
+        header.qdcount = 1
+        buf = Message(header=header, queries=[query]).serialize()
+        self.executor.submit(self.refresh, buf, False)
+
+    def refresh(self, buf: bytes, answer: bool = True) -> None:
+        """
+        Resolve `buf` upstream without consulting the caches, and cache the
+        answer.
+
+        :param bytes buf: The query
+        :param bool answer: Also cache the serialized response
+        """
+        try:
+            response = Message.from_bytes(buf).create_response(
+                resolver=self.upstream,
+                cache=self.cache,
+                negative_cache=self.negative_cache,
+                refresh=True,
+            )
+        except (DNSError, DNSServerFailure) as e:
+            logger.warning(f'Refresh ahead of expiry failed: {e}')
+            return
+
+        if (answer and self.answers is not None
+           and len(response.answers) > 0
+           and response.header.flags.rcode == 0):
+            self.answers.put(
+                buf, response.serialize(compress=self.arg.compression)
+            )
+
+    def _prefetch(self, callback: Callable[[Any], None]) -> Prefetch | None:
+        if self.upstream is None or self.arg.prefetch_hits < 1:
+            return None
+        return Prefetch(callback, hits=self.arg.prefetch_hits,
+                        window=self.arg.prefetch_window)
+
+    def _truncate(self, response: Message, max_size: int) -> bytes:
+        """
+        Drop every record section and set the TC flag, so the client retries
+        over TCP. The question section is dropped too when it alone doesn't
+        fit in `max_size`.
+        """
+        logger.info(f'Truncating response {response.header.id}')
+        response.header.flags.tc = 1
+        response.answers = []
+        response.authorities = []
+        response.additional = []
+        response.header.ancount = 0
+        response.header.nscount = 0
+        response.header.arcount = 0
+        res = response.serialize(compress=self.arg.compression)
+        if len(res) <= max_size:
+            return res
+
+        response.queries = []
+        response.header.qdcount = 0
+        return response.serialize()
+
+    def _create_error_response(self, e: DNSError | DNSServerFailure,
+                               buf: bytes) -> bytes:
         header = Header.from_bytes(buf)
+        header.flags.qr = 1
         header.flags.rcode = e.rcode.value
         header.ancount = 0
         header.nscount = 0
         header.arcount = 0
+
+        try:
+            question = UpstreamClient.question(buf)
+        except DNSError:
+            question = b''
+            header.qdcount = 0
+
         response = Message(header=header)
-        self.sock.sendto(response.serialize(), source)
+        return response.serialize() + question
 
     def handle_arguments(self):
         parser = argparse.ArgumentParser(
@@ -65,7 +482,241 @@ class DNSServer:
             required=False,
             help="The resolver address in the format <ip>:<port>",
         )
+        parser.add_argument(
+            "--upstream-sockets",
+            type=self._parse_positive,
+            default=4,
+            help="Number of persistent sockets the queries to the resolver "
+                 "are spread over (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--upstream-timeout",
+            type=float,
+            default=2.0,
+            help="Seconds to wait for the resolver to answer "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--cache-size",
+            type=int,
+            default=10000,
+            help="Maximum number of answers cached from the resolver, 0 "
+                 "for no limit or, without --cache-bytes, no cache "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--cache-bytes",
+            type=self._parse_positive,
+            default=None,
+            help="Maximum wire size in bytes of the answers cached from the "
+                 "resolver (default: no limit)",
+        )
+        parser.add_argument(
+            "--negative-cache-size",
+            type=int,
+            default=10000,
+            help="Maximum number of NXDOMAIN and NODATA answers cached from "
+                 "the resolver, 0 for none (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--negative-cache-ttl",
+            type=self._parse_positive,
+            default=10800,
+            help="Longest a negative answer is cached, in seconds "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--prefetch-hits",
+            type=int,
+            default=3,
+            help="Hits a cached answer needs before it is refreshed ahead "
+                 "of expiry, 0 to never refresh (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--prefetch-window",
+            type=float,
+            default=0.1,
+            help="Fraction of its TTL left when a cached answer is "
+                 "refreshed (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--serve-stale",
+            type=int,
+            default=86400,
+            help="Seconds an expired answer is kept to be served when the "
+                 "resolver fails (RFC 8767), 0 for never "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--stale-answer-ttl",
+            type=self._parse_positive,
+            default=30,
+            help="TTL of the answers served stale (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--answer-cache-size",
+            type=int,
+            default=10000,
+            help="Maximum number of serialized responses cached in front of "
+                 "the parser, 0 for none (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--mode",
+            choices=self.modes,
+            default='asyncio',
+            help="Server loop to use, 'sync' is the blocking one packet at "
+                 "a time loop (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=32,
+            help="Number of forwarded queries resolved concurrently by the "
+                 "asyncio and TCP listeners (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=self._parse_positive,
+            default=64,
+            help="Maximum number of packets handled per wakeup in batch "
+                 "mode (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--buffers",
+            type=self._parse_positive,
+            default=None,
+            help="Number of preallocated receive buffers in batch mode "
+                 "(default: the batch size)",
+        )
+        parser.add_argument(
+            "--compression",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Compress the domain names of the responses "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--tcp",
+            action=argparse.BooleanOptionalAction,
+            default=True,
+            help="Also answer queries over TCP on the same port "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--tcp-idle-timeout",
+            type=float,
+            default=10.0,
+            help="Seconds before an idle TCP connection is closed "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--tcp-max-connections",
+            type=self._parse_positive,
+            default=128,
+            help="Maximum number of concurrent TCP connections "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--workers",
+            type=self._parse_workers,
+            default=0,
+            help="Fork this many worker processes, each with its own "
+                 "SO_REUSEPORT socket, and restart any that die "
+                 "(default: serve from a single process)",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=0,
+            help="Serve the stage latencies in the Prometheus text format on "
+                 "http://127.0.0.1:PORT/metrics, 0 to disable "
+                 "(default: %(default)s)",
+        )
+        parser.add_argument(
+            "--metrics-json",
+            metavar="PATH",
+            help="Dump the stage latencies as JSON to PATH periodically",
+        )
+        parser.add_argument(
+            "--metrics-interval",
+            type=float,
+            default=60.0,
+            help="Seconds between two JSON dumps, and between two reports "
+                 "of the latency percentiles, which start over every "
+                 "interval (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--log-level",
+            type=str.upper,
+            choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+            default='INFO',
+            help="Lowest level of the messages logged (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--log-sample",
+            type=self._parse_sample,
+            action='append',
+            metavar='LOGGER=N',
+            help="Log one in every N messages below WARNING of LOGGER and "
+                 "its children, 0 to drop them all. May be repeated. The "
+                 "DEBUG messages logged for every packet go to "
+                 f"'{PACKET_LOGGER}' "
+                 f"(default: {PACKET_LOGGER}="
+                 f"{self.log_sample[PACKET_LOGGER]})",
+        )
         self.arg = parser.parse_args()
+        if self.arg.buffers is None:
+            self.arg.buffers = self.arg.batch_size
+
+    def _parse_positive(self, value: str) -> int:
+        try:
+            number = int(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"Value must be an integer. Received: '{value}'"
+            )
+
+        if number < 1:
+            raise argparse.ArgumentTypeError(
+                f"Value must be at least 1. Received: '{value}'"
+            )
+
+        return number
+
+    def _parse_sample(self, value: str) -> tuple[str, int]:
+        name, _, rate = value.rpartition('=')
+        try:
+            number = int(rate)
+        except ValueError:
+            number = -1
+
+        if not name or number < 0:
+            raise argparse.ArgumentTypeError(
+                "Sampling must be in the format 'logger=N', N at least 0. "
+                f"Received: '{value}'"
+            )
+
+        return name, number
+
+    def _parse_workers(self, workers: str) -> int:
+        try:
+            value = int(workers)
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                f"Workers must be an integer. Received: '{workers}'"
+            )
+
+        if value < 0:
+            raise argparse.ArgumentTypeError(
+                f"Workers can't be negative. Received: '{workers}'"
+            )
+
+        if value > 0 and not hasattr(socket, 'SO_REUSEPORT'):
+            raise argparse.ArgumentTypeError(
+                "Workers require SO_REUSEPORT, which this platform lacks"
+            )
+
+        return value
 
     def _parse_address(self, address: str) -> tuple[str, int]:
         """
@@ -95,4 +746,4 @@ class DNSServer:
 
 if __name__ == "__main__":
     dns = DNSServer()
-    dns.main()
+    dns.run()
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import struct
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from app.main import DNSServer
+
+logger = logging.getLogger(__name__)
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    """
+    Asyncio datagram protocol handing every received packet to
+    :meth:`DNSServer.handle`.
+
+    Without a resolver the response is built inline, as the stub lookup never
+    blocks. In forwarder mode the packet is resolved on the server executor so
+    the event loop keeps receiving while earlier queries wait on the upstream.
+    """
+
+    def __init__(self, server: 'DNSServer'):
+        self.server = server
+        self.transport: asyncio.DatagramTransport | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = transport
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if exc is not None:
+            logger.exception(exc)
+        self.transport = None
+
+    def error_received(self, exc: Exception) -> None:
+        logger.warning(exc)
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        received = time.perf_counter()
+        if len(data) == 0:
+            return
+
+        if self.server.resolver is None:
+            try:
+                self.respond(self.server.handle(data), addr, received)
+            except Exception as e:
+                logger.exception(e)
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.server.executor, self.server.handle, data
+        )
+        future.add_done_callback(lambda f: self._resolved(f, addr, received))
+
+    def _resolved(self, future: asyncio.Future, addr: tuple[str, int],
+                  received: float) -> None:
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            # Not in an except block, the traceback is the worker thread's
+            logger.error(exc, exc_info=exc)
+            return
+
+        self.respond(future.result(), addr, received)
+
+    def respond(self, data: bytes | None, addr: tuple[str, int],
+                received: float | None = None) -> None:
+        """
+        :param float received: When the query was received, by
+                               :func:`time.perf_counter`, to record the
+                               request latency
+        """
+        if data is None or self.transport is None:
+            return
+        self.transport.sendto(data, addr)
+        if received is not None:
+            self.server.metrics.request.record(time.perf_counter() - received)
+
+
+class TCPProtocol(asyncio.Protocol):
+    """
+    Asyncio stream protocol for DNS over TCP (RFC 7766).
+
+    Every message is prefixed with its 2 byte length. Connections are kept
+    open for further queries, pipelined queries are resolved concurrently
+    and answered in the order they complete, and a connection with nothing
+    in flight is closed once it has been idle for the server's timeout.
+    """
+
+    #: Length prefix of every message on the stream
+    prefix = struct.Struct('>H')
+
+    #: Largest message the length prefix can describe
+    max_size: int = 0xffff
+
+    #: Reading is paused while this many queries of a single connection are
+    #: still being resolved
+    max_pipelined: int = 32
+
+    def __init__(self, server: 'DNSServer'):
+        self.server = server
+        self.transport: asyncio.Transport | None = None
+        self.buffer = bytearray()
+        self.pending = 0
+        self.paused = False
+        self.idle: asyncio.TimerHandle | None = None
+        self.active = 0.0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        connections = self.server.tcp_connections
+        if len(connections) >= self.server.arg.tcp_max_connections:
+            logger.warning(
+                f'Refusing TCP connection, {len(connections)} already open'
+            )
+            transport.abort()
+            return
+
+        self.transport = transport
+        connections.add(self)
+        self._touch()
+        self._arm(self.server.arg.tcp_idle_timeout)
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if exc is not None:
+            logger.warning(exc)
+        if self.idle is not None:
+            self.idle.cancel()
+        self.server.tcp_connections.discard(self)
+        self.transport = None
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        self._touch()
+
+        while len(self.buffer) >= self.prefix.size:
+            (length,) = self.prefix.unpack_from(self.buffer)
+            end = self.prefix.size + length
+            if len(self.buffer) < end:
+                break
+
+            if length == 0:
+                logger.warning('Closing TCP connection on empty message')
+                self.transport.close()
+                return
+
+            frame = bytes(self.buffer[self.prefix.size:end])
+            del self.buffer[:end]
+            self.dispatch(frame)
+
+    def dispatch(self, frame: bytes) -> None:
+        if self.server.resolver is None:
+            try:
+                self.respond(self.server.handle(frame, self.max_size))
+            except Exception as e:
+                logger.exception(e)
+            return
+
+        self.pending += 1
+        if self.pending >= self.max_pipelined and not self.paused:
+            self.transport.pause_reading()
+            self.paused = True
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.server.executor, self.server.handle, frame, self.max_size
+        )
+        future.add_done_callback(self._resolved)
+
+    def _resolved(self, future: asyncio.Future) -> None:
+        self.pending -= 1
+        if self.paused and self.transport is not None:
+            self.transport.resume_reading()
+            self.paused = False
+
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            # Not in an except block, the traceback is the worker thread's
+            logger.error(exc, exc_info=exc)
+            return
+
+        self.respond(future.result())
+
+    def respond(self, data: bytes | None) -> None:
+        if data is None or self.transport is None:
+            return
+        self.transport.write(self.prefix.pack(len(data)) + data)
+        self._touch()
+
+    def _touch(self) -> None:
+        self.active = asyncio.get_running_loop().time()
+
+    def _arm(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        self.idle = loop.call_later(delay, self._expire)
+
+    def _expire(self) -> None:
+        self.idle = None
+        if self.transport is None:
+            return
+
+        timeout = self.server.arg.tcp_idle_timeout
+        idle = asyncio.get_running_loop().time() - self.active
+        if self.pending > 0:
+            self._arm(timeout)
+            return
+
+        if idle < timeout:
+            self._arm(timeout - idle)
+            return
+
+        logger.info('Closing idle TCP connection')
+        self.transport.close()
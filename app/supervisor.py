@@ -0,0 +1,95 @@
+import os
+import signal
+import time
+import logging
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """
+    Forks a fixed number of worker processes and restarts any worker that
+    dies, until the supervisor itself is asked to stop.
+    """
+
+    #: Workers exiting faster than this (in seconds) are restarted after
+    #: `restart_delay`, so a crashing worker can't turn into a fork loop.
+    min_uptime: float = 1.0
+
+    def __init__(self, target: Callable[[], None], workers: int,
+                 restart_delay: float = 1.0):
+        """
+        :param target: Callable run in each worker process
+        :param int workers: Number of worker processes to keep alive
+        :param float restart_delay: Seconds to wait before restarting a
+                                    worker that died right after starting
+        """
+        if workers < 1:
+            raise ValueError(f'At least one worker is required, got {workers}')
+
+        self.target = target
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.children: dict[int, float] = {}
+        self.stopping = False
+
+    def run(self) -> None:
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for _ in range(self.workers):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            started = self.children.pop(pid, None)
+            if started is None:
+                continue
+
+            if self.stopping:
+                continue
+
+            logger.warning(
+                f'Worker {pid} exited with status '
+                f'{os.waitstatus_to_exitcode(status)}, restarting'
+            )
+            if time.monotonic() - started < self.min_uptime:
+                time.sleep(self.restart_delay)
+                # Asked to stop while backing off
+                if self.stopping:
+                    continue
+            self.spawn()
+
+        logger.info('All workers stopped')
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.target()
+            except BaseException as e:
+                logger.exception(e)
+                code = 1
+            finally:
+                os._exit(code)
+
+        logger.info(f'Started worker {pid}')
+        self.children[pid] = time.monotonic()
+        return pid
+
+    def _stop(self, signum: int, frame) -> None:
+        logger.info(f'Stopping {len(self.children)} worker(s)')
+        self.stopping = True
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -25,15 +25,23 @@ if TYPE_CHECKING:
 # Mock socket module
 _defaulttimeout: float | None = None
 _reply_data = None
+_reply_echo_id = False
 
 # This is used to queue up data to be read through socket.makefile, typically
 # *before* the socket object is even created. It is intended to handle a single
 # line which the socket will feed on recv() or makefile().
 
 
-def reply_with(line):
-    global _reply_data
+def reply_with(line, echo_id: bool = False):
+    """
+    :param line: Data the next socket receives
+    :param bool echo_id: Replace the first two bytes of `line` with those of
+                         the last data sent, like a DNS server answering with
+                         the ID of the query.
+    """
+    global _reply_data, _reply_echo_id
     _reply_data = line
+    _reply_echo_id = echo_id
 
 
 class MockFile:
@@ -66,7 +74,7 @@ class MockSocket:
 
     def __init__(self, family: int = None, type: int = None,
                  proto: int = None, fileno: _FD = None) -> None:
-        global _reply_data
+        global _reply_data, _reply_echo_id
         if fileno is None:
             if family is None:
                 family = AF_INET
@@ -82,9 +90,12 @@ class MockSocket:
         self.last: WriteableBuffer | None = None
         self.output = []
         self.lines = []
+        self.echo_id = False
         if _reply_data:
             self.lines.append(_reply_data)
+            self.echo_id = _reply_echo_id
             _reply_data = None
+            _reply_echo_id = False
         self.conn = None
         self.timeout = None
 
@@ -104,6 +115,8 @@ class MockSocket:
         data = self.lines.pop(0)
         if not isinstance(data, bytes):
             data = bytes(data)
+        if self.echo_id and self.last is not None:
+            data = bytes(self.last[:2]) + data[2:]
         data += b'\r\n'
         return data
 
@@ -166,7 +179,7 @@ class MockSocket:
         pass
 
     def setsockopt(self, level: int, optname: int, value: None,
-                   optlen: int) -> None:
+                   optlen: int = None) -> None:
         pass
 
     @overload
@@ -0,0 +1,427 @@
+import socket
+import struct
+import threading
+import unittest
+from tests.common import TestDNS
+from tests.messages import test_messages
+from app.dns.cache import AnswerCache, NegativeCache, Prefetch, \
+    RecordCache
+from app.dns.common import RClass, ResponseCode, RType
+from app.dns.exceptions import DNSServerFailure
+from app.dns.message import Message
+from app.dns.rdata import RDATA
+from app.dns.record import Query, ResourceRecord
+from app.dns.upstream import UpstreamClient
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestDNSCache(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock = Clock()
+
+    def record(self, name: str, ttl: int = 60,
+               rdata: str = '1.2.3.4') -> ResourceRecord:
+        return ResourceRecord(name=name, type=RType.A, klass=RClass.IN,
+                              ttl=ttl, rdlength=4, rdata=rdata)
+
+    def query(self, name: str) -> Query:
+        return Query(name=name, type=RType.A, klass=RClass.IN)
+
+    def test_ttl_countdown(self) -> None:
+        cache = RecordCache(clock=self.clock)
+        cache.put(self.query('google.com'), [
+            self.record('google.com', ttl=60),
+            self.record('google.com', ttl=300, rdata='5.6.7.8'),
+        ])
+
+        self.clock.now += 20.5
+        records = cache.get(self.query('Google.COM.'))
+
+        self.assertEqual([r.ttl for r in records], [40, 280])
+        self.assertEqual([r.rdata.data for r in records],
+                         ['1.2.3.4', '5.6.7.8'])
+        self.assertEqual(cache.hits, 1)
+
+        # Expires with the shortest TTL
+        self.clock.now += 40
+        self.assertIsNone(cache.get(self.query('google.com')))
+        self.assertEqual(cache.expirations, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_copies(self) -> None:
+        cache = RecordCache(clock=self.clock)
+        cache.put(self.query('google.com'), [self.record('google.com')])
+
+        records = cache.get(self.query('google.com'))
+        records[0].ttl = 0
+
+        self.assertEqual(cache.get(self.query('google.com'))[0].ttl, 60)
+
+    def test_lru_entries(self) -> None:
+        cache = RecordCache(max_entries=2, clock=self.clock)
+        for name in ['a.com', 'b.com']:
+            cache.put(self.query(name), [self.record(name)])
+
+        cache.get(self.query('a.com'))
+        cache.put(self.query('c.com'), [self.record('c.com')])
+
+        self.assertIsNone(cache.get(self.query('b.com')))
+        self.assertIsNotNone(cache.get(self.query('a.com')))
+        self.assertIsNotNone(cache.get(self.query('c.com')))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_lru_bytes(self) -> None:
+        size = len(self.record('a.com'))
+        cache = RecordCache(max_entries=None, max_bytes=size * 2,
+                            clock=self.clock)
+        for name in ['a.com', 'b.com', 'c.com']:
+            cache.put(self.query(name), [self.record(name)])
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, size * 2)
+        self.assertIsNone(cache.get(self.query('a.com')))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_not_cached(self) -> None:
+        cache = RecordCache(clock=self.clock)
+        cache.put(self.query('a.com'), [])
+        cache.put(self.query('b.com'), [self.record('b.com', ttl=0)])
+
+        self.assertEqual(len(cache), 0)
+
+    def test_create_response(self) -> None:
+        message = Message.from_bytes(test_messages[0][1])
+        query = message.queries[0]
+        cache = RecordCache(clock=self.clock)
+        cache.put(query, [self.record(query.name, rdata='9.9.9.9')])
+
+        # Nothing listens there, a lookup would fail the response
+        resolver = UpstreamClient(('127.0.0.1', 9), timeout=0.1)
+        try:
+            response = message.create_response(resolver=resolver,
+                                               cache=cache)
+        finally:
+            resolver.close()
+
+        self.assertEqual(response.header.ancount, 1)
+        self.assertEqual(response.answers[0].rdata.data, '9.9.9.9')
+        self.assertEqual(cache.hits, 1)
+
+    def test_prefetch(self) -> None:
+        refreshed = []
+        cache = RecordCache(clock=self.clock,
+                            prefetch=Prefetch(refreshed.append, hits=2,
+                                              window=0.5))
+        cache.put(self.query('a.com'), [self.record('a.com', ttl=60)])
+
+        # Popular but not close to expiry yet
+        cache.get(self.query('a.com'))
+        cache.get(self.query('a.com'))
+        self.assertEqual(refreshed, [])
+
+        self.clock.now += 35
+        cache.get(self.query('a.com'))
+        cache.get(self.query('a.com'))
+
+        self.assertEqual([q.name for q in refreshed], ['a.com'])
+        self.assertEqual(cache.stats()['prefetches'], 1)
+
+        # A fresh answer can be refreshed again
+        cache.put(self.query('a.com'), [self.record('a.com', ttl=60)])
+        self.clock.now += 35
+        cache.get(self.query('a.com'))
+        cache.get(self.query('a.com'))
+        self.assertEqual(len(refreshed), 2)
+
+    def test_stale(self) -> None:
+        cache = RecordCache(clock=self.clock, stale_ttl=100)
+        cache.put(self.query('a.com'), [self.record('a.com', ttl=60)])
+
+        self.clock.now += 70
+        self.assertIsNone(cache.get(self.query('a.com')))
+        self.assertEqual(len(cache), 1)
+
+        records = cache.get_stale(self.query('a.com'))
+        self.assertEqual([r.ttl for r in records], [30])
+        self.assertEqual(cache.stale, 1)
+
+        self.clock.now += 100
+        self.assertIsNone(cache.get_stale(self.query('a.com')))
+        self.assertIsNone(cache.get(self.query('a.com')))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.expirations, 1)
+
+    def test_create_response_stale(self) -> None:
+        message = Message.from_bytes(test_messages[0][1])
+        query = message.queries[0]
+        cache = RecordCache(clock=self.clock, stale_ttl=100)
+        cache.put(query, [self.record(query.name, rdata='9.9.9.9')])
+        self.clock.now += 90
+
+        resolver = UpstreamClient(('127.0.0.1', 9), timeout=0.1)
+        try:
+            response = message.create_response(resolver=resolver,
+                                               cache=cache)
+        finally:
+            resolver.close()
+
+        self.assertEqual(response.header.flags.rcode, 0)
+        self.assertEqual(response.answers[0].rdata.data, '9.9.9.9')
+        self.assertEqual(response.answers[0].ttl, 30)
+        self.assertEqual(cache.stale, 1)
+
+    def test_malformed_reply(self) -> None:
+        message = Message.from_bytes(test_messages[0][1])
+        query = message.queries[0]
+
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream.bind(('127.0.0.1', 0))
+        upstream.settimeout(5)
+        self.addCleanup(upstream.close)
+        resolver = UpstreamClient(upstream.getsockname(), timeout=1)
+        self.addCleanup(resolver.close)
+
+        def resolve() -> None:
+            data, source = upstream.recvfrom(512)
+            reply = Message.from_bytes(data).create_response().serialize()
+            # RDLENGTH 40, with only the 4 bytes of the address following
+            upstream.sendto(reply[:-6] + b'\x00\x28' + reply[-4:], source)
+
+        def forward(cache: RecordCache) -> Message:
+            thread = threading.Thread(target=resolve)
+            thread.start()
+            try:
+                return message.create_response(resolver=resolver,
+                                               cache=cache)
+            finally:
+                thread.join()
+
+        # A SERVFAIL to the client, not a FORMERR blaming its query
+        cache = RecordCache(clock=self.clock, stale_ttl=100)
+        with self.assertLogs(level='WARNING'):
+            with self.assertRaises(DNSServerFailure):
+                forward(cache)
+
+        cache.put(query, [self.record(query.name, rdata='9.9.9.9')])
+        self.clock.now += 90
+        with self.assertLogs(level='WARNING'):
+            response = forward(cache)
+
+        self.assertEqual(response.header.flags.rcode, 0)
+        self.assertEqual(response.answers[0].rdata.data, '9.9.9.9')
+        self.assertEqual(cache.stale, 1)
+
+
+class TestDNSNegativeCache(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock = Clock()
+
+    def soa(self, ttl: int = 3600, minimum: int = 300) -> ResourceRecord:
+        record = ResourceRecord(name='com', type=RType.SOA, klass=RClass.IN,
+                                ttl=ttl, rdlength=0, rdata=None)
+        record.rdata = RDATA.factory(
+            RType.SOA.value, mname='a.gtld-servers.net',
+            rname='nstld.verisign-grs.com', serial=1, refresh=1800,
+            retry=900, expire=604800, minimum=minimum,
+        )
+        return record
+
+    def query(self, name: str) -> Query:
+        return Query(name=name, type=RType.A, klass=RClass.IN)
+
+    def reply(self, data: bytes, soa: ResourceRecord) -> bytes:
+        """
+        NXDOMAIN reply to `data` with `soa` as its authority section.
+        """
+        flags = 0x8000 | (data[2] & 0x01) << 8 | ResponseCode.NAME_ERROR.value
+        return (data[:2] + struct.pack('>HHHHH', flags, 1, 0, 1, 0)
+                + data[12:] + bytes(soa))
+
+    def test_soa_ttl(self) -> None:
+        cache = NegativeCache(clock=self.clock)
+        cache.put(self.query('nope.com'), ResponseCode.NAME_ERROR.value,
+                  [self.soa(ttl=3600, minimum=300)])
+
+        self.clock.now += 100
+        rcode, authorities = cache.get(self.query('NOPE.com.'))
+
+        self.assertEqual(rcode, ResponseCode.NAME_ERROR.value)
+        self.assertEqual([r.ttl for r in authorities], [200])
+        self.assertEqual(authorities[0].rdata.minimum, 300)
+        self.assertEqual(cache.nxdomain, 1)
+
+        self.clock.now += 200
+        self.assertIsNone(cache.get(self.query('nope.com')))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_nodata(self) -> None:
+        cache = NegativeCache(clock=self.clock)
+        cache.put(self.query('a.com'), ResponseCode.NO_ERROR.value,
+                  [self.soa(ttl=60, minimum=300)])
+
+        rcode, authorities = cache.get(self.query('a.com'))
+
+        self.assertEqual(rcode, ResponseCode.NO_ERROR.value)
+        self.assertEqual(authorities[0].ttl, 60)
+        self.assertEqual(cache.nodata, 1)
+
+    def test_max_ttl(self) -> None:
+        cache = NegativeCache(max_ttl=30, clock=self.clock)
+        cache.put(self.query('a.com'), ResponseCode.NAME_ERROR.value,
+                  [self.soa()])
+
+        self.assertEqual(cache.get(self.query('a.com'))[1][0].ttl, 30)
+
+    def test_without_soa(self) -> None:
+        cache = NegativeCache(clock=self.clock)
+        cache.put(self.query('a.com'), ResponseCode.NAME_ERROR.value, [])
+
+        self.assertEqual(len(cache), 0)
+
+    def test_forward(self) -> None:
+        message = Message.from_bytes(test_messages[0][1])
+        cache = NegativeCache(clock=self.clock)
+
+        upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream.bind(('127.0.0.1', 0))
+        upstream.settimeout(5)
+        resolver = UpstreamClient(upstream.getsockname(), timeout=1)
+
+        def resolve() -> None:
+            data, source = upstream.recvfrom(512)
+            upstream.sendto(self.reply(data, self.soa()), source)
+
+        thread = threading.Thread(target=resolve)
+        thread.start()
+        try:
+            first = message.create_response(resolver=resolver,
+                                            negative_cache=cache)
+        finally:
+            thread.join()
+            upstream.close()
+
+        # Nothing listens anymore, the answer must come from the cache
+        self.clock.now += 10
+        try:
+            second = message.create_response(resolver=resolver,
+                                             negative_cache=cache)
+        finally:
+            resolver.close()
+
+        # Passed on as received first, counted down from the negative TTL
+        # afterwards
+        for response, ttl in [(first, 3600), (second, 290)]:
+            with self.subTest(ttl=ttl):
+                self.assertEqual(response.header.flags.rcode,
+                                 ResponseCode.NAME_ERROR.value)
+                self.assertEqual(response.header.ancount, 0)
+                self.assertEqual(response.header.nscount, 1)
+                self.assertEqual(response.authorities[0].ttl, ttl)
+
+        res = Message.from_bytes(second.serialize())
+        self.assertEqual(res.authorities[0].rdata.mname,
+                         'a.gtld-servers.net')
+        self.assertEqual(cache.hits, 1)
+
+
+class TestDNSAnswerCache(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.clock = Clock()
+
+    def response(self, data: bytes) -> bytes:
+        return Message.from_bytes(data).create_response().serialize()
+
+    def test_ttls(self) -> None:
+        data = test_messages[-1][1]
+        response = Message.from_bytes(data).create_response()
+        res = response.serialize()
+
+        ttls = AnswerCache.ttls(res)
+
+        self.assertEqual([ttl for _, ttl in ttls],
+                         [a.ttl for a in response.answers])
+        for offset, ttl in ttls:
+            self.assertEqual(int.from_bytes(res[offset:offset + 4], 'big'),
+                             ttl)
+
+    def test_patching(self) -> None:
+        data = test_messages[0][1]
+        res = self.response(data)
+        offset, ttl = AnswerCache.ttls(res)[0]
+
+        cache = AnswerCache(clock=self.clock)
+        cache.put(data, res)
+        self.assertEqual(cache.get(data), res)
+
+        # Other ID, RD cleared
+        query = b'\x12\x34' + bytes([data[2] & 0xfe]) + data[3:]
+        self.clock.now += 10
+        hit = cache.get(query)
+
+        self.assertEqual(len(hit), len(res))
+        self.assertEqual(hit[:2], b'\x12\x34')
+        self.assertEqual(hit[2] & 0x01, 0)
+        self.assertEqual(hit[3:offset], res[3:offset])
+        self.assertEqual(hit[offset + 4:], res[offset + 4:])
+
+        message = Message.from_bytes(hit)
+        self.assertEqual(message.header.id, 0x1234)
+        self.assertEqual(message.header.flags.qr, 1)
+        self.assertEqual(message.header.flags.rd, 0)
+        self.assertEqual(message.answers[0].ttl, ttl - 10)
+        self.assertEqual(cache.hits, 2)
+
+    def test_expiry(self) -> None:
+        data = test_messages[0][1]
+        res = self.response(data)
+        ttl = AnswerCache.ttls(res)[0][1]
+
+        cache = AnswerCache(clock=self.clock)
+        cache.put(data, res)
+        self.clock.now += ttl
+
+        self.assertIsNone(cache.get(data))
+        self.assertEqual(cache.expirations, 1)
+
+    def test_prefetch(self) -> None:
+        data = test_messages[0][1]
+        res = self.response(data)
+        ttl = AnswerCache.ttls(res)[0][1]
+
+        refreshed = []
+        cache = AnswerCache(clock=self.clock,
+                            prefetch=Prefetch(refreshed.append, hits=1))
+        cache.put(data, res)
+
+        cache.get(data)
+        self.clock.now += ttl - 1
+        cache.get(data)
+        cache.get(data)
+
+        self.assertEqual(refreshed, [data])
+        self.assertEqual(cache.stats()['prefetches'], 1)
+
+    def test_lru(self) -> None:
+        cache = AnswerCache(max_entries=1, clock=self.clock)
+        first, second = test_messages[0][1], test_messages[1][1]
+        cache.put(first, self.response(first))
+        cache.put(second, self.response(second))
+
+        self.assertIsNone(cache.get(first))
+        self.assertIsNotNone(cache.get(second))
+        self.assertEqual(cache.evictions, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
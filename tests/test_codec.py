@@ -0,0 +1,93 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+import unittest
+import unittest.mock
+from tests.common import TestDNS
+from app.bench import codec
+
+
+class TestDNSCodec(TestDNS):
+    baseline = {'results': {'fast': 1e-6, 'slow': 2e-6}}
+
+    def results(self, fast: float, slow: float) -> dict:
+        return {'results': {'fast': fast, 'slow': slow, 'new': 3e-6}}
+
+    def test_compare(self) -> None:
+        for results, regressions in (
+            (self.results(1e-6, 2e-6), []),
+            (self.results(1.09e-6, 1e-6), []),
+            (self.results(1.2e-6, 2e-6), ['fast']),
+            (self.results(1.2e-6, 4e-6), ['fast', 'slow']),
+        ):
+            with self.subTest(results=results['results']):
+                with contextlib.redirect_stdout(io.StringIO()) as out:
+                    res = codec.compare(self.baseline, results, 0.1)
+
+                self.assertEqual(res, regressions)
+                lines = out.getvalue().splitlines()
+                self.assertEqual(len(lines), 4)
+                self.assertEqual(sum('REGRESSION' in line for line in lines),
+                                 len(regressions))
+
+    def main(self, *argv: str) -> int:
+        """
+        :return: Exit status of the compare command
+        """
+        with unittest.mock.patch('sys.argv', ['codec.py', *argv]), \
+                contextlib.redirect_stdout(io.StringIO()):
+            try:
+                codec.main()
+            except SystemExit as e:
+                return e.code
+        return 0
+
+    def test_compare_exit(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            baseline = os.path.join(tmp, 'baseline.json')
+            results = os.path.join(tmp, 'results.json')
+            with open(baseline, 'w') as f:
+                json.dump(self.baseline, f)
+
+            for slow, threshold, status in (
+                (2.1e-6, '0.1', 0),
+                (2.5e-6, '0.1', 1),
+                (2.5e-6, '0.3', 0),
+            ):
+                with self.subTest(slow=slow, threshold=threshold):
+                    with open(results, 'w') as f:
+                        json.dump(self.results(1e-6, slow), f)
+
+                    self.assertEqual(self.main('compare', baseline, results,
+                                               '--threshold', threshold),
+                                     status)
+
+    def test_run(self) -> None:
+        # run lowers the root logger to WARNING
+        root = logging.getLogger()
+        self.addCleanup(root.setLevel, root.level)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'results.json')
+
+            def measure(func, repeat: int) -> float:
+                # Every case is called once, not timed
+                func()
+                return 1e-6
+
+            with unittest.mock.patch('app.bench.codec.measure', measure):
+                self.assertEqual(self.main('run', '--output', path), 0)
+                self.assertEqual(self.main('run', '--baseline', path), 0)
+
+            with open(path) as f:
+                results = json.load(f)
+
+        self.assertEqual(list(results['results']), list(codec.cases()))
+        self.assertEqual(set(results['results'].values()), {1e-6})
+
+
+if __name__ == "__main__":
+    unittest.main()
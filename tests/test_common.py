@@ -0,0 +1,93 @@
+import io
+import logging
+import unittest
+from tests.common import TestDNS
+from app.dns.common import LogPipeline, SamplingFilter, Tracer
+
+
+class Formatted:
+    """Counts how many times it was formatted"""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def __repr__(self) -> str:
+        self.count += 1
+        return 'formatted'
+
+    __str__ = __repr__
+
+
+class TestDNSCommon(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.logger = logging.getLogger('tests.trace')
+        self.trace = Tracer(self.logger, 'Site.method')
+
+    def test_tracer_disabled(self) -> None:
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+        value = Formatted()
+
+        self.assertFalse(self.trace.enabled)
+        self.trace(value=value, data=b'\x00' * 64)
+
+        self.assertEqual(value.count, 0)
+
+    def test_tracer_enabled(self) -> None:
+        value = Formatted()
+
+        with self.assertLogs(self.logger, logging.DEBUG) as logs:
+            self.assertTrue(self.trace.enabled)
+            self.trace('RR', value=value, data=b'\x01\x02')
+
+        self.assertEqual(value.count, 1)
+        self.assertEqual(logs.records[0].getMessage(), (
+            'Site.method: RR, \n[Formatted] value: formatted'
+            '\n[bytes] data: (2 bytes)\n\\x01\\x02\n'
+        ))
+
+    def test_sampling(self) -> None:
+        sampling = SamplingFilter({'packet': 3, 'packet.quiet': 0})
+
+        def passed(name: str, level: int = logging.INFO) -> int:
+            record = logging.LogRecord(name, level, __file__, 0, 'msg', None,
+                                       None)
+            return sum(sampling.filter(record) for _ in range(9))
+
+        self.assertEqual(passed('packet.app.dns.message'), 3)
+        self.assertEqual(passed('packet.quiet.app'), 0)
+        self.assertEqual(passed('packet.quiet', logging.WARNING), 9)
+        self.assertEqual(passed('app.main'), 9)
+        self.assertEqual(sampling.dropped, 15)
+
+    def test_pipeline(self) -> None:
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        pipeline = LogPipeline(handler, rates={'tests.trace': 2})
+        pipeline.start()
+        self.addCleanup(pipeline.stop)
+
+        self.logger.addHandler(pipeline.handler)
+        self.addCleanup(self.logger.removeHandler, pipeline.handler)
+        self.logger.propagate = False
+        self.addCleanup(setattr, self.logger, 'propagate', True)
+        self.logger.setLevel(logging.INFO)
+        self.addCleanup(self.logger.setLevel, logging.NOTSET)
+
+        values = [1]
+        for i in range(4):
+            self.logger.warning('Values %s', values)
+            self.logger.info('Packet %d', i)
+        # The arguments were merged before the record was queued
+        values.append(2)
+        pipeline.stop()
+
+        self.assertEqual(stream.getvalue().splitlines(), [
+            'Values [1]', 'Packet 0', 'Values [1]',
+            'Values [1]', 'Packet 2', 'Values [1]',
+        ])
+
+
+if __name__ == "__main__":
+    unittest.main()
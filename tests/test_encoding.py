@@ -1,6 +1,7 @@
 import unittest
 from tests.common import TestDNS
 from app.dns.encoding import Encoding
+from app.dns.exceptions import FormatError
 
 
 class TestDNSEncoding(TestDNS):
@@ -18,6 +19,35 @@ class TestDNSEncoding(TestDNS):
 
                 self.assertEqual(actual, testdata.name)
 
+    def test_decoder_pointer(self) -> None:
+        data = b'\x06google\x03com\x00\x03www\xc0\x00\xc0\x0c'
+        names = {}
+
+        self.assertEqual(Encoding.decode_domain_name(data, 12, names),
+                         ('www.google.com', 18))
+        self.assertEqual(names, {0: 'google.com', 7: 'com',
+                                 12: 'www.google.com'})
+
+        # Answered from the names decoded so far
+        names[12] = 'cached.example'
+        self.assertEqual(Encoding.decode_domain_name(data, 18, names),
+                         ('cached.example', 20))
+
+    def test_decoder_limits(self) -> None:
+        label = b'\x3f' + b'a' * 63
+        sources = {
+            'pointer loop': b'\xc0\x02\xc0\x00',
+            'self pointer': b'\xc0\x00',
+            'too long': label * 4 + b'\x00',
+            'truncated label': b'\x06goo',
+            'truncated pointer': b'\x03www\xc0',
+            'no terminator': b'\x03www',
+        }
+        for source, data in sources.items():
+            with self.subTest(source=source):
+                with self.assertRaises(FormatError):
+                    Encoding.decode_domain_name(data, 0, {})
+
 
 if __name__ == "__main__":
     unittest.main()
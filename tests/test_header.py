@@ -1,3 +1,4 @@
+import copy
 import unittest
 from tests.common import TestDNS
 from app.dns.header import Header, HeaderFlags
@@ -90,6 +91,24 @@ class TestDNSHeader(TestDNS):
             b'\x05\x4d\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00'
         )
 
+    def test_header_slots(self) -> None:
+        flags = HeaderFlags(1, OpCode.QUERY.value, 0, 0, 1)
+        header = Header(1357, flags, 1)
+
+        self.assertFalse(hasattr(header, '__dict__'))
+        self.assertFalse(hasattr(flags, '__dict__'))
+        with self.assertRaises(AttributeError):
+            header.extra = 1
+
+        copied = copy.copy(header)
+        copied.flags.rcode = ResponseCode.NAME_ERROR.value
+        copied.ancount = 2
+
+        self.assertEqual(header.flags.rcode, ResponseCode.NO_ERROR.value)
+        self.assertEqual(header.ancount, 0)
+        self.assertEqual(copied.serialize()[:8],
+                         b'\x05\x4d\x81\x03\x00\x01\x00\x02')
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,169 @@
+import argparse
+import os
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+from tests.common import TestDNS
+from app.bench.load import Sender, build, load, loopback, positive_int
+from app.dns.common import ResponseCode, RType
+from app.dns.message import Message
+
+
+class Responder:
+    """A server on this host answering every query but the dropped ones"""
+
+    def __init__(self, tcp: bool = False, drop: int = 0):
+        """
+        :param int drop: Leave the queries whose ID is a multiple of `drop`
+                         unanswered, 0 to answer all
+        """
+        self.tcp = tcp
+        self.drop = drop
+        family = socket.SOCK_STREAM if tcp else socket.SOCK_DGRAM
+        self.sock = socket.socket(socket.AF_INET, family)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        if tcp:
+            self.sock.listen()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def reply(self, query: bytes) -> bytes | None:
+        (query_id,) = struct.unpack_from('>H', query)
+        if self.drop and query_id % self.drop == 0:
+            return None
+        # QR set, NXDOMAIN for every other query
+        flags = 0x8100 | (3 if query_id % 2 else 0)
+        return query[:2] + struct.pack('>H', flags) + query[4:]
+
+    def serve(self) -> None:
+        try:
+            if self.tcp:
+                conn, _ = self.sock.accept()
+                with conn:
+                    buffer = b''
+                    while data := conn.recv(4096):
+                        buffer += data
+                        while len(buffer) >= 2:
+                            (length,) = struct.unpack_from('>H', buffer)
+                            if len(buffer) < 2 + length:
+                                break
+                            res = self.reply(buffer[2:2 + length])
+                            buffer = buffer[2 + length:]
+                            if res is not None:
+                                conn.sendall(struct.pack('>H', len(res))
+                                             + res)
+                return
+
+            while True:
+                query, source = self.sock.recvfrom(512)
+                res = self.reply(query)
+                if res is not None:
+                    self.sock.sendto(res, source)
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+class TestDNSLoad(TestDNS):
+    def test_build(self) -> None:
+        message = Message.from_bytes(build('codecrafters.io', RType.MX.value))
+
+        self.assertEqual(message.header.id, 0)
+        self.assertEqual(message.header.flags.rd, 1)
+        self.assertEqual([(q.name, q.type) for q in message.queries],
+                         [('codecrafters.io', RType.MX.value)])
+
+    def test_load(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'queries.txt')
+            with open(path, 'w') as f:
+                f.write('# names\n\ncodecrafters.io\nexample.com. mx\n'
+                        'example.org ANY\n')
+            queries = load(path)
+
+            self.assertEqual(queries, [
+                build('codecrafters.io'),
+                build('example.com', RType.MX.value),
+                build('example.org', 255),
+            ])
+
+            with open(path, 'w') as f:
+                f.write('example.com BOGUS\n')
+            with self.assertRaises(ValueError):
+                load(path)
+
+    def test_arguments(self) -> None:
+        self.assertEqual(loopback('127.0.0.1:2053'), ('127.0.0.1', 2053))
+        self.assertEqual(loopback('localhost:53')[1], 53)
+        self.assertEqual(positive_int('4'), 4)
+        for func, value in ((loopback, '8.8.8.8:53'),
+                            (loopback, '127.0.0.1:port'),
+                            (positive_int, '0'),
+                            (positive_int, 'many')):
+            with self.subTest(value):
+                with self.assertRaises(argparse.ArgumentTypeError):
+                    func(value)
+
+    def test_answer(self) -> None:
+        sender = Sender(('127.0.0.1', 9), [build('codecrafters.io')],
+                        timeout=0.5, rate=10)
+        self.addCleanup(sender.sock.close)
+        sender.pending = {1: 10.0, 2: 10.0}
+
+        def answer(query_id: int, rcode: int = 0) -> bytes:
+            return struct.pack('>HHHHHH', query_id, 0x8100 | rcode, 0, 0, 0,
+                               0)
+
+        sender.answer(answer(1), 10.002)
+        sender.answer(answer(2, 3), 11.0)
+        sender.answer(answer(1), 10.003)
+        sender.answer(b'\x00\x01', 10.004)
+
+        self.assertEqual((sender.received, sender.late, sender.errors),
+                         (1, 2, 1))
+        self.assertEqual(sender.rcodes, {0: 1})
+        self.assertEqual(sender.pending, {})
+        self.assertAlmostEqual(sender.latency.percentile(50), 0.002,
+                               delta=0.0001)
+
+    def run_load(self, tcp: bool, **kwargs) -> tuple[Sender, Responder]:
+        responder = Responder(tcp=tcp, drop=5)
+        self.addCleanup(responder.close)
+        sender = Sender(responder.address, [build('codecrafters.io')],
+                        tcp=tcp, timeout=0.5, **kwargs)
+        sender.run(0.3)
+        return sender, responder
+
+    def test_loopback(self) -> None:
+        for tcp, kwargs in ((False, {'rate': 200}), (True, {'rate': 200}),
+                            (False, {'outstanding': 4})):
+            with self.subTest(tcp=tcp, **kwargs):
+                sender, _ = self.run_load(tcp, **kwargs)
+
+                # IDs count up from 1, every fifth is dropped
+                self.assertGreater(sender.sent, 10)
+                self.assertEqual(sender.received,
+                                 sender.sent - sender.sent // 5)
+                self.assertEqual((sender.late, sender.errors), (0, 0))
+                self.assertEqual(set(sender.rcodes), {
+                    ResponseCode.NO_ERROR.value,
+                    ResponseCode.NAME_ERROR.value,
+                })
+                self.assertEqual(sum(sender.rcodes.values()),
+                                 sender.received)
+                self.assertEqual(sender.latency.count, sender.received)
+                p50, _, p99, _ = sender.latency.percentiles().values()
+                self.assertGreater(p50, 0)
+                self.assertLessEqual(p50, p99)
+                self.assertLess(p99, 0.5)
+                self.assertGreaterEqual(sender.elapsed, 0.3)
+                self.assertLess(sender.elapsed, 0.3 + 0.5 + 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,12 +10,17 @@ Tests for `app.dns`.
 
 import unittest
 import unittest.mock
+import asyncio
 import logging
 import copy
+import socket
+import threading
 import app.main
-from app.dns.common import ResponseCode, setUpRootLogger, get_random_ttl
+from app.dns.common import RClass, ResponseCode, RType, setUpRootLogger, \
+    get_random_ttl
+from app.dns.header import Header
 from app.dns.message import Message
-from app.dns.record import ResourceRecord
+from app.dns.record import Query, ResourceRecord
 from app.dns.rdata import RDATA
 from tests.messages import test_messages
 from tests.common import TestData
@@ -144,9 +149,289 @@ class TestDNS(unittest.TestCase):
                 self.assertEqual(msg.header.flags.rcode, raises.value)
                 self.compare_subtest()
 
+    @unittest.mock.patch('sys.argv', ['main.py'])
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_message_asyncio(self) -> None:
+        server = app.main.DNSServer()
+        address = server.sock.getsockname()
+
+        async def exchange(data: bytes) -> bytes:
+            loop = asyncio.get_running_loop()
+            client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client.setblocking(False)
+            try:
+                await loop.sock_sendto(client, data, address)
+                return await asyncio.wait_for(
+                    loop.sock_recv(client, 512), timeout=5
+                )
+            finally:
+                client.close()
+
+        async def run() -> list[bytes]:
+            serve = asyncio.create_task(server.serve())
+            try:
+                return [await exchange(subtest[1])
+                        for subtest in test_messages]
+            finally:
+                serve.cancel()
+
+        try:
+            responses = asyncio.run(run())
+        finally:
+            server.sock.close()
+            server.tcp_sock.close()
+
+        for subtest, buf in zip(test_messages, responses):
+            title, data, raises, answers = subtest
+            with self.subTest(title):
+                msg = Message.from_bytes(buf)
+
+                self.assertEqual(msg.header.id,
+                                 int.from_bytes(data[:2], 'big'))
+                self.assertEqual(msg.header.flags.qr, 1)
+                self.assertEqual(msg.header.flags.rcode, raises.value)
+
+    @unittest.mock.patch('sys.argv', ['main.py', '--tcp-idle-timeout',
+                                      '0.2'])
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_message_tcp(self) -> None:
+        server = app.main.DNSServer()
+        address = server.tcp_sock.getsockname()
+
+        async def run() -> tuple[list[bytes], bytes]:
+            serve = asyncio.create_task(server.serve())
+            try:
+                reader, writer = await asyncio.open_connection(*address)
+                # Pipeline every query on the one connection
+                writer.write(b''.join(
+                    len(subtest[1]).to_bytes(2, 'big') + subtest[1]
+                    for subtest in test_messages
+                ))
+                await writer.drain()
+
+                responses = []
+                for _ in test_messages:
+                    length = int.from_bytes(await reader.readexactly(2),
+                                            'big')
+                    responses.append(await reader.readexactly(length))
+
+                # Closed by the server once idle
+                eof = await asyncio.wait_for(reader.read(), timeout=5)
+                writer.close()
+                return responses, eof
+            finally:
+                serve.cancel()
+
+        try:
+            responses, eof = asyncio.run(run())
+        finally:
+            server.sock.close()
+            server.tcp_sock.close()
+
+        self.assertEqual(eof, b'')
+        self.assertEqual(len(responses), len(test_messages))
+        responses = {buf[:2]: Message.from_bytes(buf) for buf in responses}
+        for subtest in test_messages:
+            title, data, raises, answers = subtest
+            with self.subTest(title):
+                msg = responses[data[:2]]
+
+                self.assertEqual(msg.header.flags.qr, 1)
+                self.assertEqual(msg.header.flags.rcode, raises.value)
+
+    @unittest.mock.patch('sys.argv', ['main.py', '--mode', 'batch',
+                                      '--batch-size', '4'])
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_message_batch(self) -> None:
+        server = app.main.DNSServer()
+        server.sock.setblocking(False)
+        address = server.sock.getsockname()
+        pool = [memoryview(bytearray(server.buffer_size))
+                for _ in range(server.arg.buffers)]
+
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.settimeout(5)
+        try:
+            for subtest in test_messages:
+                client.sendto(subtest[1], address)
+
+            handled = []
+            while sum(handled) < len(test_messages):
+                handled.append(server._drain(pool, server.arg.batch_size))
+
+            self.assertLessEqual(max(handled), 4)
+
+            responses = {}
+            for _ in test_messages:
+                buf = client.recv(512)
+                responses[buf[:2]] = Message.from_bytes(buf)
+        finally:
+            client.close()
+            server.sock.close()
+            server.tcp_sock.close()
+
+        for subtest in test_messages:
+            title, data, raises, answers = subtest
+            with self.subTest(title):
+                msg = responses[data[:2]]
+
+                self.assertEqual(msg.header.flags.qr, 1)
+                self.assertEqual(msg.header.flags.rcode, raises.value)
+
+    def server(self, *args: str) -> app.main.DNSServer:
+        with unittest.mock.patch('sys.argv', ['main.py', *args]):
+            server = app.main.DNSServer()
+        self.addCleanup(server.sock.close)
+        self.addCleanup(server.tcp_sock.close)
+        return server
+
+    def query(self, names: list[str]) -> bytes:
+        header = Header(id=0x1234, qdcount=len(names))
+        header.flags.rd = 1
+        return Message(header=header, queries=[
+            Query(name=name, type=RType.A, klass=RClass.IN) for name in names
+        ]).serialize()
+
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_truncate(self) -> None:
+        # The questions fit only once compressed, the answers never do
+        names = [f'host{i}.a-rather-long-domain-name.codecrafters.io'
+                 for i in range(20)]
+        data = self.query(names)
+
+        for args, qdcount in ((), len(names)), (('--no-compression',), 0):
+            with self.subTest(args=args):
+                server = self.server(*args)
+
+                with self.assertLogs('app.main', level='INFO'):
+                    res = server.handle(data)
+                header = Header.from_bytes(res)
+
+                self.assertLessEqual(len(res), 512)
+                self.assertEqual(header.id, 0x1234)
+                self.assertEqual(header.flags.tc, 1)
+                self.assertEqual((header.qdcount, header.ancount,
+                                  header.nscount, header.arcount),
+                                 (qdcount, 0, 0, 0))
+                if qdcount > 0:
+                    self.assertEqual(
+                        [q.name for q in Message.from_bytes(res).queries],
+                        names
+                    )
+                else:
+                    self.assertEqual(len(res), 12)
+
+                # Sent whole over TCP
+                res = server.handle(data, 0xffff)
+                self.assertEqual(Message.from_bytes(res).header.ancount,
+                                 len(names))
+
+    def upstream(self, addresses: list[str]) -> str:
+        """
+        Stub resolver answering a query with each of `addresses` in turn,
+        then nothing.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(5)
+
+        def resolve() -> None:
+            for address in addresses:
+                data, source = sock.recvfrom(512)
+                name = Message.from_bytes(data).queries[0].name
+                response = self.build_response(data, [TestData(
+                    name=name, type=RType.A, klass=RClass.IN, ttl=60,
+                    rdlength=4, rdata=address
+                )])
+                sock.sendto(response.serialize(), source)
+
+        thread = threading.Thread(target=resolve)
+        thread.start()
+        self.addCleanup(sock.close)
+        self.addCleanup(thread.join)
+        return '{}:{}'.format(*sock.getsockname())
+
+    def settle(self, server: app.main.DNSServer) -> None:
+        # A single resolver thread, the refresh was submitted first
+        server.executor.submit(lambda: None).result(timeout=5)
+
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_prefetch_answer(self) -> None:
+        server = self.server(
+            '--resolver', self.upstream(['1.1.1.1', '2.2.2.2']),
+            '--prefetch-hits', '1', '--concurrency', '1',
+            '--upstream-timeout', '0.2',
+        )
+        self.addCleanup(server.upstream.close)
+        clock = unittest.mock.Mock(return_value=1000.0)
+        server.answers.clock = server.cache.clock = clock
+        data = test_messages[0][1]
+        query = Message.from_bytes(data).queries[0]
+
+        def address(res: bytes) -> str:
+            return Message.from_bytes(res).answers[0].rdata.data
+
+        self.assertEqual(address(server.handle(data)), '1.1.1.1')
+
+        # Still answered from the cache, refreshed behind it
+        clock.return_value += 55
+        self.assertEqual(address(server.handle(data)), '1.1.1.1')
+        self.settle(server)
+
+        self.assertEqual(server.answers.stats()['prefetches'], 1)
+        self.assertEqual(address(server.answers.get(data)), '2.2.2.2')
+        self.assertEqual([r.rdata.data for r in server.cache.get(query)],
+                         ['2.2.2.2'])
+
+        # The upstream is gone, the refreshed answer is served until expiry
+        clock.return_value += 55
+        with self.assertLogs('app.main', level='WARNING') as logs:
+            self.assertEqual(address(server.handle(data)), '2.2.2.2')
+            self.settle(server)
+
+        self.assertIn('Refresh ahead of expiry failed', logs.output[0])
+        self.assertEqual(address(server.answers.get(data)), '2.2.2.2')
+
+    @unittest.mock.patch('app.main.DNSServer.address', ('127.0.0.1', 0))
+    def test_prefetch_record(self) -> None:
+        server = self.server(
+            '--resolver', self.upstream(['1.1.1.1', '2.2.2.2']),
+            '--prefetch-hits', '1', '--concurrency', '1',
+            '--answer-cache-size', '0',
+        )
+        self.addCleanup(server.upstream.close)
+        server.cache.clock = unittest.mock.Mock(return_value=1000.0)
+        data = test_messages[0][1]
+        query = Message.from_bytes(data).queries[0]
+
+        server.handle(data)
+        server.cache.clock.return_value += 55
+        with self.assertLogs('app.dns.cache', level='INFO'):
+            res = Message.from_bytes(server.handle(data))
+        self.settle(server)
+
+        self.assertEqual(res.answers[0].rdata.data, '1.1.1.1')
+        self.assertEqual(res.answers[0].ttl, 5)
+        records = server.cache.get(query)
+        self.assertEqual([r.rdata.data for r in records], ['2.2.2.2'])
+        self.assertEqual([r.ttl for r in records], [60])
+
+    @unittest.mock.patch('sys.argv', ['main.py', '--workers', '4'])
+    def test_workers_bind_after_fork(self) -> None:
+        server = app.main.DNSServer()
+
+        self.assertEqual(server.arg.workers, 4)
+        self.assertIsNone(server.sock)
+
+    @unittest.mock.patch('sys.argv', ['main.py', '--workers', '-1'])
+    def test_workers_negative(self) -> None:
+        with unittest.mock.patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                app.main.DNSServer()
+
     @unittest.mock.patch('sys.argv', ['main.py', '--resolver', '8.8.8.8'])
     @unittest.mock.patch('app.main.socket', mock_socket)
-    @unittest.mock.patch('app.dns.message.socket', mock_socket)
+    @unittest.mock.patch('app.dns.upstream.socket', mock_socket)
     def test_message_socket_with_resolver(self) -> None:
         for subtest in test_messages:
             server = app.main.DNSServer()
@@ -155,7 +440,7 @@ class TestDNS(unittest.TestCase):
             response = self.build_response(data, answers)
 
             bresponse = bytes(response)
-            app.dns.message.socket.reply_with(bresponse)
+            app.dns.upstream.socket.reply_with(bresponse, echo_id=True)
             server.sock.queue_recv(data)
             with self.subTest(title):
                 server.main()
@@ -1,8 +1,11 @@
 import unittest
 from tests.common import TestDNS
+from app.bench import samples
 from app.dns.header import Header
 from app.dns.common import OpCode, ResponseCode, RClass, RType
+from app.dns.exceptions import FormatError
 from app.dns.message import Message
+from app.dns.rdata import RDATA
 from app.dns.record import Query, ResourceRecord
 
 
@@ -134,6 +137,140 @@ class TestDNSMessage(TestDNS):
         self.assertEqual(query.type, RType.A.value)
         self.assertEqual(query.klass, RClass.IN.value)
 
+    def test_message_lazy(self) -> None:
+        data = samples.mixed()
+        eager = Message.from_bytes(data)
+        msg = Message.from_bytes(data, lazy=True)
+
+        self.assertEqual(len(msg.queries), 1)
+        for key in Message.lazy_sections:
+            self.assertNotIn(key, msg.__dict__)
+
+        # Only the sections up to the one accessed are decoded
+        self.assertEqual([r.name for r in msg.authorities],
+                         [r.name for r in eager.authorities])
+        self.assertIn('answers', msg.__dict__)
+        self.assertNotIn('additional', msg.__dict__)
+
+        self.assertEqual([(r.name, r.type) for r in msg.additional],
+                         [(r.name, r.type) for r in eager.additional])
+        self.assertNotIn('_lazy', msg.__dict__)
+        self.assertEqual(msg.serialize(), eager.serialize())
+
+    def test_message_lazy_replaced(self) -> None:
+        data = samples.mixed()
+        msg = Message.from_bytes(data, lazy=True)
+
+        msg.answers = []
+        self.assertEqual(len(msg.authorities),
+                         len(Message.from_bytes(data).authorities))
+        self.assertEqual(msg.answers, [])
+
+    def test_message_lazy_truncated(self) -> None:
+        data = samples.mixed()
+        # Ends inside the fixed fields of the last glue record
+        msg = Message.from_bytes(data[:-12], lazy=True)
+
+        self.assertEqual(len(msg.answers), msg.header.ancount)
+        with self.assertRaises(FormatError):
+            msg.additional
+
+    def test_message_hostile_rdlength(self) -> None:
+        data = samples.response(answers=1)
+        # The answer ends with RDLENGTH and 4 bytes of A RDATA
+        for name, packet in (
+            ('zero RDLENGTH', data[:-6] + b'\x00\x00'),
+            ('RDLENGTH past the end', data[:-6] + b'\x00\x10' + data[-4:]),
+            ('truncated RDATA', data[:-2]),
+        ):
+            for lazy in (False, True):
+                with self.subTest(name, lazy=lazy):
+                    with self.assertRaises(FormatError):
+                        Message.from_bytes(packet, lazy=lazy).answers
+
+    def test_message_serialize_without_rdata(self) -> None:
+        message = Message.from_bytes(samples.response(answers=1))
+        message.answers[0].rdata = None
+
+        with self.assertRaises(FormatError):
+            message.serialize()
+
+    def test_message_validate(self) -> None:
+        def expected(msg: Message) -> ResponseCode:
+            res = msg.header.validate()
+            if res != ResponseCode.NO_ERROR:
+                return res
+            for key in Message.sections:
+                for record in getattr(msg, key):
+                    res = record.validate()
+                    if res != ResponseCode.NO_ERROR:
+                        return res
+            return ResponseCode.NO_ERROR
+
+        mutations = {
+            'valid': lambda msg: None,
+            'z': lambda msg: setattr(msg.header.flags, 'z', 1),
+            'opcode': lambda msg: setattr(msg.header.flags, 'opcode', 2),
+            'rcode': lambda msg: setattr(msg.header.flags, 'rcode', 9),
+            'qtype': lambda msg: setattr(msg.queries[0], 'type', 99),
+            'qtype ANY': lambda msg: setattr(msg.queries[0], 'type', 255),
+            'qclass': lambda msg: setattr(msg.queries[0], 'klass', 9),
+            'rtype': lambda msg: setattr(msg.answers[-1], 'type', 255),
+            'rclass': lambda msg: setattr(msg.additional[0], 'klass', 255),
+        }
+        for name, mutate in mutations.items():
+            with self.subTest(name):
+                msg = Message.from_bytes(samples.mixed())
+                mutate(msg)
+                self.assertEqual(msg.validate(), expected(msg))
+
+        self.assertEqual(msg.validate(), ResponseCode.NOT_IMPLEMENTED)
+
+    def test_message_compressed(self) -> None:
+        header = Header(id=1234)
+        header.flags.qr = 1
+
+        def record(name: str, type: RType, **rdata) -> ResourceRecord:
+            record = ResourceRecord(name=name, type=type, klass=RClass.IN,
+                                    ttl=300, rdlength=0, rdata=None)
+            record.rdata = RDATA.factory(type.value, **rdata)
+            return record
+
+        message = Message(
+            header=header,
+            queries=[Query(name='www.reddit.com', type=RType.CNAME,
+                           klass=RClass.IN)],
+            answers=[
+                record('www.reddit.com', RType.CNAME, data='reddit.com'),
+                record('reddit.com', RType.MX, preference=10,
+                       exchange='mx.reddit.com'),
+            ],
+            authorities=[
+                record('fastly.net', RType.SOA, mname='ns1.fastly.net',
+                       rname='hostmaster.fastly.net', serial=1, refresh=2,
+                       retry=3, expire=4, minimum=5),
+            ],
+        )
+
+        plain = message.serialize()
+        actual = message.serialize(compress=True)
+
+        # Owner of the first answer points at the question
+        self.assertEqual(actual[32:34], b'\xc0\x0c')
+        self.assertLess(len(actual), len(plain))
+
+        decoded = Message.from_bytes(actual)
+        self.assertEqual([a.name for a in decoded.answers],
+                         ['www.reddit.com', 'reddit.com'])
+        self.assertEqual(decoded.answers[0].rdata.data, 'reddit.com')
+        self.assertEqual(decoded.answers[0].rdlength, 2)
+        self.assertEqual(decoded.answers[1].rdata.exchange, 'mx.reddit.com')
+
+        soa = decoded.authorities[0]
+        self.assertEqual(soa.name, 'fastly.net')
+        self.assertEqual((soa.rdata.mname, soa.rdata.rname, soa.rdata.minimum),
+                         ('ns1.fastly.net', 'hostmaster.fastly.net', 5))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from tests.common import TestDNS
+from tests.messages import test_messages
+from app.dns.common import ResponseCode, RType
+from app.dns.message import Message
+from app.dns.metrics import Histogram, LatencyHistogram, Metrics, \
+    MetricsDump, MetricsServer, Timings
+
+
+class TestDNSMetrics(TestDNS):
+    def timings(self, seconds: float) -> Timings:
+        timings = Timings()
+        timings.parse = seconds
+        timings.validate = seconds
+        timings.resolve = seconds * 100
+        timings.serialize = seconds
+        return timings
+
+    def test_histogram(self) -> None:
+        histogram = Histogram((0.001, 0.01))
+        for value in (0.0005, 0.001, 0.005, 1.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 1.0065)
+        self.assertEqual(histogram.cumulative(),
+                         [('0.001', 2), ('0.01', 3), ('+Inf', 4)])
+
+    def test_latency(self) -> None:
+        histogram = LatencyHistogram()
+        for us in range(1, 10001):
+            histogram.record(us / 1_000_000)
+
+        self.assertEqual(histogram.count, 10000)
+        for p, expected in ((50, 0.005), (90, 0.009), (99, 0.0099),
+                            (99.9, 0.00999), (100, 0.01)):
+            with self.subTest(p):
+                # Reported within the precision of the histogram, at or
+                # above the latency
+                value = histogram.percentile(p)
+                self.assertGreaterEqual(value, expected)
+                self.assertLess(value, expected * (1 + 1 / 64))
+        self.assertEqual(list(histogram.percentiles()),
+                         ['p50', 'p90', 'p99', 'p99.9'])
+
+    def test_latency_buckets(self) -> None:
+        histogram = LatencyHistogram(highest=1.0, precision=3)
+
+        self.assertEqual(len(histogram.counts), 17 * 4 + 8)
+        for us in (0, 7, 8, 9, 15, 16, 1000, 999_999):
+            with self.subTest(us):
+                low, high = histogram._bounds(histogram._index(us))
+                self.assertLessEqual(low, us)
+                self.assertGreaterEqual(high, us)
+                self.assertLessEqual(high - low, low // 4)
+
+        # Clamped to the highest value tracked
+        histogram.record(3600.0)
+        self.assertEqual(histogram.counts[-1], 1)
+        self.assertEqual(histogram.percentile(100), 1048575 / 1_000_000)
+
+    def test_latency_merge(self) -> None:
+        first, second = LatencyHistogram(), LatencyHistogram()
+        for us in range(100):
+            first.record(0.001)
+            second.record(0.1)
+
+        first.merge(LatencyHistogram.from_dict(second.to_dict()))
+
+        self.assertEqual(first.count, 200)
+        self.assertAlmostEqual(first.sum, 10.1)
+        self.assertLess(first.percentile(50), 0.0011)
+        self.assertGreater(first.percentile(51), 0.099)
+        with self.assertRaises(ValueError):
+            first.merge(LatencyHistogram(precision=5))
+
+    def test_latency_interval(self) -> None:
+        metrics = Metrics()
+        timings = self.timings(0.001)
+        timings.upstream = 0.05
+        metrics.request.record(0.002)
+        metrics.record(RType.A.value, 0, timings)
+
+        interval = metrics.interval()
+
+        self.assertEqual(interval['request'].count, 1)
+        self.assertEqual(interval['upstream'].count, 1)
+        self.assertEqual(metrics.request.count, 0)
+
+        metrics.request.record(0.004)
+        self.assertEqual(metrics.interval()['request'].count, 1)
+        self.assertEqual(metrics.latency('request').count, 2)
+        self.assertEqual(metrics.latency('upstream').count, 1)
+
+    def test_render(self) -> None:
+        metrics = Metrics()
+        metrics.record(RType.A.value, 0, self.timings(0.00002))
+        metrics.record(RType.A.value, 0, self.timings(0.00002))
+        metrics.record(255, 3, self.timings(0.002))
+        metrics.error(ResponseCode.FORMAT_ERROR.value)
+
+        text = metrics.render().splitlines()
+
+        self.assertIn('# TYPE dns_stage_seconds histogram', text)
+        self.assertIn('dns_stage_seconds_bucket{stage="parse",qtype="A",'
+                      'rcode="NO_ERROR",le="2.5e-05"} 2', text)
+        self.assertIn('dns_stage_seconds_bucket{stage="resolve",qtype="A",'
+                      'rcode="NO_ERROR",le="0.001"} 0', text)
+        self.assertIn('dns_stage_seconds_count{stage="resolve",qtype="ANY",'
+                      'rcode="NAME_ERROR"} 1', text)
+        self.assertIn('dns_requests_total{qtype="A",rcode="NO_ERROR"} 2',
+                      text)
+        self.assertIn('dns_errors_total{rcode="FORMAT_ERROR"} 1', text)
+        self.assertIn('# TYPE dns_request_latency_seconds summary', text)
+        self.assertIn('dns_upstream_latency_seconds{quantile="0.999"} 0.0',
+                      text)
+
+    def test_create_response(self) -> None:
+        timings = Timings()
+        message = Message.from_bytes(test_messages[0][1])
+
+        message.create_response(timings=timings)
+
+        self.assertGreater(timings.validate, 0)
+        self.assertGreater(timings.resolve, 0)
+        self.assertEqual(timings.parse, 0)
+
+    def test_endpoint(self) -> None:
+        metrics = Metrics()
+        metrics.record(RType.A.value, 0, self.timings(0.001))
+        server = MetricsServer(metrics, ('127.0.0.1', 0))
+        server.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://{}:{}'.format(*server.server_address)
+
+        with urllib.request.urlopen(f'{url}/metrics', timeout=5) as res:
+            body = res.read().decode()
+        self.assertEqual(body, metrics.render())
+
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/other', timeout=5)
+
+    def test_dump(self) -> None:
+        metrics = Metrics()
+        metrics.record(RType.MX.value, 0, self.timings(0.001))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'metrics.json')
+            MetricsDump(metrics, path).dump()
+
+            with open(path) as f:
+                dump = json.load(f)
+
+        series = dump['series'][0]
+        self.assertEqual((series['qtype'], series['rcode'], series['count']),
+                         ('MX', 'NO_ERROR', 1))
+        self.assertEqual(series['stages']['resolve']['buckets']['0.1'], 1)
+        self.assertEqual(dump['latency']['request']['count'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import argparse
+import asyncio
+import threading
+import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from tests.common import TestDNS
+from app.dns.metrics import Metrics
+from app.protocol import TCPProtocol, UDPProtocol
+
+
+class Server:
+    """Stands in for DNSServer, resolving on its executor once released"""
+
+    resolver = ('127.0.0.1', 53)
+
+    def __init__(self) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.metrics = Metrics()
+        self.arg = argparse.Namespace(tcp_max_connections=8,
+                                      tcp_idle_timeout=5.0)
+        self.tcp_connections: set[TCPProtocol] = set()
+        self.released = threading.Event()
+        self.threads: list[str] = []
+
+    def handle(self, buf: bytes, max_size: int = 512) -> bytes | None:
+        self.threads.append(threading.current_thread().name)
+        self.released.wait(5)
+        if buf == b'fail':
+            raise ValueError('Upstream went away')
+        return b're:' + buf
+
+
+class TestDNSProtocol(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = Server()
+        self.addCleanup(self.server.executor.shutdown)
+        self.addCleanup(self.server.released.set)
+
+    async def settle(self, condition: Callable[[], bool]) -> None:
+        for _ in range(500):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Timed out waiting on the executor')
+
+    def test_udp(self) -> None:
+        transport = unittest.mock.Mock()
+        address = ('127.0.0.1', 5353)
+
+        async def run() -> None:
+            protocol = UDPProtocol(self.server)
+            protocol.connection_made(transport)
+            protocol.datagram_received(b'first', address)
+            protocol.datagram_received(b'second', address)
+
+            # Received while the first queries are still resolving
+            await self.settle(lambda: len(self.server.threads) == 2)
+            transport.sendto.assert_not_called()
+
+            self.server.released.set()
+            await self.settle(lambda: transport.sendto.call_count == 2)
+
+        asyncio.run(run())
+
+        self.assertNotIn(threading.current_thread().name,
+                         self.server.threads)
+        self.assertCountEqual(
+            transport.sendto.call_args_list,
+            [unittest.mock.call(b're:first', address),
+             unittest.mock.call(b're:second', address)]
+        )
+        self.assertEqual(self.server.metrics.request.count, 2)
+
+    def test_udp_error(self) -> None:
+        transport = unittest.mock.Mock()
+        self.server.released.set()
+
+        async def run() -> None:
+            protocol = UDPProtocol(self.server)
+            protocol.connection_made(transport)
+            protocol.datagram_received(b'fail', ('127.0.0.1', 5353))
+            await self.settle(lambda: len(self.server.threads) == 1)
+            await asyncio.sleep(0.1)
+
+        with self.assertLogs('app.protocol', level='ERROR') as logs:
+            asyncio.run(run())
+
+        transport.sendto.assert_not_called()
+        # The traceback of the worker thread, not "NoneType: None"
+        exc = logs.records[0].exc_info[1]
+        self.assertIsInstance(exc, ValueError)
+        self.assertIn('in handle', logs.output[0])
+
+    def test_tcp_flow_control(self) -> None:
+        transport = unittest.mock.Mock()
+        frames = [b'one', b'two', b'fail']
+
+        async def run() -> TCPProtocol:
+            protocol = TCPProtocol(self.server)
+            protocol.max_pipelined = 2
+            protocol.connection_made(transport)
+            protocol.data_received(b''.join(
+                protocol.prefix.pack(len(frame)) + frame for frame in frames
+            ))
+
+            # Paused once as many queries as allowed are in flight
+            self.assertEqual(protocol.pending, 3)
+            self.assertTrue(protocol.paused)
+            transport.pause_reading.assert_called_once()
+            transport.resume_reading.assert_not_called()
+
+            self.server.released.set()
+            await self.settle(lambda: protocol.pending == 0)
+            protocol.connection_lost(None)
+            return protocol
+
+        with self.assertLogs('app.protocol', level='ERROR') as logs:
+            protocol = asyncio.run(run())
+
+        self.assertFalse(protocol.paused)
+        transport.resume_reading.assert_called_once()
+        self.assertCountEqual(
+            transport.write.call_args_list,
+            [unittest.mock.call(b'\x00\x06re:one'),
+             unittest.mock.call(b'\x00\x06re:two')]
+        )
+        self.assertIsInstance(logs.records[0].exc_info[1], ValueError)
+        self.assertEqual(self.server.tcp_connections, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import copy
+import unittest
+from tests.common import TestDNS
+from app.dns.common import RClass, RType
+from app.dns.exceptions import NotImplementedError
+from app.dns.header import Header
+from app.dns.message import Message
+from app.dns.rdata import RDATA, RDATA_A, RDATA_DOMAIN, RDATA_MX, RDATA_SOA
+from app.dns.record import Query, ResourceRecord
+
+
+class TestDNSRDATA(TestDNS):
+    def test_rdata_fields(self) -> None:
+        soa = RDATA_SOA('ns1.fastly.net', 'hostmaster.fastly.net', 1,
+                        minimum=300)
+
+        self.assertFalse(hasattr(soa, '__dict__'))
+        self.assertEqual(RDATA_SOA._fields[:3], ('mname', 'rname', 'serial'))
+        self.assertEqual((soa.mname, soa.serial, soa.retry, soa.minimum),
+                         ('ns1.fastly.net', 1, 0, 300))
+
+        with self.assertRaises(AttributeError):
+            soa.data = 'fastly.net'
+        with self.assertRaises(AttributeError):
+            RDATA_A().data
+
+    def test_rdata_instances(self) -> None:
+        first = RDATA.factory(RType.A.value, data='1.2.3.4')
+        second = RDATA.factory(RType.A.value, data='5.6.7.8')
+
+        self.assertIsInstance(first, RDATA_A)
+        self.assertEqual(first.data, '1.2.3.4')
+        self.assertEqual(second.data, '5.6.7.8')
+
+    def test_rdata_copy(self) -> None:
+        mx = RDATA_MX(10, 'mx.reddit.com')
+        copied = copy.copy(mx)
+        copied.preference = 20
+
+        self.assertEqual(mx.preference, 10)
+        self.assertEqual(copied.exchange, 'mx.reddit.com')
+        self.assertEqual(bytes(copied), b'\x00\x14\x02mx\x06reddit\x03com\x00')
+
+        # Unset fields stay unset
+        self.assertFalse(hasattr(copy.copy(RDATA_A()), 'data'))
+
+    def register_aaaa(self) -> type[RDATA]:
+        self.addCleanup(RDATA._codecs.pop, RType.AAAA.value)
+
+        @RDATA.register(RType.AAAA)
+        class RDATA_AAAA(RDATA):
+            data: bytes = b''
+
+            def __bytes__(self) -> bytes:
+                return self.data
+
+            @classmethod
+            def decode(cls, data, offset=0, length=None, names=None):
+                return cls(bytes(data[offset:offset + length]))
+
+        return RDATA_AAAA
+
+    def test_rdata_register(self) -> None:
+        self.assertIs(RDATA.codec(RType.PTR.value), RDATA_DOMAIN)
+        with self.assertRaises(NotImplementedError):
+            RDATA.codec(RType.AAAA.value)
+
+        RDATA_AAAA = self.register_aaaa()
+
+        rdata = RDATA.factory(RType.AAAA.value, data=b'\x00' * 16)
+        self.assertIsInstance(rdata, RDATA_AAAA)
+        self.assertEqual(RDATA_AAAA.decode(b'\x01' * 16, 0, 16).data,
+                         b'\x01' * 16)
+
+    def test_rdata_register_message(self) -> None:
+        RDATA_AAAA = self.register_aaaa()
+        address = bytes(range(16))
+        header = Header(id=1, qdcount=1, ancount=2)
+        header.flags.qr = 1
+        message = Message(
+            header=header,
+            queries=[Query('reddit.com', RType.AAAA, RClass.IN)],
+            answers=[
+                ResourceRecord('reddit.com', RType.AAAA, RClass.IN, 300, 16,
+                               address),
+                ResourceRecord('reddit.com', RType.A, RClass.IN, 300, 4,
+                               '1.2.3.4'),
+            ],
+        )
+
+        for lazy in (False, True):
+            with self.subTest(lazy=lazy):
+                res = Message.from_bytes(message.serialize(compress=True),
+                                         lazy=lazy)
+
+                # Decoded with its RDATA, the next record read from the
+                # right offset
+                self.assertEqual([a.type for a in res.answers],
+                                 [RType.AAAA.value, RType.A.value])
+                self.assertIsInstance(res.answers[0], ResourceRecord)
+                self.assertIsInstance(res.answers[0].rdata, RDATA_AAAA)
+                self.assertEqual(res.answers[0].rdata.data, address)
+                self.assertEqual(res.answers[1].rdata.data, '1.2.3.4')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,8 @@
+import copy
 import unittest
 from tests.common import TestDNS
-from app.dns.record import Query, ResourceRecord
-from app.dns.common import ResponseCode
+from app.dns.record import BaseRecord, Query, Record, ResourceRecord
+from app.dns.common import RClass, ResponseCode, RType
 
 
 class TestDNSRecord(TestDNS):
@@ -71,6 +72,58 @@ class TestDNSRecord(TestDNS):
 
                 self.assertEqual(actual, expected)
 
+    def test_record_slots(self) -> None:
+        for source in self.subtests:
+            testdata, bytedata = source
+            with self.subTest(f'{testdata!r}'):
+                record = ResourceRecord(
+                    testdata.name, testdata.type, testdata.klass,
+                    testdata.ttl, testdata.rdlength, testdata.rdata
+                )
+                self.assertFalse(hasattr(record, '__dict__'))
+                self.assertEqual(record.type, testdata.type.value)
+                self.assertEqual(record.klass, testdata.klass.value)
+
+                copied = copy.copy(record)
+                copied.ttl += 1
+                self.assertIsNot(copied.rdata, record.rdata)
+                self.assertEqual(record.ttl, testdata.ttl)
+                self.assertEqual(copied.bytes_read, 0)
+                self.assertEqual(copied.serialize()[-len(bytedata.rdata):],
+                                 bytedata.rdata)
+
+                with self.assertRaises(AttributeError):
+                    record.extra = 1
+
+    def test_record_factory(self) -> None:
+        data = (
+            b'\x03www\x06reddit\x03com\x00'
+            b'\x00\x1c\x00\x01\x00\x00\x01\x2c\x00\x10' + b'\x00' * 16
+        )
+
+        # AAAA carries no RDATA codec, only the owner and type are read
+        record, i = BaseRecord.factory(data)
+        self.assertIs(record.__class__, BaseRecord)
+        self.assertEqual((record.name, record.type, i),
+                         ('www.reddit.com', RType.AAAA.value, 18))
+
+        self.addCleanup(BaseRecord._types.pop, RType.AAAA.value)
+        BaseRecord.register(RType.AAAA, Record)
+
+        record, i = BaseRecord.factory(data)
+        self.assertIs(record.__class__, Record)
+        self.assertEqual((record.klass, i), (RClass.IN.value, 20))
+
+    def test_record_lookup(self) -> None:
+        for type, rdata in ((RType.A, b'\x08\x08\x08\x08'),
+                            (RType.MX, b'\x00\x00\x00')):
+            with self.subTest(type.name):
+                query = Query('example.com', type, RClass.IN)
+
+                record = ResourceRecord.lookup(query)
+
+                self.assertEqual(bytes(record)[-len(rdata):], rdata)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,81 @@
+import os
+import signal
+import threading
+import time
+import unittest
+import unittest.mock
+from tests.common import TestDNS
+from app.supervisor import Supervisor
+
+
+class TestDNSSupervisor(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        # Supervisor.run installs its own handlers
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def test_restart_backoff(self) -> None:
+        supervisor = Supervisor(lambda: None, workers=1, restart_delay=0.5)
+        started = []
+        spawn = supervisor.spawn
+
+        def spawned() -> int:
+            pid = spawn()
+            started.append(pid)
+            return pid
+
+        def backoff(delay: float) -> None:
+            # Stopped while backing off the second restart
+            if len(started) > 1:
+                supervisor._stop(signal.SIGTERM, None)
+
+        with unittest.mock.patch.object(supervisor, 'spawn', spawned), \
+                unittest.mock.patch('app.supervisor.time.sleep',
+                                    side_effect=backoff) as sleep:
+            supervisor.run()
+
+        self.assertEqual(len(started), 2)
+        self.assertEqual(sleep.call_args_list,
+                         [unittest.mock.call(0.5)] * 2)
+        self.assertEqual(supervisor.children, {})
+
+    def test_restart_without_backoff(self) -> None:
+        supervisor = Supervisor(lambda: None, workers=2)
+        supervisor.min_uptime = 0
+        started = []
+        spawn = supervisor.spawn
+
+        def spawned() -> int:
+            started.append(spawn())
+            if len(started) == 4:
+                supervisor.stopping = True
+            return started[-1]
+
+        with unittest.mock.patch.object(supervisor, 'spawn', spawned), \
+                unittest.mock.patch('app.supervisor.time.sleep') as sleep:
+            supervisor.run()
+
+        self.assertEqual(len(started), 4)
+        sleep.assert_not_called()
+        self.assertEqual(supervisor.children, {})
+
+    def test_stop(self) -> None:
+        supervisor = Supervisor(lambda: time.sleep(30), workers=2)
+        stop = threading.Timer(0.3, os.kill, (os.getpid(), signal.SIGTERM))
+        stop.start()
+        self.addCleanup(stop.cancel)
+
+        start = time.monotonic()
+        supervisor.run()
+
+        self.assertTrue(supervisor.stopping)
+        self.assertEqual(supervisor.children, {})
+        self.assertLess(time.monotonic() - start, 10)
+        # Every worker was reaped, none is left behind
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(-1, os.WNOHANG)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import socket
+import threading
+import unittest
+import unittest.mock
+from tests.common import TestDNS
+from tests.messages import test_messages
+from app.dns.common import ResponseCode
+from app.dns.exceptions import DNSServerFailure
+from app.dns.message import Message
+from app.dns.metrics import Timings
+from app.dns.upstream import UpstreamClient
+
+
+class TestDNSUpstream(TestDNS):
+    def setUp(self) -> None:
+        super().setUp()
+        self.resolver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.resolver.bind(('127.0.0.1', 0))
+        self.resolver.settimeout(5)
+        self.client = UpstreamClient(self.resolver.getsockname(),
+                                     pool_size=1, timeout=0.5)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.resolver.close()
+        super().tearDown()
+
+    def answer(self, data: bytes) -> bytes:
+        return Message.from_bytes(data).create_response().serialize()
+
+    def test_question(self) -> None:
+        data = test_messages[-1][1]
+
+        self.assertEqual(UpstreamClient.question(data), data[12:])
+
+    def test_out_of_order_replies(self) -> None:
+        queries = [data for _, data, _, _ in test_messages[:3]]
+        pending = [self.client.submit(data) for data in queries]
+
+        received = [self.resolver.recvfrom(512) for _ in queries]
+        for data, source in reversed(received):
+            self.resolver.sendto(self.answer(data), source)
+
+        self.client.wait(pending)
+
+        for data, query in zip(queries, pending):
+            with self.subTest(query.id):
+                self.assertTrue(query.done)
+                self.assertEqual(query.response[:2], data[:2])
+                self.assertEqual(UpstreamClient.question(query.response),
+                                 UpstreamClient.question(data))
+        self.assertEqual(self.client._pending, {})
+
+    def test_upstream_id(self) -> None:
+        data = test_messages[0][1]
+        with unittest.mock.patch('app.dns.upstream.secrets.randbits',
+                                 side_effect=[0xbeef, 0xbeef, 0xcafe]):
+            first = self.client.submit(data)
+            second = self.client.submit(data)
+
+        # The ID in flight is drawn again
+        self.assertEqual((first.upstream_id, second.upstream_id),
+                         (0xbeef, 0xcafe))
+        sent = [self.resolver.recvfrom(512)[0] for _ in range(2)]
+        self.assertEqual([s[:2] for s in sent], [b'\xbe\xef', b'\xca\xfe'])
+        self.assertEqual([s[2:] for s in sent], [data[2:]] * 2)
+
+    def test_mismatched_question(self) -> None:
+        query = self.client.submit(test_messages[0][1])
+        data, source = self.resolver.recvfrom(512)
+
+        # Same ID, different question
+        other = data[:2] + test_messages[1][1][2:]
+        self.resolver.sendto(self.answer(other), source)
+
+        self.client.wait([query])
+
+        self.assertFalse(query.done)
+        self.assertIsNone(query.response)
+        self.assertEqual(self.client._pending, {})
+
+    def test_fan_out(self) -> None:
+        data = test_messages[-1][1]
+        message = Message.from_bytes(data)
+        received = []
+
+        def resolve() -> None:
+            # Both questions arrive before anything is answered
+            for _ in message.queries:
+                received.append(self.resolver.recvfrom(512))
+            for query, source in reversed(received):
+                self.resolver.sendto(self.answer(query), source)
+
+        thread = threading.Thread(target=resolve)
+        thread.start()
+        response = message.create_response(resolver=self.client)
+        thread.join()
+
+        self.assertEqual(len(received), 2)
+        for query, _ in received:
+            self.assertEqual(Message.from_bytes(query).header.qdcount, 1)
+
+        self.assertEqual(response.header.id, message.header.id)
+        self.assertEqual(response.header.ancount, 2)
+        self.assertEqual([a.name for a in response.answers],
+                         [q.name for q in message.queries])
+
+    def test_upstream_error(self) -> None:
+        data = test_messages[-1][1]
+        message = Message.from_bytes(data)
+
+        def resolve(rcodes: list[ResponseCode]) -> None:
+            received = [self.resolver.recvfrom(512) for _ in rcodes]
+            for (query, source), rcode in zip(received, rcodes):
+                reply = Message.from_bytes(query)
+                reply.header.flags.qr = 1
+                reply.header.flags.rcode = rcode.value
+                self.resolver.sendto(reply.serialize(), source)
+
+        for rcodes, expected in (
+            ([ResponseCode.SERVER_FAILURE] * 2, ResponseCode.SERVER_FAILURE),
+            ([ResponseCode.REFUSED] * 2, ResponseCode.REFUSED),
+            ([ResponseCode.NAME_ERROR, ResponseCode.SERVER_FAILURE],
+             ResponseCode.SERVER_FAILURE),
+            ([ResponseCode.NAME_ERROR] * 2, ResponseCode.NAME_ERROR),
+        ):
+            with self.subTest(rcodes=rcodes):
+                thread = threading.Thread(target=resolve, args=(rcodes,))
+                thread.start()
+                response = message.create_response(resolver=self.client)
+                thread.join()
+
+                # Not an empty NOERROR, which reads as NODATA
+                self.assertEqual(response.header.flags.rcode, expected.value)
+                self.assertEqual(response.answers, [])
+
+    def test_round_trip(self) -> None:
+        data = test_messages[0][1]
+        timings = Timings()
+
+        def resolve() -> None:
+            query, source = self.resolver.recvfrom(512)
+            self.resolver.sendto(self.answer(query), source)
+
+        thread = threading.Thread(target=resolve)
+        thread.start()
+        Message.from_bytes(data).create_response(resolver=self.client,
+                                                 timings=timings)
+        thread.join()
+
+        self.assertGreater(timings.upstream, 0)
+        self.assertLessEqual(timings.upstream, timings.resolve)
+
+    def test_timeout(self) -> None:
+        with self.assertRaises(DNSServerFailure):
+            self.client.query(test_messages[0][1], timeout=0.1)
+
+        self.assertEqual(self.client._pending, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import struct
+import unittest
+from tests.common import TestDNS
+from app.dns.exceptions import FormatError
+from app.dns.writer import Writer
+
+
+class TestDNSWriter(TestDNS):
+    def test_names(self) -> None:
+        for source in self.subtests:
+            with self.subTest(source=source):
+                testdata, bytedata = source
+                writer = Writer()
+                writer.name(testdata.name)
+
+                self.assertEqual(writer.getvalue(), bytedata.name)
+
+    def test_compression(self) -> None:
+        writer = Writer(names={}, base=12)
+        writer.name('www.google.com')
+        writer.name('mail.google.com.')
+        writer.name('www.google.com')
+
+        self.assertEqual(
+            writer.getvalue(),
+            b'\x03www\x06google\x03com\x00'
+            b'\x04mail\xc0\x10'
+            b'\xc0\x0c'
+        )
+
+    def test_back_patch(self) -> None:
+        u16 = struct.Struct('!H')
+        writer = Writer(size=4)
+        position = writer.skip(2)
+        writer.write(b'payload')
+        writer.pack_at(u16, position, len(writer) - 2)
+
+        self.assertEqual(writer.getvalue(), b'\x00\x07payload')
+        self.assertGreaterEqual(len(writer.buffer), len(writer))
+
+    def test_label_limit(self) -> None:
+        writer = Writer()
+        writer.name('a' * 63 + '.com')
+
+        with self.assertRaises(FormatError):
+            writer.name('a' * 64 + '.com')
+
+
+if __name__ == "__main__":
+    unittest.main()